@@ -0,0 +1,411 @@
+'''
+In-process stand-in for the Veneer client, for benchmarking and testing CloeSetup,
+CloeScenario and Checkpoint.
+
+FakeVeneer implements the client calls they use (network,
+model.catchment.generation/runoff, model.link.constituents, model.functions,
+variables, data sources, recording and retrieval) against an in-memory model.
+Each call counts as one request and is delayed by latency seconds. Retrieving
+time series counts one request per series, as Veneer does. The values of each
+retrieved series depend only on the series, so retrieving in parts returns the
+same values as retrieving at once. Runs are identified by run_number and run_date,
+and run_model starts a new run, recording the generation parameters it ran with.
+
+Parameters of generation and instream models, and time series assignments, are
+stored for each element (get_param_values returns zeros for parameters that
+haven't been set). Installing a model resets the parameters and time series of
+its elements. Variables are listed in the order they were created, and functions
+are stored with their arguments.
+
+Elements are the product of the model's catchments, FUs, constituents and
+sources (or links and constituents). Each request selects the allowed values of
+each key, in enumeration order, through an index of value -> position that is
+rebuilt when the structure changes, so the cost of a request grows with the
+number of elements it matches rather than the size of the model. Run results are
+likewise listed once per structure and set of recorders.
+'''
+import itertools
+import re
+import threading
+import time
+import zlib
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+from veneer.utils import _stringToList
+
+# Element table keys (ie enumerate_names) and the constraint for each
+GENERATION_KEYS=['catchments','fus','constituents','sources']
+LINK_KEYS=['links','constituents']
+
+# FakeVeneer attribute listing the values of each key
+DIMENSIONS={
+    'catchments':'catchments',
+    'fus':'fus',
+    'constituents':'constituents',
+    'sources':'constituent_sources',
+    'links':'links'
+}
+
+@lru_cache(maxsize=None)
+def _search(pattern,value):
+    return re.search(pattern,value) is not None
+
+class ElementValues(dict):
+    '''
+    Values of (element,parameter), remembering the parameters set, so that the values
+    of an element can be reset without scanning every element
+    '''
+    def __init__(self):
+        super().__init__()
+        self.parameter_names = set()
+
+    def __setitem__(self,key,value):
+        self.parameter_names.add(key[1])
+        super().__setitem__(key,value)
+
+    def reset(self,names,parameter=None):
+        parameters = self.parameter_names if parameter is None else [parameter]
+        for name in names:
+            for p in parameters:
+                self.pop((name,p),None)
+
+class FakeNetwork(object):
+    def __init__(self,network_df):
+        self.network_df = network_df
+
+    def as_dataframe(self):
+        return self.network_df
+
+class FakeVariables(object):
+    def __init__(self,names):
+        self.names = names
+
+    def _select(self,fields):
+        return list(self.names)
+
+class _Endpoint(object):
+    '''
+    Attribute path on the client (eg model.catchment.generation), dispatching calls to
+    FakeVeneer methods named after the path (eg model_catchment_generation_set_models)
+    '''
+    def __init__(self,client,path):
+        self._client = client
+        self._path = path
+
+    def __getattr__(self,attr):
+        return _Endpoint(self._client,'%s_%s'%(self._path,attr))
+
+    def __call__(self,*args,**kwargs):
+        method = getattr(self._client,'_'+self._path,None)
+        if method is None:
+            raise AttributeError('FakeVeneer does not implement %s'%self._path.replace('_','.'))
+        return self._client._request(self._path,method,*args,**kwargs)
+
+class FakeVeneer(object):
+    '''
+    network_df: network, as per network().as_dataframe()
+    fus: functional unit types in each catchment
+    latency: seconds added to each request
+    dates: time period of results returned by retrieve_multiple_time_series
+    '''
+    def __init__(self,network_df,fus,latency=0.0,dates=None):
+        self.network_df = network_df
+        self.catchments = list(network_df[network_df['feature_type']=='catchment']['name'])
+        self.links = list(network_df[network_df['feature_type']=='link']['name'])
+        self.fus = list(fus)
+        self.latency = latency
+        if dates is None:
+            dates = pd.date_range('2000-01-01',periods=365)
+        self.dates = dates
+        self.constituents = []
+        self.constituent_sources = []
+        self.generation_models = {}
+        self.parameters = ElementValues()
+        self.time_series = ElementValues()
+        self.link_models = {}
+        self.link_parameters = ElementValues()
+        self.recorders = []
+        self.run_number = 1
+        self.run_date = '01/01/2000 00:00:00'
+        self.runs = []
+        self._index = {}
+        self._results = (None,None)
+        self.variable_names = {}
+        self.functions = {}
+        self.data_source_columns = {}
+        self.requests = 0
+        self.requests_by_path = {}
+        self._lock = threading.Lock()
+        self._model_lock = threading.RLock()
+        self.model = _Endpoint(self,'model')
+
+    def _request(self,path,method,*args,**kwargs):
+        with self._lock:
+            self.requests += 1
+            self.requests_by_path[path] = self.requests_by_path.get(path,0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        with self._model_lock:
+            return method(*args,**kwargs)
+
+    def _count(self,path,n):
+        with self._lock:
+            self.requests += n
+            self.requests_by_path[path] = self.requests_by_path.get(path,0) + n
+        if self.latency:
+            time.sleep(self.latency*n)
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = 0
+            self.requests_by_path = {}
+
+    # Model structure
+
+    def _structure(self):
+        '''
+        Identifies the current values of each key, changing when the model structure changes
+        (the lists themselves are included, so that their ids aren't reused while cached)
+        '''
+        values = [getattr(self,attr) for attr in DIMENSIONS.values()]
+        return tuple((id(v),len(v)) for v in values), values
+
+    def _positions(self,key):
+        '''
+        Position of each value of key, re-indexed when the values change
+        '''
+        values = getattr(self,DIMENSIONS[key])
+        indexed = self._index.get(key,None)
+        if indexed is None or indexed[0] is not values or indexed[1] != len(values):
+            indexed = (values,len(values),{v:ix for ix,v in enumerate(values)})
+            self._index[key] = indexed
+        return indexed[2]
+
+    def _select(self,key,kwargs):
+        '''
+        Values of key allowed by the constraint in kwargs, in enumeration order
+        '''
+        values = getattr(self,DIMENSIONS[key])
+        if key not in kwargs:
+            return list(values)
+        positions = self._positions(key)
+        return [values[ix] for ix in sorted({positions[v] for v in _stringToList(kwargs[key]) if v in positions})]
+
+    def _element_names(self,keys,kwargs):
+        return list(itertools.product(*[self._select(k,kwargs) for k in keys]))
+
+    def network(self):
+        return self._request('network',lambda: FakeNetwork(self.network_df))
+
+    def _model_catchment_get_functional_unit_types(self):
+        return [fu for _ in self.catchments for fu in self.fus]
+
+    def _model_add_constituent(self,name):
+        if name not in self.constituents:
+            self.constituents.append(name)
+
+    def _model_add_constituent_source(self,name):
+        if name not in self.constituent_sources:
+            self.constituent_sources.append(name)
+
+    def _model_get_constituents(self):
+        return list(self.constituents)
+
+    def _model_get_constituent_sources(self):
+        return list(self.constituent_sources)
+
+    # Instream (link constituent) models
+
+    def _link_names(self,**kwargs):
+        return self._element_names(LINK_KEYS,kwargs)
+
+    def _model_link_constituents_enumerate_names(self,**kwargs):
+        return self._link_names(**kwargs)
+
+    def _model_link_constituents_set_models(self,model,**kwargs):
+        names = self._link_names(**kwargs)
+        for name in names:
+            self.link_models[name] = model
+        self.link_parameters.reset(names)
+
+    def _model_link_constituents_set_param_values(self,parameter,values,fromList=False,**kwargs):
+        names = self._link_names(**kwargs)
+        for name,value in zip(names,self._element_values(names,values,fromList)):
+            self.link_parameters[(name,parameter)] = value
+
+    def _model_link_constituents_get_param_values(self,parameter,**kwargs):
+        return [self.link_parameters.get((n,parameter),0.0) for n in self._link_names(**kwargs)]
+
+    # Generation models
+
+    def _generation_names(self,**kwargs):
+        return self._element_names(GENERATION_KEYS,kwargs)
+
+    def _model_catchment_generation_enumerate_names(self,**kwargs):
+        return self._generation_names(**kwargs)
+
+    def _model_catchment_generation_set_models(self,model,**kwargs):
+        names = self._generation_names(**kwargs)
+        for name in names:
+            self.generation_models[name] = model
+        self.parameters.reset(names)
+        self.time_series.reset(names)
+
+    def _element_values(self,names,values,from_list):
+        if not from_list:
+            return [values]*len(names)
+        values = list(values)
+        if len(values) != len(names):
+            raise Exception('Expected %d values, got %d'%(len(names),len(values)))
+        return values
+
+    def _model_catchment_generation_model_table(self,**kwargs):
+        names = self._generation_names(**kwargs)
+        table = pd.DataFrame(names,columns=['Catchment','Functional Unit','Constituent','Constituent Source'])
+        table['model'] = [self.generation_models.get(n,None) for n in names]
+        return table
+
+    def _model_catchment_generation_set_param_values(self,parameter,values,fromList=False,**kwargs):
+        names = self._generation_names(**kwargs)
+        for name,value in zip(names,self._element_values(names,values,fromList)):
+            self.parameters[(name,parameter)] = value
+
+    def _model_catchment_generation_get_param_values(self,parameter,**kwargs):
+        return [self.parameters.get((n,parameter),0.0) for n in self._generation_names(**kwargs)]
+
+    def _model_catchment_generation_assign_time_series(self,parameter,values,data_source,from_list=False,**kwargs):
+        if data_source not in self.data_source_columns:
+            raise Exception('No data source: %s'%data_source)
+        names = self._generation_names(**kwargs)
+        for name,column in zip(names,self._element_values(names,values,from_list)):
+            self.time_series[(name,parameter)] = (data_source,column)
+
+    def _model_catchment_generation_clear_time_series(self,parameter,**kwargs):
+        self.time_series.reset(self._generation_names(**kwargs),parameter)
+
+    def _model_catchment_generation_apply_function(self,parameter,functions,**kwargs):
+        missing = [f for f in _stringToList(functions) if f not in self.functions]
+        if len(missing):
+            raise Exception('No function: %s'%missing[0])
+
+    # Runoff models and functions
+
+    def _runoff_names(self,**kwargs):
+        return self._element_names(GENERATION_KEYS[:2],kwargs)
+
+    def _model_catchment_runoff_enumerate_names(self,**kwargs):
+        return self._runoff_names(**kwargs)
+
+    def _model_catchment_runoff_get_param_values(self,parameter,**kwargs):
+        return [0.0]*len(self._runoff_names(**kwargs))
+
+    def _model_catchment_runoff_set_param_values(self,parameter,values,**kwargs):
+        pass
+
+    def _model_catchment_runoff_create_modelled_variable(self,parameter,**kwargs):
+        prefix = '$'+parameter.replace(' ','_').replace('-','_')
+        for sc,fu in self._runoff_names(**kwargs):
+            self.variable_names[('%s_%s_%s'%(prefix,sc,fu)).replace('#','').replace(' ','_')] = None
+
+    def variables(self):
+        return self._request('variables',lambda: FakeVariables(list(self.variable_names)))
+
+    def _model_functions_delete_variables(self,names):
+        for name in _stringToList(names):
+            self.variable_names.pop(name,None)
+
+    def _model_functions_set_modelled_variable_time_period(self,period,variables):
+        pass
+
+    def _model_functions_delete_functions(self,names):
+        for name in _stringToList(names):
+            self.functions.pop(name,None)
+
+    def _model_functions_create_functions(self,names,template,arguments,use_format=False):
+        for name,args in zip(_stringToList(names),arguments):
+            self.functions['$'+name.lstrip('$')] = args
+
+    def _model_functions_set_options(self,option,value,functions=None):
+        pass
+
+    def _model_functions_set_time_of_evaluation(self,time_of_evaluation,functions=None):
+        pass
+
+    # Data sources
+
+    def data_sources(self):
+        return self._request('data_sources',lambda: [{'Name':name,'Items':[{'Details':[{'Name':c} for c in columns]}]}
+                                                     for name,columns in self.data_source_columns.items()])
+
+    def create_data_source(self,name,data,units='mm/day',**kwargs):
+        def create():
+            self.data_source_columns[name] = [str(c) for c in data.columns]
+        return self._request('create_data_source',create)
+
+    # Recording and results
+
+    def configure_recording(self,enable=[],disable=[]):
+        def configure():
+            self.recorders += list(enable)
+        return self._request('configure_recording',configure)
+
+    def _run_results(self):
+        version, values = self._structure()
+        version += (len(self.recorders),)
+        if self._results[0] != version:
+            self._results = (version,self._list_results(),values)
+        return list(self._results[1])
+
+    def _list_results(self):
+        variables = [r['RecordingVariable'] for r in self.recorders]
+        results = []
+        if 'LinkStore' in variables:
+            variables = [v for v in variables if v != 'LinkStore']
+            for link in self.links:
+                for con in self.constituents:
+                    results.append({'NetworkElement':link,'RecordingVariable':'Constituents@%s@LinkStore'%con})
+        for sc in self.catchments:
+            for fu in self.fus:
+                for con in self.constituents:
+                    for src in self.constituent_sources:
+                        for variable in variables:
+                            rv = 'Constituents@%s@%s@%s@Generation Model@%s'%(con,fu,src,variable)
+                            results.append({'NetworkElement':sc,'FunctionalUnit':fu,'RecordingVariable':rv})
+                        for flux in ['Quick Flow Load Out','Slow Flow Load Out']:
+                            rv = 'Constituents@%s@%s@%s@%s'%(con,fu,src,flux)
+                            results.append({'NetworkElement':sc,'FunctionalUnit':fu,'RecordingVariable':rv})
+        return results
+
+    def run_model(self,params={},start=None,end=None,**kwargs):
+        def run():
+            self.run_number += 1
+            date_run = pd.Timestamp('2000-01-01') + pd.Timedelta(seconds=self.run_number-1)
+            self.run_date = date_run.strftime('%d/%m/%Y %H:%M:%S')
+            self.runs.append(dict(self.parameters))
+            return (302,'/runs/%d'%self.run_number)
+        return self._request('run_model',run)
+
+    def retrieve_run(self,run='latest'):
+        return self._request('retrieve_run',lambda: {'Number':self.run_number,'DateRun':self.run_date,
+                                                     'Results':self._run_results()})
+
+    def retrieve_multiple_time_series(self,run='latest',run_data=None,criteria={},timestep='daily',name_fn=None):
+        if run_data is None:
+            run_data = self.retrieve_run(run)
+        matched = [r for r in run_data['Results']
+                   if all(_search(pattern,r.get(k,'')) for k,pattern in criteria.items())]
+        self._count('retrieve_multiple_time_series',len(matched))
+        names = [name_fn(r) if name_fn else r['RecordingVariable'] for r in matched]
+        return pd.DataFrame(self._series_values(run_data.get('DateRun',''),matched),index=self.dates,columns=names)
+
+    def _series_values(self,date_run,results):
+        '''
+        Values (time x series) for the given results of a run, determined by the run and each series
+        '''
+        keys = ['%s|%s|%s|%s'%(date_run,r.get('NetworkElement',''),r.get('FunctionalUnit',''),r['RecordingVariable'])
+                for r in results]
+        phase = np.array([zlib.crc32(k.encode('utf-8')) for k in keys],dtype='f8')/2**32
+        steps = np.arange(1,len(self.dates)+1,dtype='f8')
+        return np.abs(np.sin(np.outer(steps,1.0+10.0*phase) + 2*np.pi*phase))
@@ -0,0 +1,134 @@
+'''
+Benchmark CloeSetup and CloeScenario against FakeVeneer, using synthetic models.
+
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000 --latency 0.001 --output results.csv
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000 --latency 0.001 --baseline results.csv
+
+For each size (number of subcatchments), reports the wall time, number of Veneer
+requests and peak Python memory (tracemalloc) of each CloeSetup.apply stage and
+each CloeScenario retrieval.
+
+With --baseline, results are compared with an earlier output file. The exit status
+is 1 if any stage makes more requests than before or is slower by more than
+--tolerance (a ratio). Stages taking less than --min-time seconds are not
+checked for time regressions.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cloe_setup import CloeSetup, CloeScenario
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+SETUP_STAGES=[
+    'load_inputs',
+    'create_constituents',
+    'create_constituent_sources',
+    'install_models',
+    'apply_parameters',
+    'create_data_sources',
+    'connect_time_series',
+    'setup_functions'
+]
+
+RETRIEVALS={
+    'retrieve_model_var_by_fu':lambda scenario,run_data,output: scenario.retrieve_model_var_by_fu('SoilStore','TP',run_data=run_data),
+    'retrieve_fu_flux':lambda scenario,run_data,output: scenario.retrieve_fu_flux('Quick Flow Load Out','TP',run_data=run_data),
+    'stream_model_var_by_fu':lambda scenario,run_data,output: scenario.stream_model_var_by_fu('SoilStore',output,'TP',run_data=run_data)
+}
+
+KEYS=['size','stage']
+
+def measure(v,fn):
+    '''
+    Wall time, number of requests and peak memory allocated while calling fn
+    '''
+    v.reset_counts()
+    tracemalloc.reset_peak()
+    baseline,_ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    _,peak = tracemalloc.get_traced_memory()
+    return {
+        'wall_time':elapsed,
+        'requests':v.requests,
+        'peak_memory_mb':(peak-baseline)/1e6
+    }
+
+def benchmark(n_catchments,directory,latency=0.0,days=365,batch_time_series=False,workers=None):
+    '''
+    Benchmark the setup stages and retrievals for a synthetic model of n_catchments
+    '''
+    config_fn, network_df, fus = generate(os.path.join(directory,str(n_catchments)),n_catchments,days=days)
+    dates = pd.date_range('2000-01-01',periods=days)
+    v = FakeVeneer(network_df,fus,latency,dates)
+    rows = []
+    def record(stage,fn):
+        result = measure(v,fn)
+        rows.append(dict(size=n_catchments,stage=stage,**result))
+        print('%6d %-30s %8.3fs %8d requests %10.1fMB'%(n_catchments,stage,result['wall_time'],result['requests'],result['peak_memory_mb']))
+
+    setup = CloeSetup(config_fn,v,batch_time_series=batch_time_series)
+    for stage in SETUP_STAGES:
+        record(stage,getattr(setup,stage))
+    if workers:
+        record('apply (%d workers)'%workers,lambda: setup.apply(workers=workers))
+
+    scenario = CloeScenario(v)
+    scenario.record_stores()
+    run_data = v.retrieve_run()
+    output = os.path.join(directory,str(n_catchments),'stream')
+    for name,retrieval in RETRIEVALS.items():
+        record(name,lambda: retrieval(scenario,run_data,output))
+    return pd.DataFrame(rows)
+
+def compare(results,baseline,tolerance,min_time=0.01):
+    '''
+    Join results with baseline results, flagging regressions in requests or wall time
+    '''
+    joined = results.merge(baseline,on=KEYS,suffixes=('','_baseline'))
+    joined['time_ratio'] = joined['wall_time'] / joined['wall_time_baseline']
+    slower = (joined['time_ratio'] > tolerance) & (joined['wall_time'] > min_time)
+    joined['regression'] = (joined['requests'] > joined['requests_baseline']) | slower
+    return joined
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark CloeSetup and CloeScenario against a stand-in Veneer')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[10,100,1000],help='Number of subcatchments')
+    parser.add_argument('--latency',type=float,default=0.0,help='Seconds added to each request')
+    parser.add_argument('--days',type=int,default=365,help='Length of input and result time series')
+    parser.add_argument('--batch',action='store_true',help='Use batch time series assignment')
+    parser.add_argument('--workers',type=int,default=None,help='Also benchmark a concurrent apply with this many workers')
+    parser.add_argument('--dir',default=None,help='Directory for synthetic inputs (default: temporary)')
+    parser.add_argument('--output',default=None,help='CSV file for results')
+    parser.add_argument('--baseline',default=None,help='CSV file of earlier results to compare against')
+    parser.add_argument('--tolerance',type=float,default=1.5,help='Wall time ratio regarded as a regression')
+    parser.add_argument('--min-time',type=float,default=0.01,help='Minimum wall time (s) checked for time regressions')
+    args = parser.parse_args(argv)
+
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.dir or tmp
+        results = pd.concat([benchmark(n,directory,args.latency,args.days,args.batch,args.workers) for n in args.sizes],
+                            ignore_index=True)
+    tracemalloc.stop()
+
+    if args.output:
+        results.to_csv(args.output,index=False)
+    if args.baseline is None:
+        return 0
+
+    joined = compare(results,pd.read_csv(args.baseline),args.tolerance,args.min_time)
+    print(joined[KEYS+['wall_time','wall_time_baseline','time_ratio','requests','requests_baseline','regression']].to_string(index=False))
+    return 1 if joined['regression'].any() else 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+'''
+Synthetic catchments, inputs and CloeSetup configurations for benchmarking.
+
+    config_fn, network_df, fus = generate('bench/100',100)
+
+Creates a network of n_catchments subcatchments (a random tree of links), with
+FUS in every catchment, along with the input files and configuration used by
+CloeSetup:
+
+* hillslope.csv: daily input rate for each catchment/FU, one column each,
+* fertiliser.csv and septic.csv: daily, constituent specific (P and N), in long
+  format with one row per date, catchment and FU,
+* attributes.csv: catchment attributes used for spatial parameters and runoff
+  functions.
+'''
+import json
+import os
+import numpy as np
+import pandas as pd
+
+FUS=['Grazing','Cropping','Forestry','Urban','Conservation']
+
+def catchment_name(ix):
+    return 'SC #%d'%ix
+
+def input_name(ix):
+    return 'SC#%d'%ix
+
+def network(n_catchments,seed=0):
+    '''
+    Network as per network().as_dataframe() in Veneer: a random tree with one link (and
+    catchment) per node, draining to a single outlet node
+    '''
+    rng = np.random.default_rng(seed)
+    downstream = [-1] + [int(rng.integers(0,ix)) for ix in range(1,n_catchments)]
+    rows = [{'feature_type':'node','id':'/network/nodes/outlet','name':'Outlet'}]
+    for ix in range(n_catchments):
+        rows.append({'feature_type':'node','id':'/network/nodes/%d'%ix,'name':'Node %d'%ix})
+    for ix,ds in enumerate(downstream):
+        to_node = '/network/nodes/outlet' if ds < 0 else '/network/nodes/%d'%ds
+        rows.append({'feature_type':'link','id':'/network/link/%d'%ix,'name':'Link %d'%ix,
+                     'from_node':'/network/nodes/%d'%ix,'to_node':to_node})
+        rows.append({'feature_type':'catchment','id':'/network/catchments/%d'%ix,'name':catchment_name(ix),
+                     'link':'/network/link/%d'%ix})
+    return pd.DataFrame(rows)
+
+def config(directory,fus):
+    return {
+        'sources':{
+            'areal':['Hillslope','Fertiliser'],
+            'non_areal':['Septic','Gully'],
+            'constituents':{
+                'TP':{},
+                'TN':{'exclude':['Gully']}
+            }
+        },
+        'inputs':{
+            'dir':directory,
+            'ignore':[],
+            'upload_manifest':False,
+            'column_formats':{
+                'hillslope':'SC#${scix}:${fu}'
+            },
+            'columns':{
+                'TP':{'fertiliser':'P','septic':'P'},
+                'TN':{'fertiliser':'N','septic':'N'}
+            },
+            'source':{
+                'Hillslope':'hillslope',
+                'Fertiliser':'fertiliser',
+                'Septic':'septic'
+            },
+            'constrained':{
+                'Gully':{
+                    'datasource':'TP:fertiliser',
+                    'column_format':'SC#${scix}:${fu}',
+                    'constrain':{'fus':fus[0]}
+                }
+            }
+        },
+        'parameters':{
+            'fixed':{'M':1.0,'E':1.0,'Alpha':1.0,'TimingFactor':1.0,'B1':0.5},
+            'losses':{'fixed':{'surf':0.1,'out':0.05},'dynamic':['gw']},
+            'scalar':[{'match':{'fus':fus[0]},'parameters':{'B2':0.2}}],
+            'spatial':[
+                {'input':'attributes','param':'Distance','match':{'catchments':'name'},'value':'distance'},
+                {'input':'attributes','param':'Geology','match':{'catchments':'name'},'value':'geology'}
+            ]
+        },
+        'runoff_functions':[
+            {
+                'function_name':'drainage',
+                'param':'Drainage',
+                'template':'{Quick_Flow}*{dist}',
+                'model_variables':['Quick Flow'],
+                'data_variables':[
+                    {'input':'attributes','match':{'catchments':'name'},'value':'distance','label':'dist'}
+                ]
+            }
+        ]
+    }
+
+def _long_input(dates,catchments,fus,rng):
+    n = len(dates)*len(catchments)*len(fus)
+    return pd.DataFrame({
+        'Date':np.repeat(dates.strftime('%d/%m/%Y'),len(catchments)*len(fus)),
+        'cmt':np.tile(np.repeat([input_name(ix) for ix in catchments],len(fus)),len(dates)),
+        'FU':np.tile(fus,len(dates)*len(catchments)),
+        'P':rng.random(n),
+        'N':rng.random(n)
+    })
+
+def generate(directory,n_catchments,fus=FUS,days=365,point_source_fraction=0.1,seed=0):
+    '''
+    Write inputs and configuration for n_catchments to directory.
+
+    Returns the configuration filename, the network (as a DataFrame) and the FUs.
+    '''
+    os.makedirs(directory,exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2000-01-01',periods=days)
+    catchments = list(range(n_catchments))
+
+    hillslope = pd.DataFrame(rng.random((days,n_catchments*len(fus))),
+                             columns=['%s:%s'%(input_name(ix),fu) for ix in catchments for fu in fus])
+    hillslope.insert(0,'Date',dates.strftime('%d/%m/%Y'))
+    hillslope.to_csv(os.path.join(directory,'hillslope.csv'),index=False)
+
+    _long_input(dates,catchments,fus,rng).to_csv(os.path.join(directory,'fertiliser.csv'),index=False)
+
+    n_point = max(1,int(n_catchments*point_source_fraction))
+    point_catchments = sorted(rng.choice(n_catchments,n_point,replace=False).tolist())
+    _long_input(dates,point_catchments,fus,rng).to_csv(os.path.join(directory,'septic.csv'),index=False)
+
+    pd.DataFrame({
+        'name':[catchment_name(ix) for ix in catchments],
+        'distance':rng.random(n_catchments)*100.0,
+        'geology':rng.integers(1,5,n_catchments)
+    }).to_csv(os.path.join(directory,'attributes.csv'),index=False)
+
+    config_fn = os.path.join(directory,'config.json')
+    with open(config_fn,'w') as fp:
+        json.dump(config(directory,fus),fp,indent=2)
+    return config_fn, network(n_catchments,seed), fus
@@ -0,0 +1,487 @@
+'''
+On-disk caches used by CloeSetup and CloeScenario.
+
+InputCache holds parsed (and transformed) input files in Parquet format, so that
+repeated setups don't re-parse unchanged CSV files. Parquet support in pandas
+requires pyarrow (or fastparquet).
+
+HashManifest records the content hash of data sources uploaded to Source, so that
+unchanged data sources aren't uploaded again.
+
+ResultCache holds time series retrieved from model runs, keyed by run and
+recording criteria, in uncompressed Arrow IPC (Feather) files that are read
+memory mapped. This also requires pyarrow.
+
+ScenarioStore collects the results of many scenario runs (eg from
+cloe_scheduler) in Parquet files, indexed by scenario and result name.
+'''
+import hashlib
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+CHUNK_SIZE=1<<20
+
+def file_hash(fn):
+    h = hashlib.sha1()
+    with open(fn,'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def frame_hash(df,*extra):
+    '''
+    Content hash of a DataFrame (values, index and column names) and any extra values (eg units)
+    '''
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(df,index=True).values.tobytes())
+    h.update(repr([str(c) for c in df.columns] + list(extra)).encode('utf-8'))
+    return h.hexdigest()
+
+class HashManifest(object):
+    '''
+    JSON file of name -> content hash of the items (eg data sources) last written under that name
+    '''
+    def __init__(self,fn):
+        self.fn = fn
+        self.hashes = {}
+        if os.path.exists(fn):
+            with open(fn,'r') as fp:
+                self.hashes = json.load(fp)
+
+    def get(self,name):
+        return self.hashes.get(name,None)
+
+    def set(self,name,content_hash):
+        self.hashes[name] = content_hash
+
+    def discard(self,names):
+        for name in names:
+            self.hashes.pop(name,None)
+
+    def save(self):
+        with open(self.fn,'w') as fp:
+            json.dump(self.hashes,fp)
+
+class InputCache(object):
+    '''
+    Cache of parsed input files, keyed by input name and file path.
+
+    An entry is valid if it was written in the current format (version) and the file's
+    size and modification time match those recorded. If only the modification time
+    differs, the content hash is compared before the entry is discarded.
+
+    version: format of the cached DataFrames. Change it whenever the parsing or
+             transformation of inputs changes, so that entries written before are not used
+    '''
+    def __init__(self,directory,version=None):
+        self.directory = directory
+        self.version = version
+        os.makedirs(directory,exist_ok=True)
+
+    def _paths(self,name,fn):
+        key = hashlib.sha1(('%s|%s'%(name,os.path.abspath(fn))).encode('utf-8')).hexdigest()[:20]
+        base = os.path.join(self.directory,'%s_%s'%(name,key))
+        return base + '.parquet', base + '.json'
+
+    def _read_metadata(self,meta_fn):
+        if not os.path.exists(meta_fn):
+            return None
+        with open(meta_fn,'r') as fp:
+            return json.load(fp)
+
+    def _write_metadata(self,meta_fn,metadata):
+        with open(meta_fn,'w') as fp:
+            json.dump(metadata,fp)
+
+    def get(self,name,fn):
+        '''
+        Return the cached DataFrame for input name (from file fn), or None if not cached
+        or out of date.
+        '''
+        data_fn, meta_fn = self._paths(name,fn)
+        metadata = self._read_metadata(meta_fn)
+        if metadata is None or not os.path.exists(data_fn):
+            return None
+        if metadata.get('version',None) != self.version:
+            return None
+        stat = os.stat(fn)
+        if metadata['size'] != stat.st_size:
+            return None
+        if metadata['mtime'] != stat.st_mtime_ns:
+            if metadata['hash'] != file_hash(fn):
+                return None
+            metadata['mtime'] = stat.st_mtime_ns
+            self._write_metadata(meta_fn,metadata)
+        return pd.read_parquet(data_fn)
+
+    def put(self,name,fn,df):
+        data_fn, meta_fn = self._paths(name,fn)
+        stat = os.stat(fn)
+        df.to_parquet(data_fn)
+        self._write_metadata(meta_fn,{
+            'name':name,
+            'version':self.version,
+            'path':os.path.abspath(fn),
+            'size':stat.st_size,
+            'mtime':stat.st_mtime_ns,
+            'hash':file_hash(fn)
+        })
+
+class ChunkStore(object):
+    '''
+    Columnar on-disk store of a wide (time x column) table, written in parts.
+
+    Each appended chunk is written to its own Parquet file, with the columns of each
+    part recorded in a manifest. Parts may share columns (eg partial sums from
+    different chunks), in which case they are summed when read.
+    '''
+    MANIFEST='manifest.json'
+
+    def __init__(self,directory):
+        self.directory = directory
+        os.makedirs(directory,exist_ok=True)
+        self._manifest_fn = os.path.join(directory,self.MANIFEST)
+        if os.path.exists(self._manifest_fn):
+            with open(self._manifest_fn,'r') as fp:
+                self.manifest = json.load(fp)
+        else:
+            self.manifest = {'parts':[]}
+
+    def _save_manifest(self):
+        with open(self._manifest_fn,'w') as fp:
+            json.dump(self.manifest,fp)
+
+    def clear(self):
+        for part in self.manifest['parts']:
+            os.remove(os.path.join(self.directory,part['file']))
+        self.manifest = {'parts':[]}
+        self._save_manifest()
+
+    def append(self,df):
+        if not len(df.columns):
+            return
+        fn = 'part-%05d.parquet'%len(self.manifest['parts'])
+        df.to_parquet(os.path.join(self.directory,fn))
+        self.manifest['parts'].append({'file':fn,'columns':[str(c) for c in df.columns]})
+        self._save_manifest()
+
+    def columns(self):
+        return list(dict.fromkeys(c for part in self.manifest['parts'] for c in part['columns']))
+
+    def read(self,columns=None):
+        '''
+        Read the table (or a subset of columns), reading only the parts that hold them.
+        '''
+        wanted = None if columns is None else set(columns)
+        frames = []
+        for part in self.manifest['parts']:
+            part_columns = part['columns'] if wanted is None else [c for c in part['columns'] if c in wanted]
+            if not len(part_columns):
+                continue
+            frames.append(pd.read_parquet(os.path.join(self.directory,part['file']),columns=part_columns))
+        if not len(frames):
+            return pd.DataFrame()
+        result = pd.concat(frames,axis=1)
+        if result.columns.has_duplicates:
+            result = result.T.groupby(level=0,sort=False).sum(min_count=1).T
+        if columns is not None:
+            result = result[[c for c in columns if c in result.columns]]
+        return result
+
+class FileLock(object):
+    '''
+    Exclusive lock on a file, held across processes (eg sessions sharing a cache)
+    '''
+    def __init__(self,fn):
+        self.fn = fn
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self.fn,'a+')
+        if os.name == 'nt':
+            import msvcrt
+            self._fp.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._fp.fileno(),msvcrt.LK_LOCK,1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    continue
+        else:
+            import fcntl
+            fcntl.flock(self._fp.fileno(),fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self,*args):
+        if os.name == 'nt':
+            import msvcrt
+            self._fp.seek(0)
+            msvcrt.locking(self._fp.fileno(),msvcrt.LK_UNLCK,1)
+        else:
+            import fcntl
+            fcntl.flock(self._fp.fileno(),fcntl.LOCK_UN)
+        self._fp.close()
+        self._fp = None
+
+class ResultCache(object):
+    '''
+    Size bounded cache of retrieved time series tables (time x column), keyed by run
+    and recording criteria.
+
+    Each table is a Feather file, read memory mapped so that only the columns requested
+    are read. Columns are stored by position, with their names (which needn't be unique)
+    in the file's metadata. An index records the run, size and last use of each entry.
+    When the total size exceeds max_bytes, the least recently used entries are removed.
+
+    The cache can be shared by several sessions: the index is re-read, and this
+    session's changes merged in, under a file lock each time it is saved. The index
+    is saved when entries are added or removed, along with the last use of the
+    entries read since.
+    '''
+    INDEX='index.json'
+    INDEX_COLUMN='__index__'
+
+    def __init__(self,directory,max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory,exist_ok=True)
+        self._index_fn = os.path.join(directory,self.INDEX)
+        self._lock = threading.Lock()
+        self._added = set()
+        self._used = set()
+        self._removed = set()
+        self.entries = self._read_index()
+
+    def _read_index(self):
+        if not os.path.exists(self._index_fn):
+            return {}
+        with open(self._index_fn,'r') as fp:
+            return json.load(fp)
+
+    def _save_index(self,keep=None):
+        '''
+        Merge the entries added, used and removed by this session into the index on disk,
+        evict entries if needed and save the result
+        '''
+        with FileLock(self._index_fn + '.lock'):
+            entries = self._read_index()
+            for key in self._removed:
+                entries.pop(key,None)
+            for key in self._added:
+                entries[key] = self.entries[key]
+            # Entries removed by another session stay removed
+            for key in self._used:
+                if key in entries:
+                    entries[key]['last_used'] = max(entries[key]['last_used'],self.entries[key]['last_used'])
+            self.entries = entries
+            self._evict(keep)
+            tmp_fn = self._index_fn + '.tmp'
+            with open(tmp_fn,'w') as fp:
+                json.dump(self.entries,fp)
+            os.replace(tmp_fn,self._index_fn)
+            self._added = set()
+            self._used = set()
+            self._removed = set()
+
+    def _refresh(self):
+        '''
+        Add the entries written by other sessions since the index was read
+        '''
+        self.entries.update({k:e for k,e in self._read_index().items()
+                             if k not in self.entries and k not in self._removed})
+
+    def _entry(self,key):
+        if key not in self.entries:
+            self._refresh()
+        return self.entries.get(key)
+
+    def _key(self,run,criteria):
+        return hashlib.sha1(json.dumps([str(run),sorted(criteria.items())]).encode('utf-8')).hexdigest()
+
+    def contains(self,run,criteria):
+        with self._lock:
+            entry = self._entry(self._key(run,criteria))
+        return entry is not None and os.path.exists(os.path.join(self.directory,entry['file']))
+
+    def size(self):
+        return sum(e['bytes'] for e in self.entries.values())
+
+    def get(self,run,criteria,columns=None):
+        '''
+        Return the cached table for run and criteria (or a subset of its columns), or None
+        if not cached.
+        '''
+        import pyarrow as pa
+        key = self._key(run,criteria)
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return None
+            entry['last_used'] = time.time()
+            self._used.add(key)
+        fn = os.path.join(self.directory,entry['file'])
+        if not os.path.exists(fn):
+            return None
+        with pa.memory_map(fn,'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        metadata = table.schema.metadata
+        names = json.loads(metadata[b'columns'])
+        positions = range(len(names))
+        if columns is not None:
+            wanted = {str(c) for c in columns}
+            positions = [i for i,n in enumerate(names) if n in wanted]
+        index = table.column(self.INDEX_COLUMN).to_pandas()
+        result = pd.DataFrame({i:table.column(str(i)).to_numpy() for i in positions},index=pd.Index(index))
+        result.columns = [names[i] for i in positions]
+        result.index.name = json.loads(metadata[b'index_name'])
+        return result
+
+    def put(self,run,criteria,df):
+        import pyarrow as pa
+        from pyarrow import feather
+        key = self._key(run,criteria)
+        fn = key + '.feather'
+        tmp_fn = os.path.join(self.directory,fn + '.tmp')
+        arrays = [pa.array(df.index)] + [pa.array(df.iloc[:,i].values) for i in range(len(df.columns))]
+        names = [self.INDEX_COLUMN] + [str(i) for i in range(len(df.columns))]
+        table = pa.Table.from_arrays(arrays,names=names).replace_schema_metadata({
+            'columns':json.dumps([str(c) for c in df.columns]),
+            'index_name':json.dumps(df.index.name)
+        })
+        feather.write_feather(table,tmp_fn,compression='uncompressed')
+        os.replace(tmp_fn,os.path.join(self.directory,fn))
+        with self._lock:
+            self.entries[key] = {
+                'file':fn,
+                'run':str(run),
+                'criteria':criteria,
+                'bytes':os.path.getsize(os.path.join(self.directory,fn)),
+                'last_used':time.time()
+            }
+            self._added.add(key)
+            self._removed.discard(key)
+            self._save_index(keep=key)
+
+    def _evict(self,keep=None):
+        if self.max_bytes is None:
+            return
+        total = self.size()
+        for key in sorted(self.entries,key=lambda k: self.entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._remove(key)
+
+    def _remove(self,key):
+        entry = self.entries.pop(key)
+        self._removed.add(key)
+        self._added.discard(key)
+        fn = os.path.join(self.directory,entry['file'])
+        if os.path.exists(fn):
+            os.remove(fn)
+        return entry['bytes']
+
+    def discard_run(self,run):
+        with self._lock:
+            self._refresh()
+            for key in [k for k,e in self.entries.items() if e['run']==str(run)]:
+                self._remove(key)
+            self._save_index()
+
+    def clear(self):
+        '''
+        Remove every entry, along with any files not in the index (eg left by a session
+        that stopped part way through writing an entry)
+        '''
+        with self._lock:
+            self._refresh()
+            for key in list(self.entries):
+                self._remove(key)
+            self._save_index()
+            for fn in os.listdir(self.directory):
+                if fn.endswith('.feather') or fn.endswith('.feather.tmp'):
+                    os.remove(os.path.join(self.directory,fn))
+
+class ScenarioStore(object):
+    '''
+    On-disk store of the results of scenario runs, indexed by scenario and result name.
+
+    Each result (a time x column table) is written to its own Parquet file. The manifest
+    records, for each scenario, its status, details of the run (eg endpoint, attempts,
+    duration) and the file of each result.
+    '''
+    MANIFEST='manifest.json'
+
+    def __init__(self,directory):
+        self.directory = directory
+        os.makedirs(directory,exist_ok=True)
+        self._manifest_fn = os.path.join(directory,self.MANIFEST)
+        self._lock = threading.Lock()
+        self.scenarios = {}
+        if os.path.exists(self._manifest_fn):
+            with open(self._manifest_fn,'r') as fp:
+                self.scenarios = json.load(fp)
+
+    def _save_manifest(self):
+        tmp_fn = self._manifest_fn + '.tmp'
+        with open(tmp_fn,'w') as fp:
+            json.dump(self.scenarios,fp)
+        os.replace(tmp_fn,self._manifest_fn)
+
+    def _fn(self,scenario,name):
+        key = hashlib.sha1(('%s|%s'%(scenario,name)).encode('utf-8')).hexdigest()[:20]
+        return '%s.parquet'%key
+
+    def put(self,scenario,results,**details):
+        '''
+        Store the results (dictionary of name -> DataFrame) of a scenario, marking it complete
+        '''
+        files = {}
+        for name,df in results.items():
+            fn = self._fn(scenario,name)
+            table = df.copy(deep=False)
+            table.columns = [str(c) for c in table.columns]
+            table.to_parquet(os.path.join(self.directory,fn))
+            files[name] = fn
+        with self._lock:
+            self.scenarios[scenario] = dict(details,status='complete',results=files)
+            self._save_manifest()
+
+    def fail(self,scenario,**details):
+        with self._lock:
+            self.scenarios[scenario] = dict(details,status='failed',results={})
+            self._save_manifest()
+
+    def completed(self):
+        return {s for s,entry in self.scenarios.items() if entry['status']=='complete'}
+
+    def names(self):
+        return list(dict.fromkeys(n for entry in self.scenarios.values() for n in entry['results']))
+
+    def get(self,scenario,name):
+        fn = self.scenarios[scenario]['results'][name]
+        return pd.read_parquet(os.path.join(self.directory,fn))
+
+    def read(self,name,scenarios=None):
+        '''
+        Read one result for each of scenarios (default: all complete scenarios), as a DataFrame
+        with columns indexed by (scenario, column)
+        '''
+        if scenarios is None:
+            scenarios = [s for s,entry in self.scenarios.items() if name in entry['results']]
+        frames = {s:self.get(s,name) for s in scenarios}
+        if not len(frames):
+            return pd.DataFrame()
+        return pd.concat(frames,axis=1,names=['scenario','column'])
+
+    def status(self):
+        '''
+        Status and run details of each scenario, as a DataFrame
+        '''
+        rows = {s:{k:v for k,v in entry.items() if k != 'results'} for s,entry in self.scenarios.items()}
+        return pd.DataFrame.from_dict(rows,orient='index')
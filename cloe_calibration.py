@@ -0,0 +1,246 @@
+'''
+Parallel Monte Carlo sampling and calibration of CLOE parameters using CloeEngine.
+
+Parameter ranges are described in the same terms as the parameters section of
+a CloeSetup configuration, ie a parameter name with optional constraints:
+
+    ranges = [
+        {'param':'B1','min':0.0,'max':2.0},
+        {'param':'Dsurf','min':0.0,'max':0.5,'constrain':{'fus':'Grazing'},'label':'Dsurf_grazing'},
+        {'param':'Osurf','min':0.0,'max':1.0}
+    ]
+    campaign = CalibrationCampaign(engine,ranges,objective,'campaign.csv')
+    results = campaign.run(5000,workers=16)
+
+The objective is a picklable (ie module level) function, receiving the
+CloeResults of each run and returning either a number or a dictionary of
+numbers.
+
+Forcing data (the data sources of the engine) is placed in shared memory once
+and attached by each worker. Results are appended to the output CSV as each
+sample completes. Re-running the campaign with the same output file resumes it,
+skipping completed samples.
+'''
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from cloe_engine import CloeEngine, FLUXES
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_ID='sample'
+
+def parameter_ranges(ranges):
+    '''
+    Normalise parameter ranges, accepting either a list of dictionaries (param, min,
+    max, constrain and label) or a dictionary of param -> (min,max)
+    '''
+    if isinstance(ranges,dict):
+        ranges = [{'param':p,'min':r[0],'max':r[1]} for p,r in ranges.items()]
+    result = []
+    for r in ranges:
+        r = dict(r)
+        r.setdefault('constrain',{})
+        r.setdefault('label',r['param'])
+        result.append(r)
+    labels = [r['label'] for r in result]
+    if len(set(labels)) != len(labels):
+        raise ValueError('Parameter labels must be unique. Use label to distinguish constrained parameters')
+    return result
+
+def latin_hypercube(n,ranges,seed=0):
+    rng = np.random.default_rng(seed)
+    result = {}
+    for r in ranges:
+        strata = (rng.permutation(n) + rng.random(n)) / n
+        result[r['label']] = r['min'] + strata * (r['max'] - r['min'])
+    return pd.DataFrame(result,index=pd.RangeIndex(n,name=SAMPLE_ID))
+
+def uniform(n,ranges,seed=0):
+    rng = np.random.default_rng(seed)
+    result = {r['label']:rng.uniform(r['min'],r['max'],n) for r in ranges}
+    return pd.DataFrame(result,index=pd.RangeIndex(n,name=SAMPLE_ID))
+
+SAMPLERS = {
+    'lhs':latin_hypercube,
+    'uniform':uniform
+}
+
+def _share_data_sources(engine,dates):
+    '''
+    Copy each data source, aligned to dates, into shared memory.
+
+    Returns the shared memory blocks and a description of each data source
+    for attaching in other processes.
+    '''
+    blocks = []
+    descriptions = {}
+    for name,df in engine.data_sources.items():
+        data = np.asarray(df.reindex(dates).values,dtype='f8')
+        block = shared_memory.SharedMemory(create=True,size=max(1,data.nbytes))
+        np.ndarray(data.shape,dtype='f8',buffer=block.buf)[...] = data
+        blocks.append(block)
+        descriptions[name] = (block.name,data.shape,list(df.columns))
+    return blocks, descriptions
+
+def _attach_data_sources(descriptions,dates):
+    blocks = []
+    data_sources = {}
+    for name,(block_name,shape,columns) in descriptions.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        data = np.ndarray(shape,dtype='f8',buffer=block.buf)
+        blocks.append(block)
+        data_sources[name] = pd.DataFrame(data,index=dates,columns=columns,copy=False)
+    return blocks, data_sources
+
+_worker = {}
+
+def _init_worker(elements,parameters,time_series,descriptions,dates):
+    engine = CloeEngine(elements)
+    engine.parameters = parameters
+    engine.time_series = time_series
+    blocks, engine.data_sources = _attach_data_sources(descriptions,dates)
+    _worker['engine'] = engine
+    _worker['blocks'] = blocks # Keep shared memory attached for the life of the worker
+    _worker['dates'] = dates
+
+def evaluate(engine,ranges,sample,objective,dates=None,record=FLUXES,timestep=86400.0):
+    '''
+    Run the engine with the parameter values of one sample and evaluate the objective.
+
+    Parameters modified for the sample are restored afterwards.
+    '''
+    original = {}
+    try:
+        for r in ranges:
+            param = r['param']
+            if param not in original:
+                original[param] = engine.parameters[param].copy() if param in engine.parameters else None
+            engine.set_param_values(param,sample[r['label']],**r['constrain'])
+        results = engine.run(dates=dates,timestep=timestep,record=record)
+    finally:
+        for param,values in original.items():
+            if values is None:
+                engine.parameters.pop(param,None)
+            else:
+                engine.parameters[param] = values
+    score = objective(results)
+    if not isinstance(score,dict):
+        score = {'objective':score}
+    return score
+
+def _evaluate_in_worker(ranges,sample_id,sample,objective,record,timestep):
+    engine = _worker['engine']
+    return sample_id, evaluate(engine,ranges,sample,objective,_worker['dates'],record,timestep)
+
+class CalibrationCampaign(object):
+    '''
+    Evaluate an objective function over samples of CLOE parameters.
+
+    engine: CloeEngine, with base parameters and time series applied (eg CloeEngine.from_setup)
+    ranges: parameter ranges (see parameter_ranges)
+    objective: function of CloeResults returning a number or dictionary of numbers
+    output: CSV filename for results. Samples are saved alongside (.samples.csv), along
+            with the settings used to generate them (.samples.json)
+    record: variables recorded in each run and available to the objective
+    '''
+    def __init__(self,engine,ranges,objective,output,record=FLUXES,dates=None,timestep=86400.0):
+        self.engine = engine
+        self.ranges = parameter_ranges(ranges)
+        self.objective = objective
+        self.output = output
+        self.record = list(record)
+        self.dates = dates
+        self.timestep = timestep
+
+    @property
+    def samples_fn(self):
+        return os.path.splitext(self.output)[0] + '.samples.csv'
+
+    @property
+    def settings_fn(self):
+        return os.path.splitext(self.output)[0] + '.samples.json'
+
+    def samples(self,n,method='lhs',seed=0):
+        '''
+        Generate n samples, or reload them when resuming a campaign.
+
+        The sampling settings (n, method, seed and ranges) are saved with the samples.
+        Raises ValueError when resuming with different settings: use a new output file.
+        '''
+        settings = json.loads(json.dumps({'n':n,'method':method,'seed':seed,'ranges':self.ranges}))
+        if os.path.exists(self.samples_fn):
+            samples = pd.read_csv(self.samples_fn,index_col=SAMPLE_ID)
+            if os.path.exists(self.settings_fn):
+                with open(self.settings_fn,'r') as fp:
+                    previous = json.load(fp)
+                changed = [k for k in settings if previous.get(k) != settings[k]]
+            else:
+                # Samples saved without settings: check what we can
+                changed = [k for k,same in [('n',len(samples)==n),
+                                            ('ranges',list(samples.columns)==[r['label'] for r in self.ranges])]
+                           if not same]
+            if len(changed):
+                raise ValueError('Samples in %s were generated with different settings (%s). Use a new output file'%(
+                    self.samples_fn,', '.join(changed)))
+            return samples
+        samples = SAMPLERS[method](n,self.ranges,seed)
+        samples.to_csv(self.samples_fn)
+        with open(self.settings_fn,'w') as fp:
+            json.dump(settings,fp)
+        return samples
+
+    def completed(self):
+        if not os.path.exists(self.output):
+            return set()
+        return set(pd.read_csv(self.output,usecols=[SAMPLE_ID])[SAMPLE_ID])
+
+    def results(self):
+        return pd.read_csv(self.output,index_col=SAMPLE_ID)
+
+    def _write(self,sample_id,sample,score):
+        row = pd.DataFrame([dict(sample,**score)],index=pd.Index([sample_id],name=SAMPLE_ID))
+        header = not os.path.exists(self.output)
+        row.to_csv(self.output,mode='a',header=header)
+
+    def run(self,n,workers=None,method='lhs',seed=0):
+        '''
+        Evaluate n samples (skipping those already in the output file), on a process
+        pool of the given number of workers (or in this process if workers is None).
+
+        Returns all results, including those from earlier, interrupted runs.
+        '''
+        samples = self.samples(n,method,seed)
+        done = self.completed()
+        pending = [(ix,row.to_dict()) for ix,row in samples.iterrows() if ix not in done]
+        logger.info(f'Evaluating {len(pending)} of {len(samples)} samples ({len(done)} already complete)')
+
+        dates = self.dates
+        if dates is None:
+            dates = self.engine.default_dates()
+
+        if workers is None or workers <= 1:
+            for sample_id,sample in pending:
+                score = evaluate(self.engine,self.ranges,sample,self.objective,dates,self.record,self.timestep)
+                self._write(sample_id,sample,score)
+            return self.results()
+
+        blocks, descriptions = _share_data_sources(self.engine,dates)
+        try:
+            initargs = (self.engine.elements,self.engine.parameters,self.engine.time_series,descriptions,dates)
+            with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,initargs=initargs) as pool:
+                jobs = {pool.submit(_evaluate_in_worker,self.ranges,sample_id,sample,self.objective,self.record,self.timestep):sample
+                        for sample_id,sample in pending}
+                for job in as_completed(jobs):
+                    sample_id, score = job.result()
+                    self._write(sample_id,jobs[job],score)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return self.results()
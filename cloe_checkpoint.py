@@ -0,0 +1,177 @@
+'''
+Checkpoints of the CLOE stores, for starting runs from a spun-up state.
+
+A checkpoint holds the SoilStore and GroundwaterStore of each generation model
+and the LinkStore of each link at the end of a run. Applying a checkpoint sets
+InitialSoilStore, InitialGroundwaterStore and InitialLinkStore, with one call
+per parameter, so that later runs (eg scenarios covering just the period of
+interest) start from that state:
+
+    scenario = CloeScenario(v)
+    scenario.record_stores()
+    v.run_model(start='01/01/1990',end='31/12/2009') # Spin up
+    checkpoint = Checkpoint.from_run(scenario)
+    checkpoint.save('spun_up.parquet')
+
+    Checkpoint.load('spun_up.parquet').apply(v)
+    v.run_model(start='01/01/2010',end='31/12/2019')
+
+Checkpoints are saved in Parquet format (requires pyarrow or fastparquet).
+CloeEngine and InstreamRouting states can be captured and applied in the same
+way (from_engine, apply_to_engine and apply_to_routing).
+'''
+import json
+import numpy as np
+import pandas as pd
+
+# Initial state parameter for each store
+STATE_PARAMETERS={
+    'SoilStore':'InitialSoilStore',
+    'GroundwaterStore':'InitialGroundwaterStore',
+    'LinkStore':'InitialLinkStore'
+}
+
+# Key of each element: catchment (or link), fu, constituent and source. Links have no fu or source
+KEYS=['element','fu','constituent','source']
+
+def _state_name(rec):
+    '''
+    Name of a recorded store, as a JSON list of the variable and element key
+    '''
+    parts = rec['RecordingVariable'].split('@')
+    variable = parts[-1]
+    if variable == 'LinkStore':
+        key = [rec['NetworkElement'],'',parts[1],'']
+    else:
+        key = [rec['NetworkElement'],rec.get('FunctionalUnit') or '',parts[1],parts[3]]
+    return json.dumps([variable]+key)
+
+class Checkpoint(object):
+    '''
+    States of the CLOE stores.
+
+    states: DataFrame indexed by KEYS, with a column for each store (SoilStore,
+            GroundwaterStore, LinkStore). Missing values are left unchanged when applied
+    '''
+    def __init__(self,states):
+        self.states = states
+
+    @staticmethod
+    def from_run(scenario,run='latest',run_data=None,chunk_size=200):
+        '''
+        Capture the stores at the end of a run, from the recorders enabled by
+        CloeScenario.record_stores.
+
+        scenario: CloeScenario
+        chunk_size: number of network elements retrieved at once
+        '''
+        criteria = {'RecordingVariable':'^Constituents@.*@(%s)$'%'|'.join(STATE_PARAMETERS)}
+        if run_data is None:
+            run_data = scenario._v.retrieve_run(run)
+        final = {}
+        for chunk in scenario._chunk_results(run_data,criteria,chunk_size,'catchment'):
+            table = scenario._v.retrieve_multiple_time_series(run,dict(run_data,Results=chunk),criteria,name_fn=_state_name)
+            scenario.tracer.record(rows=len(table),columns=len(table.columns))
+            final.update(table.ffill().iloc[-1].to_dict())
+        if not len(final):
+            raise ValueError('No stores recorded in run %s. See CloeScenario.record_stores'%run)
+        rows = [json.loads(name) for name in final]
+        states = pd.DataFrame([r[1:] for r in rows],columns=KEYS)
+        states['variable'] = [r[0] for r in rows]
+        states['value'] = list(final.values())
+        return Checkpoint(states.pivot_table(index=KEYS,columns='variable',values='value',aggfunc='last'))
+
+    @staticmethod
+    def from_engine(engine,routings=None):
+        '''
+        Capture the current stores of a CloeEngine and, optionally, of InstreamRouting
+        models (a dictionary of constituent -> InstreamRouting)
+        '''
+        elements = engine.elements
+        index = pd.MultiIndex.from_arrays([elements.catchment,elements.fu,elements.constituent,elements.source],names=KEYS)
+        if engine.soil_store is None:
+            engine.reset()
+        frames = [pd.DataFrame({'SoilStore':engine.soil_store,'GroundwaterStore':engine.groundwater_store},index=index)]
+        for constituent,routing in (routings or {}).items():
+            if routing.link_store is None:
+                routing.reset()
+            names = [routing.link_names[l] for l in routing.link_ids]
+            index = pd.MultiIndex.from_tuples([(n,'',constituent,'') for n in names],names=KEYS)
+            frames.append(pd.DataFrame({'LinkStore':routing.link_store},index=index))
+        return Checkpoint(pd.concat(frames))
+
+    @staticmethod
+    def load(fn):
+        states = pd.read_parquet(fn)
+        return Checkpoint(states.set_index(KEYS))
+
+    def save(self,fn):
+        states = self.states.reset_index()
+        for k in KEYS:
+            states[k] = states[k].astype('category')
+        states.to_parquet(fn)
+
+    def values(self,variable,keys,current=None):
+        '''
+        Values of a store for each element key (in order), falling back to current (a
+        function returning the current values, in the same order) for elements not in
+        the checkpoint. Returns None if the checkpoint has no values for any of the keys.
+        '''
+        if variable not in self.states.columns:
+            return None
+        values = self.states[variable].reindex(pd.MultiIndex.from_tuples(keys,names=KEYS)).values
+        missing = np.isnan(values)
+        if missing.all():
+            return None
+        if missing.any():
+            values = np.where(missing,np.asarray(current(),dtype='f8'),values)
+        return values
+
+    def apply_generation(self,target):
+        '''
+        Set InitialSoilStore and InitialGroundwaterStore of generation models, with one call
+        per parameter.
+
+        target: model.catchment.generation of a Veneer client, or a CloeEngine
+        '''
+        keys = [tuple(n[:4]) for n in target.enumerate_names()]
+        for variable in ['SoilStore','GroundwaterStore']:
+            parameter = STATE_PARAMETERS[variable]
+            values = self.values(variable,keys,lambda: target.get_param_values(parameter))
+            if values is not None:
+                target.set_param_values(parameter,values.tolist(),fromList=True)
+
+    def apply_links(self,target):
+        '''
+        Set InitialLinkStore of instream models, in one call.
+
+        target: model.link.constituents of a Veneer client, enumerating (link, constituent)
+        '''
+        names = target.enumerate_names()
+        if any(len(n) != 2 for n in names):
+            raise ValueError('Expected (link, constituent) names from the instream models, got %s'%(names[0],))
+        keys = [(n[0],'',n[1],'') for n in names]
+        parameter = STATE_PARAMETERS['LinkStore']
+        values = self.values('LinkStore',keys,lambda: target.get_param_values(parameter))
+        if values is not None:
+            target.set_param_values(parameter,values.tolist(),fromList=True)
+
+    def apply(self,v):
+        '''
+        Set the initial states of the generation and instream models through a Veneer client
+        '''
+        self.apply_generation(v.model.catchment.generation)
+        if 'LinkStore' in self.states.columns:
+            self.apply_links(v.model.link.constituents)
+
+    def apply_to_engine(self,engine):
+        self.apply_generation(engine)
+        engine.soil_store = None
+
+    def apply_to_routing(self,routing,constituent):
+        names = [routing.link_names[l] for l in routing.link_ids]
+        keys = [(n,'',constituent,'') for n in names]
+        values = self.values('LinkStore',keys,lambda: routing._parameter('InitialLinkStore'))
+        if values is not None:
+            routing.set_param_values('InitialLinkStore',values,fromList=True)
+        routing.link_store = None
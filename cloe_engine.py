@@ -0,0 +1,634 @@
+'''
+Vectorised reference implementation of the CLOE generation model.
+
+CloeEngine runs the equations of AbstractCLOEFUModel (and the Areal/NonAreal
+subclasses) for every catchment x FU x constituent x constituent source element
+at once, holding the SoilStore and GroundwaterStore states as arrays.
+
+The engine mimics the parts of the Veneer API used by CloeSetup
+(set_param_values, assign_time_series, create_data_source, etc), so a
+configuration can be applied to it directly:
+
+    engine = CloeEngine.from_setup(setup,areas)
+    results = engine.run()
+    soil = results.as_dataframe('SoilStore','TP')
+
+The engine can also propagate forward sensitivities of the stores and fluxes
+to the loss rate parameters (B, M, D and O coefficients) and the generation
+terms, in the same run:
+
+    results = engine.run(sensitivities=['B1','Dsurf'])
+    dload_dB1 = results.catchment_load_sensitivity('TP','B1')
+
+Sensitivities are with respect to the parameter value of each element, so the
+sensitivity to a parameter shared by a group of elements is the sum over the
+group (as catchment_load_sensitivity does for the elements of each catchment).
+'''
+import numpy as np
+import pandas as pd
+
+from veneer.utils import _stringToList
+
+TINY = 1e-8
+
+AREAL='areal'
+NON_AREAL='non_areal'
+
+ELEMENT_KEYS = ['catchment','fu','constituent','source']
+FILTER_KEYS = {
+    'catchments':'catchment',
+    'fus':'fu',
+    'constituents':'constituent',
+    'sources':'source'
+}
+
+# Parameters and inputs of AbstractCLOEFUModel, with their defaults
+DEFAULTS = {
+    'InitialSoilStore':0.0,
+    'InitialGroundwaterStore':0.0,
+    'O':1.0,
+    'Alpha':0.0,
+    'InputRate':0.0,
+    'E':0.0,
+    'TimingFactor':1.0,
+    'M':0.0,
+    'M3':0.0,
+    'M4':0.0,
+    'M5':0.0,
+    'M6':0.0,
+    'M13':0.0,
+    'M22':0.0,
+    'M41':0.0,
+    'B1':0.0,
+    'B2':0.0,
+    'B3':0.0,
+    'B4':0.0,
+    'B5':0.0,
+    'B6':0.0,
+    'B11':0.0,
+    'B12':0.0,
+    'B13':0.0,
+    'B21':0.0,
+    'B22':0.0,
+    'B31':0.0,
+    'B41':0.0,
+    'B42':0.0,
+    'T':1.0,
+    'DgwSurf':0.0,
+    'OgwSurf':0.0,
+    'DgwOut':0.0,
+    'OgwOut':0.0,
+    'Dgw':0.0,
+    'Ogw':0.0,
+    'Dsurf':0.0,
+    'Osurf':0.0,
+    'Dout':0.0,
+    'Oout':0.0,
+    'Geology':0.0,
+    'DOC':0.0,
+    'Drainage':0.0,
+    'SoilLeach':0.0,
+    'Groundcover':0.0,
+    'Distance':0.0,
+    'Wetlands':0.0,
+    'PlantUptake':0.0,
+    'SoilMoisture':0.0,
+    'Temp':0.0,
+    'Riparian':0.0,
+    'Soil':0.0,
+    'quickflow':0.0,
+    'slowflow':0.0
+}
+
+# Terms of each loss rate exponent: (B, modifier or None, variable, inverse)
+LOSS_RATES = {
+    'OutsideLossRate':('Dout','Oout',[
+        ('B11',None,'Temp',True),
+        ('B12',None,'SoilMoisture',True),
+        ('B13','M13','PlantUptake',True)
+    ]),
+    'SurfaceLossRate':('Dsurf','Osurf',[
+        ('B1',None,'quickflow',True),
+        ('B2',None,'Distance',False),
+        ('B3','M3','Groundcover',False),
+        ('B4','M4','Riparian',False),
+        ('B5','M5','Wetlands',False),
+        ('B6','M6','Soil',False)
+    ]),
+    'GroundwaterLossRate':('Dgw','Ogw',[
+        ('B21',None,'Drainage',True),
+        ('B22','M22','SoilLeach',False)
+    ]),
+    'GroundwaterLossOutRate':('DgwOut','OgwOut',[
+        ('B41','M41','DOC',True),
+        ('B42',None,'Geology',False)
+    ]),
+    'GroundwaterLossSlowflowRate':('DgwSurf','OgwSurf',[
+        ('B31',None,'slowflow',True) # GWDischarge = slowflow
+    ])
+}
+
+GENERATION_TERMS = ['O','Alpha','InputRate','M','E','TimingFactor']
+
+STATES = ['SoilStore','GroundwaterStore']
+FLUXES = ['LossOut','LossToGroundwater','LossOutGroundwater','quickflowConstituent','slowflowConstituent']
+DEFAULT_RECORD = STATES + FLUXES
+LOADS = ['quickflowConstituent','slowflowConstituent']
+
+# Parameters that sensitivities can be calculated for
+SENSITIVITY_PARAMETERS = set(GENERATION_TERMS)
+for _d,_o,_terms in LOSS_RATES.values():
+    SENSITIVITY_PARAMETERS.update([_d,_o] + [b for b,_,_,_ in _terms] + [m for _,m,_,_ in _terms if m])
+
+def safe_inv(x):
+    x = np.asarray(x,dtype='f8')
+    sign = np.sign(x)
+    sign[sign==0] = 1.0
+    return 1.0 / np.where(np.abs(x) < TINY,sign*TINY,x)
+
+def weight(d,o,e):
+    return (1 - o)*d + o * e
+
+def term_dependencies(term):
+    b, m, x, _ = term
+    return [b,x] + ([m] if m else [])
+
+def exponent_term(term,values):
+    b, m, x, inverse = term
+    result = -values[b] * (safe_inv(values[x]) if inverse else values[x])
+    if m is not None:
+        result = result * values[m]
+    return result
+
+def exponent(terms,values,initial=0.0):
+    result = initial
+    for term in terms:
+        result = result + exponent_term(term,values)
+    return result
+
+def loss_rate(rate,values):
+    '''
+    Compute one of the loss rates of AbstractCLOEFUModel.
+
+    values: mapping (eg dictionary) from parameter/input name to array
+    '''
+    d, o, terms = LOSS_RATES[rate]
+    return weight(values[d],values[o],np.exp(exponent(terms,values)))
+
+def generation_rate(values,area_ha,terms=GENERATION_TERMS):
+    '''
+    Mass generated per timestep (GenerateRateKg_timestep).
+    '''
+    result = area_ha
+    for term in terms:
+        result = result * values[term]
+    return result
+
+def loss_rate_sensitivity(rate,values,parameters,exp_value=None):
+    '''
+    Derivatives of a loss rate, weight(D,O,exp(sum(-B*M*x))), with respect to each of
+    parameters, as an array of parameter x element.
+
+    exp_value: exp(exponent) for the rate, if already computed
+    '''
+    d, o, terms = LOSS_RATES[rate]
+    if exp_value is None:
+        exp_value = np.exp(exponent(terms,values))
+    result = np.zeros((len(parameters),) + np.shape(exp_value))
+    for i,p in enumerate(parameters):
+        if p == d:
+            result[i] = 1 - values[o]
+        elif p == o:
+            result[i] = exp_value - values[d]
+        else:
+            for b, m, x, inverse in terms:
+                if p not in (b,m):
+                    continue
+                xv = safe_inv(values[x]) if inverse else values[x]
+                if p == b:
+                    d_exponent = -xv * (values[m] if m else 1.0)
+                else:
+                    d_exponent = -values[b] * xv
+                result[i] += values[o] * exp_value * d_exponent
+    return result
+
+def generation_sensitivity(values,area_ha,parameters):
+    '''
+    Derivatives of the generation rate with respect to each of parameters, as an array of
+    parameter x element
+    '''
+    result = np.zeros((len(parameters),len(area_ha)))
+    for i,p in enumerate(parameters):
+        if p in GENERATION_TERMS:
+            result[i] = generation_rate(values,area_ha,[t for t in GENERATION_TERMS if t != p])
+    return result
+
+class CloeResults(object):
+    '''
+    Recorded outputs of a CloeEngine run, as arrays of time x element, along with any
+    sensitivities (variable -> parameter -> array of time x element).
+    '''
+    def __init__(self,dates,elements,recorded,sensitivities=None):
+        self.dates = dates
+        self.elements = elements
+        self.recorded = recorded
+        self.sensitivities = sensitivities or {}
+
+    def __getitem__(self,variable):
+        return self.recorded[variable]
+
+    def as_dataframe(self,variable,constituent=None,parameter=None):
+        '''
+        Return a recorded variable as a DataFrame with columns named as per custom_name
+        (catchment@fu@@source), as returned by CloeScenario retrievals prior to reduction.
+
+        If parameter is given, return the sensitivity of the variable to that parameter.
+        '''
+        data = self.recorded[variable] if parameter is None else self.sensitivities[variable][parameter]
+        elements = self.elements
+        if constituent is not None:
+            mask = (elements.constituent==constituent).values
+            data = data[:,mask]
+            elements = elements[mask]
+        columns = elements.catchment + '@' + elements.fu + '@@' + elements.source
+        return pd.DataFrame(data,index=self.dates,columns=list(columns))
+
+    def catchment_loads(self,constituent):
+        '''
+        Total load (quickflow + slowflow, kg/s) delivered from each catchment, as a
+        DataFrame of time x catchment. Suitable as input to InstreamRouting.
+        '''
+        return self._by_catchment([self.recorded[v] for v in LOADS],constituent)
+
+    def catchment_load_sensitivity(self,constituent,parameter):
+        '''
+        Sensitivity of the total load from each catchment (as per catchment_loads) to a
+        parameter applied to every element of the constituent, as a DataFrame of time x catchment.
+        '''
+        return self._by_catchment([self.sensitivities[v][parameter] for v in LOADS],constituent)
+
+    def _by_catchment(self,arrays,constituent):
+        mask = (self.elements.constituent==constituent).values
+        loads = sum(a[:,mask] for a in arrays)
+        catchments = self.elements.catchment[mask]
+        codes, names = pd.factorize(catchments)
+        result = np.zeros((loads.shape[0],len(names)))
+        np.add.at(result.T,codes,loads.T)
+        return pd.DataFrame(result,index=self.dates,columns=list(names))
+
+class CloeEngine(object):
+    '''
+    Array based implementation of the CLOE constituent generation models.
+
+    elements: DataFrame with columns catchment, fu, constituent, source and model
+              (AREAL or NON_AREAL), with an optional area column (m^2)
+    '''
+    def __init__(self,elements):
+        elements = elements.reset_index(drop=True)
+        if 'area' not in elements.columns:
+            elements = elements.assign(area=np.nan)
+        self.elements = elements
+        self.n_elements = len(elements)
+        self.parameters = {}
+        self.data_sources = {}
+        self.time_series = {}
+        self.soil_store = None
+        self.groundwater_store = None
+
+    @staticmethod
+    def build_elements(catchments,fus,constituents,models):
+        '''
+        Build the element table from the catchment/FU/constituent lists and a list of
+        (model,constraint) tuples as per CloeSetup.install_models. Later models override
+        earlier models for the same element.
+        '''
+        index = pd.MultiIndex.from_product([catchments,fus,constituents],names=ELEMENT_KEYS[:3])
+        base = index.to_frame(index=False)
+        assigned = {}
+        for model,constraint in models:
+            sources = _stringToList(constraint.get('sources',[]))
+            if not len(sources):
+                continue
+            candidates = pd.concat([base.assign(source=s) for s in sources],ignore_index=True)
+            mask = np.ones(len(candidates),dtype=bool)
+            for kw,col in FILTER_KEYS.items():
+                if kw in constraint:
+                    mask &= candidates[col].isin(_stringToList(constraint[kw])).values
+            for row in candidates[mask].itertuples(index=False):
+                assigned[tuple(row)] = model
+        elements = pd.DataFrame(list(assigned.keys()),columns=ELEMENT_KEYS)
+        elements['model'] = list(assigned.values())
+        return elements
+
+    @staticmethod
+    def from_setup(setup,areas=None):
+        '''
+        Build an engine for the models, parameters and time series described by a CloeSetup.
+
+        setup: CloeSetup with inputs loaded (setup.load_inputs())
+        areas: mapping (catchment,fu) -> area in m^2, required for areal sources
+        '''
+        from cloe_setup import model_name
+        # Conditional models can be given by short or full (Source) model name
+        engine_models = {model_name(m):m for m in [AREAL,NON_AREAL]}
+        models = [(AREAL,dict(sources=setup.areal_sources,constituents=setup.constituents)),
+                  (NON_AREAL,dict(sources=setup.non_areal_sources,constituents=setup.constituents))]
+        for cond in setup.conditional_sources:
+            full_name = model_name(cond['model'])
+            models.append((engine_models.get(full_name,full_name),cond['constrain']))
+        elements = CloeEngine.build_elements(setup.catchment_names,setup.fus,setup.constituents,models)
+        elements = elements[elements.model.isin([AREAL,NON_AREAL])]
+        engine = CloeEngine(elements)
+        if areas is not None:
+            engine.set_areas(areas)
+
+        setup.apply_parameters(target=engine)
+        setup.create_data_sources(target=engine)
+        setup.connect_time_series(target=engine)
+        return engine
+
+    def set_areas(self,areas):
+        '''
+        Set the area (m^2) of each element from a mapping of (catchment,fu) -> area
+        '''
+        keys = zip(self.elements.catchment,self.elements.fu)
+        self.elements['area'] = [areas.get(k,np.nan) for k in keys]
+
+    def _match(self,**kwargs):
+        mask = np.ones(self.n_elements,dtype=bool)
+        for kw,val in kwargs.items():
+            if kw not in FILTER_KEYS:
+                raise ValueError('Unsupported constraint: %s'%kw)
+            mask &= self.elements[FILTER_KEYS[kw]].isin(_stringToList(val)).values
+        return np.flatnonzero(mask)
+
+    def enumerate_names(self,**kwargs):
+        ix = self._match(**kwargs)
+        return list(self.elements.iloc[ix][ELEMENT_KEYS].itertuples(index=False,name=None))
+
+    def set_param_values(self,parameter,values,fromList=False,**kwargs):
+        ix = self._match(**kwargs)
+        if parameter not in self.parameters:
+            self.parameters[parameter] = np.full(self.n_elements,DEFAULTS.get(parameter,0.0))
+        if fromList:
+            values = np.resize(np.asarray(values,dtype='f8'),len(ix))
+        self.parameters[parameter][ix] = values
+
+    def get_param_values(self,parameter,**kwargs):
+        ix = self._match(**kwargs)
+        return list(self._parameter(parameter)[ix])
+
+    def _parameter(self,parameter):
+        if parameter in self.parameters:
+            return self.parameters[parameter]
+        return np.full(self.n_elements,DEFAULTS.get(parameter,0.0))
+
+    def create_data_source(self,name,data,units=None):
+        if 'Date' in data.columns:
+            data = data.set_index('Date')
+        self.data_sources[name] = data
+
+    def data_source_columns(self):
+        return {name:list(df.columns) for name,df in self.data_sources.items()}
+
+    def assign_time_series(self,parameter,values,data_source,from_list=False,**kwargs):
+        ix = self._match(**kwargs)
+        if not from_list:
+            values = [values]
+        assignments = self.time_series.setdefault(parameter,{})
+        for i,el in enumerate(ix):
+            assignments[el] = (data_source,values[i%len(values)])
+
+    def clear_time_series(self,parameter,**kwargs):
+        if parameter not in self.time_series:
+            return
+        assignments = self.time_series[parameter]
+        for el in self._match(**kwargs):
+            assignments.pop(el,None)
+
+    def _area_ha(self):
+        areal = (self.elements.model==AREAL).values
+        area = self.elements.area.values
+        if np.isnan(area[areal]).any():
+            raise ValueError('Areas required for all areal elements. Use set_areas')
+        return np.where(areal,area*1e-4,1.0)
+
+    def _compile_time_series(self,dates):
+        '''
+        Convert time series assignments to, for each parameter, a list of
+        (values[time,column], element index, column index)
+        '''
+        result = {}
+        for parameter,assignments in self.time_series.items():
+            if not len(assignments):
+                continue
+            by_source = {}
+            for el,(ds,col) in assignments.items():
+                by_source.setdefault(ds,[]).append((el,col))
+            compiled = []
+            for ds,pairs in by_source.items():
+                df = self.data_sources[ds]
+                el_ix = np.array([el for el,_ in pairs])
+                columns = df.columns.get_indexer([col for _,col in pairs])
+                if (columns < 0).any():
+                    raise KeyError('Missing columns in data source %s'%ds)
+                if not df.index.equals(dates):
+                    df = df.reindex(dates)
+                data = np.asarray(df.values,dtype='f8')
+                compiled.append((data,el_ix,columns))
+            result[parameter] = compiled
+        return result
+
+    def default_dates(self):
+        '''
+        Dates common to all assigned data sources
+        '''
+        dates = None
+        used = {ds for assignments in self.time_series.values() for ds,_ in assignments.values()}
+        for ds in used:
+            index = self.data_sources[ds].index
+            dates = index if dates is None else dates.intersection(index)
+        if dates is None:
+            raise ValueError('No time series assigned. Provide dates')
+        return dates.sort_values()
+
+    def reset(self):
+        self.soil_store = self._parameter('InitialSoilStore').astype('f8').copy()
+        self.groundwater_store = self._parameter('InitialGroundwaterStore').astype('f8').copy()
+
+    def run(self,dates=None,timestep=86400.0,record=DEFAULT_RECORD,reset=True,
+            sensitivities=None,sensitivity_record=LOADS):
+        '''
+        Run the model over dates (default: dates common to all assigned time series).
+
+        Returns CloeResults with each recorded variable as an array of time x element.
+        Fluxes are in kg/s and stores in kg, as per Source.
+
+        sensitivities: parameters (see SENSITIVITY_PARAMETERS) to propagate forward
+                       sensitivities for, through the store updates (including loss
+                       scaling and the limits on each loss). Sensitivities of the
+                       variables in sensitivity_record are returned in
+                       CloeResults.sensitivities. Stores carried over from a previous
+                       run (reset=False) are treated as independent of the parameters.
+        '''
+        if dates is None:
+            dates = self.default_dates()
+        if reset or self.soil_store is None:
+            self.reset()
+
+        series = self._compile_time_series(dates)
+        unknown = [p for p in series if p not in DEFAULTS]
+        if len(unknown):
+            raise ValueError('Time series assigned to unknown parameters: %s'%', '.join(unknown))
+        static = {p:self._parameter(p) for p in DEFAULTS}
+        area_ha = self._area_ha()
+
+        def dynamic(names):
+            return any(n in series for n in names)
+
+        sensitivities = list(sensitivities or [])
+        for p in sensitivities:
+            if p not in SENSITIVITY_PARAMETERS:
+                raise ValueError('Sensitivities not supported for %s'%p)
+            if dynamic([p]):
+                raise ValueError('Sensitivities not supported for parameters with time series (%s)'%p)
+        n_sens = len(sensitivities)
+
+        # Evaluate everything that doesn't depend on a time series once, up front
+        rate_terms = {}
+        for rate,(d,o,terms) in LOSS_RATES.items():
+            if dynamic([d,o]):
+                raise ValueError('Time series not supported for %s and %s'%(d,o))
+            dynamic_terms = [t for t in terms if dynamic(term_dependencies(t))]
+            static_exponent = exponent([t for t in terms if t not in dynamic_terms],static)
+            rate_terms[rate] = (dynamic_terms,static_exponent)
+        static_rates = {rate:weight(static[LOSS_RATES[rate][0]],static[LOSS_RATES[rate][1]],np.exp(e))
+                        for rate,(dynamic_terms,e) in rate_terms.items() if not len(dynamic_terms)}
+        static_d_rates = {rate:loss_rate_sensitivity(rate,static,sensitivities,np.exp(e))
+                          for rate,(dynamic_terms,e) in rate_terms.items() if n_sens and not len(dynamic_terms)}
+        dynamic_generation = [t for t in GENERATION_TERMS if dynamic([t])]
+        static_generation = generation_rate(static,area_ha,[t for t in GENERATION_TERMS if t not in dynamic_generation])
+
+        n_steps = len(dates)
+        recorded = {v:np.empty((n_steps,self.n_elements)) for v in record}
+        sens_record = list(sensitivity_record) if n_sens else []
+        d_recorded = {v:np.empty((n_sens,n_steps,self.n_elements)) for v in sens_record}
+        values = dict(static)
+        soil = self.soil_store
+        gw = self.groundwater_store
+        # Sensitivities of the stores, as arrays of parameter x element
+        d_soil = np.zeros((n_sens,self.n_elements))
+        d_gw = np.zeros((n_sens,self.n_elements))
+        for t in range(n_steps):
+            for parameter,compiled in series.items():
+                current = static[parameter].copy()
+                for data,el_ix,columns in compiled:
+                    current[el_ix] = data[t,columns]
+                values[parameter] = current
+
+            rates = dict(static_rates)
+            d_rates = dict(static_d_rates)
+            for rate,(dynamic_terms,static_exponent) in rate_terms.items():
+                if rate in rates:
+                    continue
+                d, o, _ = LOSS_RATES[rate]
+                exp_value = np.exp(exponent(dynamic_terms,values,static_exponent))
+                rates[rate] = weight(values[d],values[o],exp_value)
+                if n_sens:
+                    d_rates[rate] = loss_rate_sensitivity(rate,values,sensitivities,exp_value)
+            generated = generation_rate(values,static_generation,dynamic_generation)
+
+            # runTimeStep
+            soil += generated
+            if n_sens:
+                d_soil += generation_sensitivity(values,area_ha,sensitivities)
+
+            # CalculateSurfaceFluxes
+            loss_threshold = values['T'] * soil
+            loss_out = soil * rates['OutsideLossRate']
+            quick = soil * rates['SurfaceLossRate']
+            to_gw = soil * rates['GroundwaterLossRate']
+
+            loss_demand = loss_out + quick + to_gw
+            over = loss_demand > loss_threshold
+            loss_scale = np.ones(self.n_elements)
+            loss_scale[over] = loss_threshold[over] / loss_demand[over]
+
+            if n_sens:
+                d_loss_out = d_soil * rates['OutsideLossRate'] + soil * d_rates['OutsideLossRate']
+                d_quick = d_soil * rates['SurfaceLossRate'] + soil * d_rates['SurfaceLossRate']
+                d_to_gw = d_soil * rates['GroundwaterLossRate'] + soil * d_rates['GroundwaterLossRate']
+                d_threshold = values['T'] * d_soil
+                d_demand = d_loss_out + d_quick + d_to_gw
+                d_loss_scale = np.zeros_like(d_soil)
+                d_loss_scale[:,over] = (d_threshold[:,over] * loss_demand[over] - loss_threshold[over] * d_demand[:,over]) / loss_demand[over]**2
+                d_quick = d_quick * loss_scale + quick * d_loss_scale
+                d_to_gw = d_to_gw * loss_scale + to_gw * d_loss_scale
+                d_loss_out = d_loss_out * loss_scale + loss_out * d_loss_scale
+
+            quick *= loss_scale
+            soil -= quick
+
+            to_gw *= loss_scale
+            soil -= to_gw
+            gw += to_gw
+
+            loss_out *= loss_scale
+            if n_sens:
+                d_soil -= d_quick + d_to_gw
+                d_gw += d_to_gw
+                # Where the loss is limited to the store, it follows the store
+                limited = loss_out > soil
+                d_loss_out[:,limited] = d_soil[:,limited]
+            loss_out = np.minimum(loss_out,soil)
+            soil -= loss_out
+            if n_sens:
+                d_soil -= d_loss_out
+
+            # CalculateGroundwaterStoreFluxes
+            loss_out_gw = gw * rates['GroundwaterLossOutRate']
+            slow = gw * rates['GroundwaterLossSlowflowRate']
+            if n_sens:
+                d_loss_out_gw = d_gw * rates['GroundwaterLossOutRate'] + gw * d_rates['GroundwaterLossOutRate']
+                d_slow = d_gw * rates['GroundwaterLossSlowflowRate'] + gw * d_rates['GroundwaterLossSlowflowRate']
+                limited = loss_out_gw > gw
+                d_loss_out_gw[:,limited] = d_gw[:,limited]
+
+            loss_out_gw = np.minimum(gw,loss_out_gw)
+            gw -= loss_out_gw
+            if n_sens:
+                d_gw -= d_loss_out_gw
+                limited = slow > gw
+                d_slow[:,limited] = d_gw[:,limited]
+
+            slow = np.minimum(gw,slow)
+            gw -= slow
+            if n_sens:
+                d_gw -= d_slow
+
+            step = {
+                'SoilStore':soil,
+                'GroundwaterStore':gw,
+                'LossOut':loss_out,
+                'LossToGroundwater':to_gw,
+                'LossOutGroundwater':loss_out_gw,
+                'quickflowConstituent':quick,
+                'slowflowConstituent':slow
+            }
+            for v in record:
+                recorded[v][t] = step[v] if v in STATES else step[v] / timestep
+            if n_sens:
+                d_step = {
+                    'SoilStore':d_soil,
+                    'GroundwaterStore':d_gw,
+                    'LossOut':d_loss_out,
+                    'LossToGroundwater':d_to_gw,
+                    'LossOutGroundwater':d_loss_out_gw,
+                    'quickflowConstituent':d_quick,
+                    'slowflowConstituent':d_slow
+                }
+                for v in sens_record:
+                    d_recorded[v][:,t] = d_step[v] if v in STATES else d_step[v] / timestep
+
+        result = {v:{p:d_recorded[v][i] for i,p in enumerate(sensitivities)} for v in sens_record}
+        return CloeResults(dates,self.elements,recorded,result)
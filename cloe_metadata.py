@@ -0,0 +1,168 @@
+'''
+Cache of model metadata queried from Veneer during CloeSetup.
+
+MetadataCache sits between CloeSetup and the Veneer client. Reads are served
+from local indexes, built on first use:
+
+* variable FullNames, in an index supporting prefix queries (see PrefixIndex),
+* data source columns, by data source name,
+* runoff model element names and parameter values, keyed by (catchment, fu),
+  so that FU/catchment constrained queries are answered locally,
+* generation model tables and element names, by constraint.
+
+Mutating calls made through the cache are forwarded to Veneer and update or
+invalidate just the affected entries.
+'''
+from bisect import bisect_left, insort
+
+from veneer.utils import _stringToList
+
+# Constraints on runoff models that can be answered from (catchment, fu) keyed values
+LOCAL_CONSTRAINTS={
+    'catchments':0,
+    'fus':1
+}
+
+def _key(**kwargs):
+    return tuple(sorted((k,repr(v)) for k,v in kwargs.items()))
+
+class PrefixIndex(object):
+    '''
+    Index of names supporting prefix queries, insertion and removal.
+
+    Names are held sorted, for prefix queries, but returned in the order they were
+    listed (or added), ie the order in which Source lists them
+    '''
+    def __init__(self,names=()):
+        self._order = {}
+        for name in names:
+            self._order.setdefault(name,len(self._order))
+        self._names = sorted(self._order)
+        self._next = len(self._order)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self,name):
+        return name in self._order
+
+    def with_prefix(self,prefix):
+        start = bisect_left(self._names,prefix)
+        end = start
+        while end < len(self._names) and self._names[end].startswith(prefix):
+            end += 1
+        return sorted(self._names[start:end],key=self._order.__getitem__)
+
+    def add(self,name):
+        if name not in self._order:
+            insort(self._names,name)
+            self._order[name] = self._next
+            self._next += 1
+
+    def remove(self,name):
+        if self._order.pop(name,None) is not None:
+            del self._names[bisect_left(self._names,name)]
+
+class MetadataCache(object):
+    def __init__(self,client):
+        self.client = client
+        self._variables = None
+        self._stale_prefixes = set()
+        self._data_sources = None
+        self._runoff_names = None
+        self._runoff_values = {}
+        self._generation_tables = {}
+        self._generation_names = {}
+
+    # Function variables
+
+    def variables_with_prefix(self,prefix):
+        '''
+        FullNames of function variables starting with prefix
+        '''
+        if self._variables is None or any(prefix.startswith(p) or p.startswith(prefix) for p in self._stale_prefixes):
+            self._variables = PrefixIndex(self.client.variables()._select(['FullName']))
+            self._stale_prefixes = set()
+        return self._variables.with_prefix(prefix)
+
+    def delete_variables(self,names):
+        self.client.model.functions.delete_variables(names)
+        if self._variables is not None:
+            for name in names:
+                self._variables.remove(name)
+
+    def create_modelled_variable(self,parameter,**kwargs):
+        result = self.client.model.catchment.runoff.create_modelled_variable(parameter,**kwargs)
+        # Names of new variables are determined by Source, so mark the prefix for re-query
+        self._stale_prefixes.add('$'+parameter.replace(' ','_').replace('-','_'))
+        return result
+
+    # Data sources
+
+    def data_source_columns(self,refresh=False):
+        '''
+        Dictionary of data source name -> column names. If refresh, re-query Source
+        '''
+        if self._data_sources is None or refresh:
+            data_sources = self.client.data_sources()
+            self._data_sources = {ds['Name']:[i['Name'] for i in ds['Items'][0]['Details']] for ds in data_sources}
+        return self._data_sources
+
+    def create_data_source(self,name,data,**kwargs):
+        result = self.client.create_data_source(name,data,**kwargs)
+        if self._data_sources is not None:
+            self._data_sources[name] = [str(c) for c in data.columns]
+        return result
+
+    # Runoff models
+
+    def runoff_names(self,**kwargs):
+        '''
+        (catchment, fu) of each runoff model matching the constraint, in Source's order
+        '''
+        if self._runoff_names is None:
+            self._runoff_names = [tuple(n[:2]) for n in self.client.model.catchment.runoff.enumerate_names()]
+        if not set(kwargs).issubset(LOCAL_CONSTRAINTS):
+            return [tuple(n[:2]) for n in self.client.model.catchment.runoff.enumerate_names(**kwargs)]
+        filters = [(LOCAL_CONSTRAINTS[k],set(_stringToList(v))) for k,v in kwargs.items()]
+        return [n for n in self._runoff_names if all(n[ix] in allowed for ix,allowed in filters)]
+
+    def runoff_values(self,parameter):
+        '''
+        Dictionary of (catchment, fu) -> value of a runoff model parameter
+        '''
+        if parameter not in self._runoff_values:
+            values = self.client.model.catchment.runoff.get_param_values(parameter)
+            self._runoff_values[parameter] = dict(zip(self.runoff_names(),values))
+        return self._runoff_values[parameter]
+
+    def runoff_param_values(self,parameter,**kwargs):
+        if not set(kwargs).issubset(LOCAL_CONSTRAINTS):
+            return self.client.model.catchment.runoff.get_param_values(parameter,**kwargs)
+        lookup = self.runoff_values(parameter)
+        return [lookup[n] for n in self.runoff_names(**kwargs)]
+
+    def set_runoff_param_values(self,parameter,values,**kwargs):
+        result = self.client.model.catchment.runoff.set_param_values(parameter,values,**kwargs)
+        self._runoff_values.pop(parameter,None)
+        return result
+
+    # Generation models
+
+    def generation_model_table(self,**kwargs):
+        key = _key(**kwargs)
+        if key not in self._generation_tables:
+            self._generation_tables[key] = self.client.model.catchment.generation.model_table(**kwargs)
+        return self._generation_tables[key]
+
+    def generation_names(self,**kwargs):
+        key = _key(**kwargs)
+        if key not in self._generation_names:
+            self._generation_names[key] = self.client.model.catchment.generation.enumerate_names(**kwargs)
+        return self._generation_names[key]
+
+    def set_generation_models(self,model,**kwargs):
+        result = self.client.model.catchment.generation.set_models(model,**kwargs)
+        self._generation_tables = {}
+        self._generation_names = {}
+        return result
@@ -0,0 +1,206 @@
+'''
+Concurrent application of a CloeSetup configuration.
+
+The configuration is compiled into the Veneer operations that CloeSetup.apply
+would send (see cloe_plan), which are then sent with up to a fixed number of
+requests in flight. Veneer clients are blocking, so requests are sent from a
+pool of threads.
+
+Each stage starts once the stages it depends on are complete (DEPENDENCIES),
+eg models are installed before parameters are set and data sources are created
+before time series are connected. Data sources are uploaded while constituents,
+models and parameters are configured.
+
+On a model without the constituents, constituent sources or models, operations
+aligned with the model's elements (ELEMENT_STAGES) can only be compiled once
+the models are installed, so apply compiles them while data sources are
+uploaded.
+
+Within a stage, operations are divided into lanes. Operations in a lane are
+sent in order, while lanes run concurrently:
+
+* constituents, constituent sources and data sources: one lane each,
+* models: one lane, as later models override earlier models,
+* parameters: one lane per parameter,
+* time series: one lane per parameter and constituent source. Operations that
+  aren't constrained to one constituent source (clear_time_series and global
+  time series) can apply to any element, so they are sent in phases of their
+  own (one lane per parameter), in the order compiled relative to the others,
+  eg global time series override those assigned by constituent source,
+* runoff functions: one lane.
+
+    pipeline = Pipeline(setup,workers=8,client_factory=lambda: veneer.Veneer(port))
+    pipeline.apply()
+
+By default the setup's Veneer client is shared by all threads. Use
+client_factory to give each thread its own client (eg with its own
+connection).
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cloe_plan import Planner, STAGES, ELEMENT_STAGES
+from cloe_trace import TracingClient
+
+logger = logging.getLogger(__name__)
+
+# Stages that must be complete before each stage starts
+DEPENDENCIES={
+    'constituents':[],
+    'constituent_sources':[],
+    'models':['constituents','constituent_sources'],
+    'parameters':['models'],
+    'data_sources':[],
+    'time_series':['parameters','data_sources'],
+    'functions':['time_series']
+}
+
+SINGLE_LANE={'models','functions'}
+
+def lanes(operations):
+    '''
+    Divide the operations of one stage into phases, run in order, each made up of lanes
+    of operations that can be sent concurrently with the other lanes in the phase.
+
+    Consecutive time series operations constrained to one constituent source share a
+    phase. Other time series operations start a new phase.
+    '''
+    phases = []
+    for op in operations:
+        by_source = True
+        if op.stage in SINGLE_LANE:
+            key = None
+        elif op.stage == 'time_series':
+            sources = op.kwargs.get('sources',None)
+            by_source = isinstance(sources,str)
+            key = (op.group,sources) if by_source else op.group
+        else:
+            key = op.group
+        if not len(phases) or phases[-1][0] != by_source:
+            phases.append((by_source,{}))
+        phases[-1][1].setdefault(key,[]).append(op)
+    return [list(phase.values()) for _,phase in phases]
+
+class Pipeline(object):
+    '''
+    Send the operations of a CloeSetup concurrently.
+
+    setup: CloeSetup
+    workers: maximum number of requests in flight
+    client_factory: function returning a Veneer client, called once in each thread.
+                    If None, all threads share the setup's client
+    '''
+    def __init__(self,setup,workers=8,client_factory=None):
+        self.setup = setup
+        self.workers = workers
+        self.client_factory = client_factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shared_client = None
+        self.sent = {}
+
+    def _client(self):
+        if self.client_factory is None:
+            return self._shared_client
+        if not hasattr(self._local,'client'):
+            self._local.client = TracingClient(self.client_factory(),self.setup.tracer)
+        return self._local.client
+
+    def _send(self,op):
+        if op.stage == 'functions':
+            self.setup._setup_function(*op.args)
+        else:
+            op.apply(self._client())
+        with self._lock:
+            self.sent[op.stage] = self.sent.get(op.stage,0) + 1
+
+    def _run_lane(self,operations):
+        for op in operations:
+            self._send(op)
+
+    def _compile(self,compile_operations,dependency):
+        dependency.result()
+        return compile_operations()
+
+    def _run_stage(self,operations,pool,dependencies):
+        for dependency in dependencies:
+            dependency.result()
+        if callable(operations):
+            operations = operations()
+        run_lane = self.setup.tracer.bind(self._run_lane)
+        for phase in lanes(operations):
+            jobs = [pool.submit(run_lane,lane) for lane in phase]
+            try:
+                for job in jobs:
+                    job.result()
+            except:
+                for job in jobs:
+                    job.cancel()
+                raise
+
+    def run(self,operations,deferred=None):
+        '''
+        Send operations (cloe_plan.Operation), respecting the dependencies between stages.
+
+        deferred: function returning further operations for ELEMENT_STAGES, called once
+                  the models are installed (eg compiling those stages)
+
+        Returns the number of operations sent, by stage.
+        '''
+        by_stage = {}
+        for op in operations:
+            by_stage.setdefault(op.stage,[]).append(op)
+        self.sent = {}
+        # Compiling swaps the setup's client, so hold on to the real one
+        self._shared_client = self.setup._v
+        with self.setup.tracer.span('pipeline','setup',workers=self.workers), \
+             ThreadPoolExecutor(self.workers) as pool, ThreadPoolExecutor(len(STAGES)+1) as coordinators:
+            # Coordinators and workers are traced within the pipeline span
+            run_stage = self.setup.tracer.bind(self._run_stage)
+            stages = {}
+            compiled = None
+            for stage in STAGES:
+                dependencies = [stages[d] for d in DEPENDENCIES[stage]]
+                stage_operations = by_stage.get(stage,[])
+                if compiled is not None and stage in ELEMENT_STAGES:
+                    stage_operations = lambda stage=stage,early=stage_operations: \
+                        early + [op for op in compiled.result() if op.stage == stage]
+                stages[stage] = coordinators.submit(run_stage,stage_operations,pool,dependencies)
+                if stage == 'models' and deferred is not None:
+                    compiled = coordinators.submit(self.setup.tracer.bind(self._compile),deferred,stages[stage])
+            for stage in STAGES:
+                stages[stage].result()
+        return self.sent
+
+    def apply(self):
+        '''
+        Compile and send the full configuration.
+
+        ELEMENT_STAGES are compiled once the models are installed. As with
+        CloeSetup.create_data_sources, data sources that Source already holds
+        (according to the upload manifest) are not uploaded again.
+        '''
+        setup = self.setup
+        planner = Planner(setup,None)
+        operations = planner.compile([s for s in STAGES if s not in ELEMENT_STAGES])
+        deferred = lambda: planner.compile(ELEMENT_STAGES)
+        manifest = setup.upload_manifest() if setup.deduplicate_uploads else None
+        if manifest is None:
+            return self.run(operations,deferred)
+
+        uploads = {op.args[0]:op for op in operations if op.stage == 'data_sources'}
+        pending = []
+        for name,op in uploads.items():
+            pending += setup._stale_data_sources([(name,op.args[1])],manifest,op.kwargs.get('units','kg'))
+        stale = {name for name,_,_ in pending}
+        operations = [op for op in operations if op.stage != 'data_sources' or op.args[0] in stale]
+        logger.info('Uploading %d of %d data sources',len(stale),len(uploads))
+
+        manifest.discard(stale)
+        manifest.save()
+        result = self.run(operations,deferred)
+        for name,_,content_hash in pending:
+            manifest.set(name,content_hash)
+        manifest.save()
+        return result
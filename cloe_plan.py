@@ -0,0 +1,384 @@
+'''
+Incremental application of a CloeSetup configuration.
+
+The planner compiles the configuration into the list of Veneer operations that
+CloeSetup.apply would send, by running the setup stages against a recording
+client. Queries needed while compiling (eg the existing data sources) are
+passed through to the real client.
+
+The plan is then compared with the model's current state, made up of the
+constituents, constituent sources and data sources reported by Source,
+together with a state file recording the fingerprint of each operation last
+applied. Only the differences are sent.
+
+Models are grouped by model type and constraint. As later models override
+earlier models, when one changes it and every later model is re-sent.
+Operations that modify the same parameter are order dependent: when one
+changes, it and every later operation on that parameter are re-sent. Removing
+a parameter setting from the configuration re-sends the remaining settings for
+that parameter, but does not restore Source's defaults. When any time series
+assignment for an input changes (including when its data source is
+re-created), that input is cleared and all of its assignments are re-sent.
+Runoff functions are re-created whenever their configuration or input data
+change. Installing generation models resets their parameters and inputs, so
+when the models change, every parameter, time series and runoff function
+applied to the generation models is re-sent.
+
+Parameters, time series and runoff functions (ELEMENT_STAGES) are planned once
+the constituents, constituent sources and models have been applied, so that
+they are aligned with the elements in the model.
+'''
+import hashlib
+import json
+import logging
+import os
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Stages where the model is queried for what already exists
+EXISTING=['constituents','constituent_sources','data_sources']
+
+STAGES=[
+    'constituents',
+    'constituent_sources',
+    'models',
+    'parameters',
+    'data_sources',
+    'time_series',
+    'functions'
+]
+
+# Stages aligned with the elements of the model (eg spatial parameters set fromList), which
+# must be compiled once the constituents, constituent sources and models are in place
+ELEMENT_STAGES=['parameters','time_series','functions']
+
+# Queries that are passed through to the real client while compiling a plan
+PASSTHROUGH={
+    'data_sources',
+    'model.catchment.generation.enumerate_names',
+    'model.catchment.generation.get_param_values',
+    'model.catchment.generation.model_table'
+}
+
+def _update_hash(h,value):
+    if isinstance(value,(pd.DataFrame,pd.Series)):
+        h.update(pd.util.hash_pandas_object(value,index=True).values.tobytes())
+        if isinstance(value,pd.DataFrame):
+            h.update(repr(list(value.columns)).encode('utf-8'))
+    elif isinstance(value,dict):
+        for k in sorted(value.keys(),key=str):
+            h.update(repr(k).encode('utf-8'))
+            _update_hash(h,value[k])
+    elif isinstance(value,(list,tuple)):
+        h.update(b'[')
+        for v in value:
+            _update_hash(h,v)
+        h.update(b']')
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+def fingerprint(*values):
+    h = hashlib.sha1()
+    for v in values:
+        _update_hash(h,v)
+    return h.hexdigest()
+
+class Operation(object):
+    '''
+    A single call on the Veneer client, eg model.catchment.generation.set_param_values
+    '''
+    def __init__(self,stage,group,path,args,kwargs,depends_on=None):
+        self.stage = stage
+        self.group = group
+        self.path = path
+        self.args = args
+        self.kwargs = kwargs
+        self.fingerprint = fingerprint(path,list(args),kwargs,depends_on)
+
+    def __repr__(self):
+        return '%s: %s%s'%(self.stage,self.path,repr(tuple(self.args)))
+
+    def apply(self,client):
+        target = client
+        for attr in self.path.split('.'):
+            target = getattr(target,attr)
+        return target(*self.args,**self.kwargs)
+
+class _RecordingClient(object):
+    '''
+    Stands in for the Veneer client, recording mutating calls as operations
+    '''
+    def __init__(self,planner,client,path=''):
+        self._planner = planner
+        self._client = client
+        self._path = path
+
+    def __getattr__(self,attr):
+        path = attr if not self._path else '%s.%s'%(self._path,attr)
+        return _RecordingClient(self._planner,self._client,path)
+
+    def __call__(self,*args,**kwargs):
+        if self._path in PASSTHROUGH:
+            result = Operation(None,None,self._path,args,kwargs).apply(self._client)
+            if self._path == 'data_sources':
+                result = self._planner._with_planned_data_sources(result)
+            return result
+        self._planner._record(self._path,args,kwargs)
+
+def _reset_by_models(op):
+    '''
+    Whether op applies to generation models, and so is undone when models are installed
+    '''
+    return op.stage == 'functions' or op.path.startswith('model.catchment.generation.')
+
+class Plan(object):
+    '''
+    Planned operations and the subset (changes) that differ from the current state.
+
+    current_state: dictionary of stage -> group -> fingerprints of operations last applied
+    existing: dictionary of stage -> names of constituents, constituent sources and data
+              sources that exist in the model
+    models_changed: whether generation models are being installed, in which case the
+                    operations applied to them are re-sent. If None, determined from
+                    the models operations in this plan
+    '''
+    def __init__(self,operations,current_state,existing,models_changed=None):
+        self.operations = operations
+        self.current_state = current_state
+        self.existing = existing
+        self.models_changed = bool(models_changed)
+        self.state = {}
+        for op in operations:
+            self.state.setdefault(op.stage,{}).setdefault(op.group,[]).append(op.fingerprint)
+        self.changes = self._diff()
+
+    def _diff(self):
+        result = []
+        for stage in STAGES:
+            ops = [op for op in self.operations if op.stage==stage]
+            groups = {}
+            for op in ops:
+                groups.setdefault(op.group,[]).append(op)
+            previous = self.current_state.get(stage,{})
+            for group,group_ops in groups.items():
+                if stage in EXISTING and group not in self.existing[stage]:
+                    result += group_ops
+                    continue
+                if stage in ('constituents','constituent_sources'):
+                    continue
+
+                old = previous.get(group,[])
+                if self.models_changed and _reset_by_models(group_ops[0]):
+                    old = []
+                elif stage == 'models' and any(op.stage == 'models' for op in result):
+                    # Later models override earlier models
+                    old = []
+                new = [op.fingerprint for op in group_ops]
+                first_change = 0
+                while first_change < min(len(old),len(new)) and old[first_change]==new[first_change]:
+                    first_change += 1
+                if first_change == len(new) and len(old) == len(new):
+                    continue
+                if stage == 'time_series':
+                    if not group_ops[0].path.endswith('clear_time_series'):
+                        parameter = group_ops[0].args[0]
+                        result.append(Operation(stage,group,'model.catchment.generation.clear_time_series',[parameter],{}))
+                    first_change = 0
+                elif len(old) > len(new) and first_change == len(new):
+                    # Trailing operations removed: re-send the remaining operations
+                    first_change = 0
+                result += group_ops[first_change:]
+            if stage == 'models':
+                self.models_changed = self.models_changed or \
+                    any(op.stage == 'models' and _reset_by_models(op) for op in result)
+        return result
+
+    def extend(self,other):
+        '''
+        Add the operations and changes of a plan of later stages
+        '''
+        self.operations = self.operations + other.operations
+        self.changes = self.changes + other.changes
+        self.state.update(other.state)
+        return self
+
+    def summary(self):
+        '''
+        Number of operations planned and to be sent, by stage
+        '''
+        return pd.DataFrame({
+            'planned':pd.Series([op.stage for op in self.operations],dtype=object).value_counts(),
+            'changed':pd.Series([op.stage for op in self.changes],dtype=object).value_counts()
+        }).reindex(STAGES).fillna(0).astype(int)
+
+class Planner(object):
+    '''
+    Plan and apply a CloeSetup configuration incrementally.
+
+    setup: CloeSetup
+    state_fn: JSON file recording the operations last applied to the model
+    '''
+    def __init__(self,setup,state_fn):
+        self.setup = setup
+        self.state_fn = state_fn
+        self._operations = []
+        self._stage = None
+        self._data_source_fingerprints = {}
+        self._planned_data_sources = {}
+
+    def _record(self,path,args,kwargs):
+        group = self._group(path,args,kwargs)
+        depends_on = None
+        if self._stage == 'time_series' and len(args) > 2:
+            depends_on = self._data_source_fingerprints.get(args[2],None)
+        op = Operation(self._stage,group,path,args,kwargs,depends_on)
+        if self._stage == 'data_sources':
+            self._data_source_fingerprints[args[0]] = op.fingerprint
+            self._planned_data_sources[args[0]] = [str(c) for c in args[1].columns]
+        self._operations.append(op)
+
+    def _group(self,path,args,kwargs):
+        if self._stage in ('constituents','constituent_sources','data_sources'):
+            return args[0]
+        if self._stage in ('parameters','time_series'):
+            return '%s:%s'%(path.split('.')[-2],args[0])
+        # Models, by model type and constraint
+        return '%s:%s:%s'%(path.split('.')[-2],args[0],json.dumps(kwargs,sort_keys=True,default=str))
+
+    def _with_planned_data_sources(self,data_sources):
+        '''
+        Add the planned data sources to those in the model, so that time series can be
+        planned against data sources that have not been created yet
+        '''
+        planned = [{'Name':name,'Items':[{'Details':[{'Name':c} for c in columns]}]}
+                   for name,columns in self._planned_data_sources.items()]
+        return [ds for ds in data_sources if ds['Name'] not in self._planned_data_sources] + planned
+
+    def load_state(self):
+        if self.state_fn is None or not os.path.exists(self.state_fn):
+            return {}
+        with open(self.state_fn,'r') as fp:
+            return json.load(fp)
+
+    def save_state(self,state):
+        if self.state_fn is None:
+            return
+        with open(self.state_fn,'w') as fp:
+            json.dump(state,fp)
+
+    def existing(self):
+        '''
+        Constituents, constituent sources and data sources that exist in the model
+        '''
+        v = self.setup._v
+        return {
+            'constituents':set(v.model.get_constituents()),
+            'constituent_sources':set(v.model.get_constituent_sources()),
+            'data_sources':{ds['Name'] for ds in v.data_sources()}
+        }
+
+    def compile(self,stages=STAGES):
+        '''
+        Compile the configuration into a list of operations, for the given stages.
+
+        Queries made while compiling see the model as it is, so on a model without
+        the constituents, constituent sources or models, compile ELEMENT_STAGES once
+        the other stages have been applied. Data sources planned by an earlier call
+        are treated as existing.
+        '''
+        setup = self.setup
+        self._operations = []
+        if 'data_sources' in stages:
+            self._data_source_fingerprints = {}
+            self._planned_data_sources = {}
+        client = setup._v
+        setup._v = _RecordingClient(self,client)
+        # Data sources are compared by fingerprint here, rather than by the upload manifest
+        deduplicate = setup.deduplicate_uploads
+        setup.deduplicate_uploads = False
+        try:
+            for stage,method in [
+                ('constituents',setup.create_constituents),
+                ('constituent_sources',setup.create_constituent_sources),
+                ('models',setup.install_models),
+                ('parameters',setup.apply_parameters),
+                ('data_sources',setup.create_data_sources),
+                ('time_series',setup.connect_time_series)]:
+                if stage not in stages:
+                    continue
+                self._stage = stage
+                method()
+        finally:
+            setup._v = client
+            setup.deduplicate_uploads = deduplicate
+            self._stage = None
+
+        if 'functions' not in stages:
+            return self._operations
+        for fn in setup.cfg.get('runoff_functions',[]):
+            data = [setup.input(dp['input']) for dp in fn.get('data_variables',[])]
+            op = Operation('functions',fn['function_name'],'_setup_function',[fn],{},data)
+            self._operations.append(op)
+        return self._operations
+
+    def plan(self,stages=STAGES):
+        '''
+        Plan the given stages against the current model. On a model without the
+        constituents, constituent sources or models, the plan for ELEMENT_STAGES is
+        incomplete (see apply)
+        '''
+        return Plan(self.compile(stages),self.load_state(),self.existing())
+
+    def apply(self,plan=None,pipeline=None):
+        '''
+        Send the changes in the plan (or a new plan) to the model and record the new state.
+
+        Without a plan, ELEMENT_STAGES are planned once the changes to the other stages
+        have been applied.
+
+        If a pipeline (cloe_pipeline.Pipeline) is given, it is used to send the changes
+        concurrently.
+        '''
+        if plan is not None:
+            self._send(plan.changes,pipeline)
+            self.save_state(plan.state)
+            return plan
+
+        current_state = self.load_state()
+        existing = self.existing()
+        plan = Plan(self.compile([s for s in STAGES if s not in ELEMENT_STAGES]),current_state,existing)
+        later = []
+        def plan_elements():
+            later.append(Plan(self.compile(ELEMENT_STAGES),current_state,existing,plan.models_changed))
+            return later[0].changes
+        self._send(plan.changes,pipeline,plan_elements)
+        plan.extend(later[0])
+        logger.info('Applied %d of %d planned operations',len(plan.changes),len(plan.operations))
+        self.save_state(plan.state)
+        return plan
+
+    def _send(self,changes,pipeline=None,deferred=None):
+        '''
+        Send changes, followed by those returned by deferred (called once the models are
+        installed)
+        '''
+        uploads = [op.args[0] for op in changes if op.stage == 'data_sources']
+        manifest = self.setup.upload_manifest() if len(uploads) else None
+        if manifest is not None:
+            # Data sources uploaded here aren't recorded in the upload manifest
+            manifest.discard(uploads)
+            manifest.save()
+        if pipeline is not None:
+            pipeline.run(changes,deferred)
+            return
+        if deferred is not None:
+            self._send(changes)
+            self._send(deferred())
+            return
+        logger.info('Applying %d operations',len(changes))
+        for op in changes:
+            if op.stage == 'functions':
+                self.setup._setup_function(*op.args)
+            else:
+                op.apply(self.setup._v)
@@ -0,0 +1,375 @@
+'''
+Network ordered implementation of InstreamCLOEModel.
+
+InstreamRouting routes catchment loads (eg from CloeEngine, or retrieved from
+Source) down the link network, using the same equations as
+InstreamCLOEModel.runTimeStep. Node processes (storages, extractions, etc) are
+not represented: the processed load of each link is passed to the links
+downstream of its to_node, divided equally where there is more than one.
+
+Links are routed in topological order. Independent headwater subtrees can be
+routed in parallel on a process pool:
+
+    routing = InstreamRouting.from_setup(setup)
+    routing.set_param_values('Dlink',0.9)
+    result = routing.route(results.catchment_loads('TP'),workers=8)
+
+Sensitivities of the processed loads can be propagated alongside, both to the
+parameters of ConstituentOutFraction (applied to every link) and to upstream
+parameters, given the sensitivity of the catchment loads (eg from CloeEngine):
+
+    result = routing.route(results.catchment_loads('TP'),sensitivities=['Dlink','B51'],
+                           load_sensitivities={'B1':results.catchment_load_sensitivity('TP','B1')})
+    result['ProcessedLoad sensitivities']['B1']
+'''
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from veneer.utils import _stringToList
+from cloe_engine import safe_inv, weight
+
+# Parameters and inputs of InstreamCLOEModel, with their defaults
+DEFAULTS = {
+    'InitialLinkStore':0.0,
+    'Dlink':0.0,
+    'Olink':0.0,
+    'B51':0.0,
+    'B52':0.0,
+    'BankErosionRate':0.0,
+    'TimingFactor':0.0,
+    'Alpha':0.0,
+    'O':1.4,
+    'M':0.0,
+    'E':0.0,
+    'TravelTime':0.0
+}
+
+BANK_EROSION_TERMS = ['O','Alpha','BankErosionRate','M','E','TimingFactor']
+
+# Parameters of ConstituentOutFraction that sensitivities can be calculated for
+SENSITIVITY_PARAMETERS = ['Dlink','Olink','B51','B52']
+
+def constituent_out_fraction(values,downstream_flow_volume):
+    '''
+    ConstituentOutFraction for one link, over time
+    '''
+    exp = -values['B51']*safe_inv(downstream_flow_volume) + values['B52']*values['TravelTime']
+    return weight(values['Dlink'],values['Olink'],np.exp(exp))
+
+def out_fraction_sensitivity(values,downstream_flow_volume,parameters):
+    '''
+    Derivatives of ConstituentOutFraction for one link with respect to each of parameters,
+    as an array of time x parameter
+    '''
+    inv_flow = safe_inv(downstream_flow_volume)
+    exp_value = np.exp(-values['B51']*inv_flow + values['B52']*values['TravelTime'])
+    derivatives = {
+        'Dlink':1 - values['Olink'],
+        'Olink':exp_value - values['Dlink'],
+        'B51':-values['Olink']*exp_value*inv_flow,
+        'B52':values['Olink']*exp_value*values['TravelTime']
+    }
+    return np.column_stack([np.broadcast_to(derivatives[p],np.shape(downstream_flow_volume)) for p in parameters])
+
+def bank_erosion(values,bank_erosion_rate):
+    result = bank_erosion_rate
+    for term in BANK_EROSION_TERMS:
+        if term != 'BankErosionRate':
+            result = result * values[term]
+    return result
+
+def route_link(inflow,out_fraction,initial_store,d_inflow=None,d_out_fraction=None):
+    '''
+    Route a single link over time, given its total inflow mass per timestep.
+
+    Returns ProcessedLoad, LinkStore (both per timestep) and the final LinkStore.
+
+    If d_inflow and d_out_fraction (sensitivities, as arrays of time x parameter) are
+    given, the sensitivities of ProcessedLoad (time x parameter) are returned as well.
+    '''
+    n = len(inflow)
+    processed = np.empty(n)
+    stores = np.empty(n)
+    store = initial_store
+    if d_inflow is None:
+        for t,(i,f) in enumerate(zip(inflow.tolist(),out_fraction.tolist())):
+            store += i
+            load = store*f
+            store = max(0.0,store - load)
+            processed[t] = load
+            stores[t] = store
+        return processed, stores, store
+
+    d_processed = np.empty(d_inflow.shape)
+    d_store = np.zeros(d_inflow.shape[1])
+    for t,(i,f) in enumerate(zip(inflow.tolist(),out_fraction.tolist())):
+        store += i
+        d_store = d_store + d_inflow[t]
+        load = store*f
+        d_load = d_store*f + store*d_out_fraction[t]
+        if store - load > 0.0:
+            d_store = d_store - d_load
+        else:
+            d_store = np.zeros_like(d_store)
+        store = max(0.0,store - load)
+        processed[t] = load
+        stores[t] = store
+        d_processed[t] = d_load
+    return processed, stores, store, d_processed
+
+def route_links(order,upstream,local_inflow,out_fraction,initial_store,splits,external_inflow=None,
+                d_local_inflow=None,d_out_fraction=None):
+    '''
+    Route a set of links in topological order.
+
+    order: link ids, upstream before downstream
+    upstream: dictionary of link id -> upstream link ids
+    local_inflow: dictionary of link id -> inflow mass per timestep (catchment,
+                  additional inflow and bank erosion)
+    out_fraction: dictionary of link id -> ConstituentOutFraction per timestep
+    initial_store: dictionary of link id -> initial LinkStore
+    splits: dictionary of link id -> number of downstream links
+    external_inflow: dictionary of link id -> processed load of upstream links
+                     routed elsewhere (eg in another process)
+    d_local_inflow, d_out_fraction: optional dictionaries of link id -> sensitivities of
+                     local inflow and ConstituentOutFraction (time x parameter)
+
+    Returns dictionary of link id -> (ProcessedLoad, LinkStore, final LinkStore), with
+    the sensitivities of ProcessedLoad appended if d_local_inflow is given
+    '''
+    external_inflow = external_inflow or {}
+    result = {}
+    for link in order:
+        inflow = local_inflow[link].copy()
+        d_inflow = None if d_local_inflow is None else d_local_inflow[link].copy()
+        for up in upstream.get(link,[]):
+            upstream_load = result[up][0] if up in result else external_inflow[up]
+            inflow += upstream_load / max(1,splits[up])
+            if d_inflow is not None:
+                d_inflow += result[up][3] / max(1,splits[up])
+        if d_inflow is None:
+            result[link] = route_link(inflow,out_fraction[link],initial_store[link])
+        else:
+            result[link] = route_link(inflow,out_fraction[link],initial_store[link],d_inflow,d_out_fraction[link])
+    return result
+
+def _route_job(args):
+    return route_links(*args)
+
+class InstreamRouting(object):
+    '''
+    Array based implementation of InstreamCLOEModel over a node-link network.
+
+    network_df: network as a DataFrame, as returned by network().as_dataframe() from Veneer
+    '''
+    def __init__(self,network_df):
+        links = network_df[network_df['feature_type']=='link']
+        catchments = network_df[network_df['feature_type']=='catchment']
+
+        self.link_ids = list(links['id'])
+        self.link_names = dict(zip(links['id'],links['name']))
+        self.n_links = len(self.link_ids)
+        self._link_index = {l:i for i,l in enumerate(self.link_ids)}
+        self.catchment_links = dict(zip(catchments['name'],catchments['link']))
+
+        links_by_from_node = {}
+        for link,from_node in zip(links['id'],links['from_node']):
+            links_by_from_node.setdefault(from_node,[]).append(link)
+        self.downstream = {link:links_by_from_node.get(to_node,[]) for link,to_node in zip(links['id'],links['to_node'])}
+        self.upstream = {link:[] for link in self.link_ids}
+        for link,downstream in self.downstream.items():
+            for ds in downstream:
+                self.upstream[ds].append(link)
+
+        self.order = self._topological_order()
+        self.parameters = {}
+        self.link_store = None
+
+    @staticmethod
+    def from_setup(setup):
+        return InstreamRouting(setup.network_df)
+
+    def _topological_order(self):
+        remaining = {link:len(up) for link,up in self.upstream.items()}
+        ready = [link for link in self.link_ids if remaining[link]==0]
+        order = []
+        while len(ready):
+            link = ready.pop()
+            order.append(link)
+            for ds in self.downstream[link]:
+                remaining[ds] -= 1
+                if remaining[ds]==0:
+                    ready.append(ds)
+        if len(order) != self.n_links:
+            raise ValueError('Link network contains a cycle')
+        return order
+
+    def _match(self,links=None):
+        if links is None:
+            return np.arange(self.n_links)
+        names = set(_stringToList(links))
+        return np.array([i for i,l in enumerate(self.link_ids) if self.link_names[l] in names],dtype=int)
+
+    def set_param_values(self,parameter,values,fromList=False,links=None):
+        ix = self._match(links)
+        if parameter not in self.parameters:
+            self.parameters[parameter] = np.full(self.n_links,DEFAULTS.get(parameter,0.0))
+        if fromList:
+            values = np.resize(np.asarray(values,dtype='f8'),len(ix))
+        self.parameters[parameter][ix] = values
+
+    def _parameter(self,parameter):
+        if parameter in self.parameters:
+            return self.parameters[parameter]
+        return np.full(self.n_links,DEFAULTS.get(parameter,0.0))
+
+    def reset(self):
+        self.link_store = self._parameter('InitialLinkStore').astype('f8').copy()
+
+    def _link_series(self,data,dates,default=0.0):
+        '''
+        Align a DataFrame (time x link name), Series or scalar to dates x links
+        '''
+        if data is None:
+            return np.full((len(dates),self.n_links),default)
+        if not isinstance(data,pd.DataFrame):
+            return np.broadcast_to(np.asarray(data,dtype='f8'),(len(dates),self.n_links))
+        columns = [self.link_names[l] for l in self.link_ids]
+        return data.reindex(index=dates,columns=columns).fillna(default).values
+
+    def _catchment_inflow(self,catchment_loads,timestep):
+        result = np.zeros((len(catchment_loads),self.n_links))
+        for catchment in catchment_loads.columns:
+            link = self.catchment_links.get(catchment)
+            if link is None:
+                continue
+            result[:,self._link_index[link]] += catchment_loads[catchment].values
+        return result * timestep
+
+    def partition(self,n_jobs):
+        '''
+        Split the network into independent upstream subtrees, each routed as a separate
+        job, plus the trunk of links downstream of them.
+
+        Returns (list of job link orders, trunk link order)
+        '''
+        size = {}
+        for link in self.order:
+            size[link] = 1 + sum(size[up] for up in self.upstream[link])
+        limit = max(1,int(math.ceil(self.n_links / n_jobs)))
+
+        roots = {link for link in self.link_ids if size[link] <= limit and not len(self.downstream[link])}
+        trunk = set()
+        for link in self.order:
+            if size[link] > limit:
+                trunk.add(link)
+                roots.update(up for up in self.upstream[link] if size[up] <= limit)
+
+        job_of = {}
+        for link in reversed(self.order):
+            if link in roots:
+                job_of[link] = link
+            elif link not in trunk:
+                job_of[link] = job_of[self.downstream[link][0]]
+        jobs = {}
+        for link in self.order:
+            if link in job_of:
+                jobs.setdefault(job_of[link],[]).append(link)
+        return list(jobs.values()), [l for l in self.order if l in trunk]
+
+    def route(self,catchment_loads,downstream_flow_volume=None,bank_erosion_rate=None,
+              additional_inflow=None,timestep=86400.0,workers=None,reset=True,
+              sensitivities=None,load_sensitivities=None):
+        '''
+        Route catchment loads through the network.
+
+        catchment_loads: DataFrame of time x catchment name, in kg/s
+        downstream_flow_volume: DataFrame of time x link name (or scalar), in m^3
+        bank_erosion_rate: DataFrame of time x link name (or scalar), in kg/timestep
+        additional_inflow: DataFrame of time x link name (or scalar), in kg/timestep
+        workers: Number of processes used to route independent subtrees. If None,
+                 route in this process. Networks with divergent links (more than
+                 one downstream link from a node), and routing with sensitivities,
+                 are always routed in this process
+        sensitivities: parameters of ConstituentOutFraction (see SENSITIVITY_PARAMETERS)
+                 to calculate sensitivities to, with the parameter applied to every link
+        load_sensitivities: dictionary of parameter -> sensitivity of catchment_loads to
+                 that parameter (DataFrame of time x catchment name, in kg/s, eg from
+                 CloeResults.catchment_load_sensitivity)
+
+        Returns a dictionary with ProcessedLoad (kg/timestep) and LinkStore (kg), each
+        as a DataFrame of time x link name. If sensitivities or load_sensitivities are
+        given, it also holds 'ProcessedLoad sensitivities': a dictionary of parameter ->
+        DataFrame of time x link name (kg/timestep)
+        '''
+        dates = catchment_loads.index
+        if reset or self.link_store is None:
+            self.reset()
+
+        sensitivities = list(sensitivities or [])
+        load_sensitivities = load_sensitivities or {}
+        for p in sensitivities:
+            if p not in SENSITIVITY_PARAMETERS:
+                raise ValueError('Sensitivities not supported for %s'%p)
+        sensitivity_names = sensitivities + [p for p in load_sensitivities if p not in sensitivities]
+
+        values = {p:self._parameter(p) for p in DEFAULTS}
+        flow = self._link_series(downstream_flow_volume,dates)
+        local = self._catchment_inflow(catchment_loads,timestep)
+        local = local + self._link_series(additional_inflow,dates)
+        local = local + bank_erosion(values,self._link_series(bank_erosion_rate,dates))
+
+        local_inflow = {l:local[:,i] for i,l in enumerate(self.link_ids)}
+        out_fraction = {}
+        for i,l in enumerate(self.link_ids):
+            link_values = {p:v[i] for p,v in values.items()}
+            out_fraction[l] = np.broadcast_to(constituent_out_fraction(link_values,flow[:,i]),(len(dates),))
+        initial = dict(zip(self.link_ids,self.link_store.tolist()))
+        splits = {l:len(ds) for l,ds in self.downstream.items()}
+        divergent = any(n > 1 for n in splits.values())
+
+        if len(sensitivity_names):
+            d_local = np.zeros((len(dates),self.n_links,len(sensitivity_names)))
+            for j,p in enumerate(sensitivity_names):
+                if p in load_sensitivities:
+                    d_local[:,:,j] = self._catchment_inflow(load_sensitivities[p].reindex(dates).fillna(0.0),timestep)
+            d_local_inflow = {l:d_local[:,i] for i,l in enumerate(self.link_ids)}
+            d_out_fraction = {}
+            for i,l in enumerate(self.link_ids):
+                link_values = {p:v[i] for p,v in values.items()}
+                d = np.zeros((len(dates),len(sensitivity_names)))
+                d[:,:len(sensitivities)] = out_fraction_sensitivity(link_values,flow[:,i],sensitivities)
+                d_out_fraction[l] = d
+            routed = route_links(self.order,self.upstream,local_inflow,out_fraction,initial,splits,
+                                 d_local_inflow=d_local_inflow,d_out_fraction=d_out_fraction)
+        elif workers is None or workers <= 1 or divergent:
+            routed = route_links(self.order,self.upstream,local_inflow,out_fraction,initial,splits)
+        else:
+            job_orders, trunk = self.partition(workers*4)
+            def job_args(order):
+                return (order,
+                        {l:self.upstream[l] for l in order},
+                        {l:local_inflow[l] for l in order},
+                        {l:out_fraction[l] for l in order},
+                        {l:initial[l] for l in order},
+                        {l:splits[l] for l in order})
+            routed = {}
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for result in pool.map(_route_job,[job_args(order) for order in job_orders]):
+                    routed.update(result)
+            external = {l:r[0] for l,r in routed.items()}
+            routed.update(route_links(trunk,self.upstream,local_inflow,out_fraction,initial,splits,external))
+
+        self.link_store = np.array([routed[l][2] for l in self.link_ids])
+        columns = [self.link_names[l] for l in self.link_ids]
+        result = {
+            'ProcessedLoad':pd.DataFrame(np.column_stack([routed[l][0] for l in self.link_ids]),index=dates,columns=columns),
+            'LinkStore':pd.DataFrame(np.column_stack([routed[l][1] for l in self.link_ids]),index=dates,columns=columns)
+        }
+        if len(sensitivity_names):
+            result['ProcessedLoad sensitivities'] = {
+                p:pd.DataFrame(np.column_stack([routed[l][3][:,j] for l in self.link_ids]),index=dates,columns=columns)
+                for j,p in enumerate(sensitivity_names)}
+        return result
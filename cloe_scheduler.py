@@ -0,0 +1,244 @@
+'''
+Running many CLOE scenarios across a pool of Veneer endpoints.
+
+Each scenario is a change to the parameters of the base model, given in the
+same form as the fixed and scalar parameters of a CloeSetup configuration:
+
+    scenarios = [
+        {'name':'baseline'},
+        {'name':'reduced_fertiliser','parameters':{
+            'scalar':[{'match':{'fus':'Cropping'},'parameters':{'M3':0.5}}]
+        }},
+        {'name':'riparian','parameters':{'fixed':{'Dsurf':0.3}}}
+    ]
+    endpoints = [lambda port=port: veneer.Veneer(port) for port in range(9876,9880)]
+    scheduler = ScenarioScheduler(endpoints,'scenario_results',constituents=['TP','TN'])
+    store = scheduler.run(scenarios)
+    quickflow = store.read('quickflow@TP')
+
+Each endpoint (a Source instance running the base model, with the CLOE
+recorders enabled) has a worker thread, taking the next pending scenario,
+applying its parameters, running the model and retrieving the results through
+CloeScenario. The parameters are then restored to their previous values, ready
+for the next scenario. Results are gathered in a ScenarioStore (see cloe_cache).
+
+A scenario that fails is retried (on whichever endpoint is next free) up to a
+given number of times. Endpoints given as functions are called again to
+reconnect after a failure. An endpoint that can't be restored to the base
+model after a failure, or that fails repeatedly, is retired. Re-running the
+scheduler with the same store skips completed scenarios.
+'''
+import logging
+import queue
+import threading
+import time
+
+from cloe_cache import ScenarioStore
+from cloe_setup import CloeScenario
+
+logger = logging.getLogger(__name__)
+
+# Results retrieved for each scenario and constituent, as name -> CloeScenario method
+DEFAULT_RETRIEVALS={
+    'quickflow':'retrieve_quickflow_flux',
+    'slowflow':'retrieve_slowflow_flux'
+}
+
+class RestoreError(RuntimeError):
+    '''
+    Parameters couldn't be restored after a scenario, leaving the endpoint's model modified
+    '''
+    pass
+
+def parameter_changes(parameters):
+    '''
+    List of (parameter, value, constraint) from the parameters of a scenario, given in
+    the same form as the fixed and scalar parameters of a CloeSetup configuration
+    '''
+    changes = [(p,v,{}) for p,v in parameters.get('fixed',{}).items()]
+    for scalar in parameters.get('scalar',[]):
+        matches = scalar.get('match',{})
+        changes += [(p,v,matches) for p,v in scalar.get('parameters',{}).items()]
+    return changes
+
+def apply_changes(target,changes):
+    '''
+    Apply parameter changes to target (eg model.catchment.generation), returning the
+    changes that restore the previous values, in the order they should be applied.
+
+    If a change fails, the changes already made are rolled back before raising. Raises
+    RestoreError if the rollback fails, as the target is then left partly modified.
+    '''
+    restore = []
+    try:
+        for p,v,constraint in changes:
+            previous = target.get_param_values(p,**constraint)
+            restore.append((p,previous,constraint))
+            target.set_param_values(p,v,**constraint)
+    except:
+        try:
+            restore_changes(target,restore[::-1])
+        except Exception as e:
+            raise RestoreError('Unable to restore parameters after failing to apply changes: %s'%e)
+        raise
+    return restore[::-1]
+
+def restore_changes(target,restore):
+    for p,values,constraint in restore:
+        target.set_param_values(p,values,fromList=True,**constraint)
+
+def run_id(response):
+    '''
+    Run number from the response to run_model (status, location of the run), or 'latest'
+    '''
+    try:
+        return int(str(response[1]).rstrip('/').split('/')[-1])
+    except (TypeError,ValueError,IndexError):
+        return 'latest'
+
+class _Endpoint(object):
+    def __init__(self,endpoint,index):
+        self.endpoint = endpoint
+        self.index = index
+        self.scenario = None
+        self.failures = 0
+
+    def connect(self):
+        client = self.endpoint() if callable(self.endpoint) else self.endpoint
+        self.scenario = CloeScenario(client)
+
+    def reconnect(self):
+        if callable(self.endpoint) or self.scenario is None:
+            self.connect()
+
+class ScenarioScheduler(object):
+    '''
+    Run scenarios across a pool of Veneer endpoints.
+
+    endpoints: Veneer clients, or functions returning one
+    store: ScenarioStore, or directory for one
+    constituents: constituents retrieved for each scenario
+    retrievals: dictionary of result name -> CloeScenario method (or function of
+                (CloeScenario, constituent, run, run_data)) returning a DataFrame.
+                Results are stored as <name>@<constituent>
+    retries: number of times a failed scenario is retried
+    max_failures: consecutive failures after which an endpoint is retired
+    run_params: keyword arguments to run_model (eg start, end)
+    '''
+    def __init__(self,endpoints,store,constituents=['TP'],retrievals=DEFAULT_RETRIEVALS,
+                 retries=2,max_failures=3,run_params=None):
+        self.endpoints = [_Endpoint(e,i) for i,e in enumerate(endpoints)]
+        if isinstance(store,str):
+            store = ScenarioStore(store)
+        self.store = store
+        self.constituents = list(constituents)
+        self.retrievals = dict(retrievals)
+        self.retries = retries
+        self.max_failures = max_failures
+        self.run_params = run_params or {}
+
+    def run_scenario(self,cloe_scenario,scenario):
+        '''
+        Apply one scenario's parameters on the endpoint of cloe_scenario, run the model
+        and retrieve the results, then restore the parameters.
+
+        Returns a dictionary of result name -> DataFrame
+        '''
+        target = cloe_scenario._v.model.catchment.generation
+        restore = apply_changes(target,parameter_changes(scenario.get('parameters',{})))
+        try:
+            run = run_id(cloe_scenario._v.run_model(**self.run_params))
+            run_data = cloe_scenario._v.retrieve_run(run)
+            results = {}
+            for name,retrieval in self.retrievals.items():
+                for constituent in self.constituents:
+                    if callable(retrieval):
+                        df = retrieval(cloe_scenario,constituent,run,run_data)
+                    else:
+                        df = getattr(cloe_scenario,retrieval)(constituent,run,run_data)
+                    results['%s@%s'%(name,constituent)] = df
+        finally:
+            try:
+                restore_changes(target,restore)
+            except Exception as e:
+                raise RestoreError('Unable to restore parameters after scenario %s: %s'%(scenario['name'],e))
+        return results
+
+    def _work(self,endpoint,pending,attempts,remaining):
+        while True:
+            try:
+                scenario = pending.get_nowait()
+            except queue.Empty:
+                if remaining.wait(0.1):
+                    return
+                continue
+            name = scenario['name']
+            attempts[name] += 1
+            start = time.perf_counter()
+            try:
+                if endpoint.scenario is None:
+                    endpoint.connect()
+                results = self.run_scenario(endpoint.scenario,scenario)
+            except Exception as e:
+                endpoint.failures += 1
+                logger.warning('Scenario %s failed on endpoint %d (attempt %d): %s',name,endpoint.index,attempts[name],e)
+                if attempts[name] <= self.retries:
+                    pending.put(scenario)
+                else:
+                    self.store.fail(name,endpoint=endpoint.index,attempts=attempts[name],error=str(e))
+                    self._finish(remaining)
+                if isinstance(e,RestoreError):
+                    logger.error('Retiring endpoint %d: model no longer matches the base model',endpoint.index)
+                    return
+                if endpoint.failures >= self.max_failures:
+                    logger.error('Retiring endpoint %d after %d consecutive failures',endpoint.index,endpoint.failures)
+                    return
+                try:
+                    endpoint.reconnect()
+                except Exception as e:
+                    logger.error('Retiring endpoint %d: unable to reconnect (%s)',endpoint.index,e)
+                    return
+                continue
+
+            endpoint.failures = 0
+            duration = time.perf_counter() - start
+            self.store.put(name,results,endpoint=endpoint.index,attempts=attempts[name],duration=duration)
+            logger.info('Scenario %s complete on endpoint %d (%.1fs)',name,endpoint.index,duration)
+            self._finish(remaining)
+
+    def _finish(self,remaining):
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining == 0:
+                remaining.set()
+
+    def run(self,scenarios):
+        '''
+        Run each scenario not already complete in the store, returning the store.
+        '''
+        names = [s['name'] for s in scenarios]
+        if len(set(names)) != len(names):
+            raise ValueError('Scenario names must be unique')
+        done = self.store.completed()
+        pending = queue.Queue()
+        for s in scenarios:
+            if s['name'] not in done:
+                pending.put(s)
+        logger.info('Running %d of %d scenarios (%d already complete) on %d endpoints',
+                    pending.qsize(),len(scenarios),len(done & set(names)),len(self.endpoints))
+        if pending.empty():
+            return self.store
+
+        attempts = {s['name']:0 for s in scenarios}
+        self._lock = threading.Lock()
+        self._remaining = pending.qsize()
+        remaining = threading.Event()
+        workers = [threading.Thread(target=self._work,args=(e,pending,attempts,remaining),daemon=True)
+                   for e in self.endpoints]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if not remaining.is_set():
+            logger.error('All endpoints retired with %d scenarios incomplete',self._remaining)
+        return self.store
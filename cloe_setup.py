@@ -1,18 +1,49 @@
 import json
+import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+import numpy as np
 import pandas as pd
 import string
 
 from pandas.core.algorithms import isin
 from veneer import read_rescsv
 from veneer.utils import _stringToList
+from cloe_cache import InputCache, ChunkStore, HashManifest, ResultCache, frame_hash
+from cloe_plan import Planner
+from cloe_pipeline import Pipeline
+from cloe_metadata import MetadataCache
+from cloe_trace import Tracer, TracingClient, traced
+
+logger = logging.getLogger(__name__)
 
 MODEL_NAMES={
     'areal':'Source.CLOE.ArealCLOEModel',
     'non_areal':'Source.CLOE.NonArealCLOEModel'
 }
 
+# Format of inputs as returned by load_input (and held in an InputCache). Increment when
+# transform_df or compact change
+INPUT_FORMAT=2
+
+# Maximum number of columns uploaded in a single data source, if inputs.upload_chunk_columns
+# isn't set. Larger data sources are split into parts. None: don't split
+DEFAULT_UPLOAD_COLUMNS=None
+
+# CLOE variables retrieved by CloeScenario, as the RecordingVariable pattern for a constituent
+MODEL_VARIABLES=['SoilStore','GroundwaterStore','LossToGroundwater','LossOut$','LossOutGroundwater']
+FLUX_VARIABLES=['Quick Flow Load Out','Slow Flow Load Out']
+
+# Position of each constraint within the names enumerated for generation models
+ELEMENT_POSITIONS={
+    'catchments':0,
+    'fus':1,
+    'constituents':2,
+    'sources':3
+}
+
 def model_name(nm):
     return MODEL_NAMES.get(nm,nm)
 
@@ -20,16 +51,16 @@ def _read_csv(fn: str) -> pd.DataFrame:
     if fn.endswith('.res.csv'):
         _, data = read_rescsv(fn,['Name'])
         return data.reset_index()
-    try:
+    header = pd.read_csv(fn,nrows=0)
+    if 'Date' in header.columns:
         return pd.read_csv(fn,parse_dates=['Date'],dayfirst=True)
-    except:
-        return pd.read_csv(fn,parse_dates=True,dayfirst=True)
+    return pd.read_csv(fn,parse_dates=True,dayfirst=True)
 
 def read_csv(fn: str) -> pd.DataFrame:
     try:
         return _read_csv(fn)
     except:
-        print(f'Error reading CSV data from {fn}')
+        logger.error(f'Error reading CSV data from {fn}')
         raise
 
 def first_match(values,options):
@@ -39,13 +70,78 @@ def first_match(values,options):
     return None
 
 def transform_df(df,k):
+    '''
+    Add a categorical location (<catchment>:<fu>) column to long format inputs.
+
+    Modifies df (a newly read input) in place. Locations are built from the distinct
+    catchment/FU pairs rather than row by row.
+    '''
     if k in 'clover dairyshed feed septic fertiliser'.split(' '):
         catch_col = first_match(df.columns,['SourceName','cmt'])
         fu_col = first_match(df.columns,['Source_FU','FU'])
-        df = df.copy()
-        df['location'] = df[catch_col] + ':' + df[fu_col]
+        codes, pairs = pd.MultiIndex.from_arrays([df[catch_col],df[fu_col]]).factorize()
+        df['location'] = pd.Categorical.from_codes(codes,['%s:%s'%pair for pair in pairs])
     return df
 
+def compact(df,float32=False):
+    '''
+    Reduce the memory used by an input, in place: text columns with repeated values
+    become categorical and, if float32, float64 columns of time series inputs (with a
+    Date column) become float32. Non-temporal inputs (eg spatial parameter values) are
+    kept at full precision.
+    '''
+    float32 = float32 and 'Date' in df.columns
+    for col in df.columns:
+        if col == 'Date':
+            continue
+        series = df[col]
+        if isinstance(series.dtype,pd.CategoricalDtype):
+            continue
+        if float32 and series.dtype == 'float64':
+            df[col] = series.astype('float32')
+        elif pd.api.types.is_string_dtype(series) and series.nunique() <= len(series)//2:
+            df[col] = series.astype('category')
+    return df
+
+def load_input(k,fn,cache=None,float32=False):
+    cache_name = k + '_float32' if float32 else k
+    if cache is not None:
+        df = cache.get(cache_name,fn)
+        if df is not None:
+            return df
+    df = compact(transform_df(read_csv(fn),k),float32)
+    if cache is not None:
+        cache.put(cache_name,fn,df)
+    return df
+
+def first_match_values(actions,elements,default):
+    '''
+    For each (catchment,fu) in elements, find the value of the first action (value,matches)
+    that matches it on catchments and fus (where given), or default if none match.
+    '''
+    both = {}
+    by_catchment = {}
+    by_fu = {}
+    anything = None
+    for ix,(val,matches) in enumerate(actions):
+        entry = (ix,val)
+        sc = matches.get('catchments',None)
+        fu = matches.get('fus',None)
+        if sc is not None and fu is not None:
+            both.setdefault((sc,fu),entry)
+        elif sc is not None:
+            by_catchment.setdefault(sc,entry)
+        elif fu is not None:
+            by_fu.setdefault(fu,entry)
+        elif anything is None:
+            anything = entry
+
+    result = []
+    for sc,fu in elements:
+        candidates = [e for e in (both.get((sc,fu)),by_catchment.get(sc),by_fu.get(fu),anything) if e is not None]
+        result.append(min(candidates)[1] if len(candidates) else default)
+    return result
+
 def custom_name(rec):
     sc = rec['NetworkElement']
     fu = rec['FunctionalUnit']
@@ -54,16 +150,53 @@ def custom_name(rec):
     return '%s@%s@@%s'%(sc,fu,src)
 
 class CloeSetup(object):
-    def __init__(self,fn,veneer):
+    def __init__(self,fn,veneer,batch_time_series=False,tracer=None):
+        '''
+        fn: configuration (JSON) filename
+        veneer: Veneer client
+        batch_time_series: assign time series with as few calls as possible
+        tracer: Tracer recording each stage (see cloe_trace). A new Tracer is created if None
+        '''
         self.cfg = json.load(open(fn,'r'))
+        self.config_fn = fn
+        self.batch_time_series = batch_time_series
 
         self._find_sources()
        
-        self._v = veneer
+        self.tracer = tracer or Tracer()
+        self._v = TracingClient(veneer,self.tracer)
+        self._metadata = None
+        self.data_source_parts = {}
+        self.deduplicate_uploads = True
         self._query_network()
 
-    def apply(self):
+    @property
+    def metadata(self):
+        '''
+        MetadataCache for the current Veneer client
+        '''
+        if self._metadata is None or self._metadata.client is not self._v:
+            self._metadata = MetadataCache(self._v)
+        return self._metadata
+
+    @traced('setup')
+    def apply(self,incremental=False,state_fn=None,workers=None):
+        '''
+        Apply the configuration to the model.
+
+        If incremental, only send the operations that differ from those last applied
+        (recorded in state_fn, default <config>.state.json). See cloe_plan.
+
+        If workers is given, send independent operations concurrently, with up to workers
+        requests in flight. See cloe_pipeline.
+        '''
         self.load_inputs()
+        pipeline = Pipeline(self,workers) if workers else None
+        if incremental:
+            return self.planner(state_fn).apply(pipeline=pipeline)
+        if pipeline is not None:
+            return pipeline.apply()
+
         self.create_constituents()
         self.create_constituent_sources()
         self.install_models()
@@ -73,6 +206,11 @@ class CloeSetup(object):
         self.connect_time_series()
         self.setup_functions()
 
+    def planner(self,state_fn=None):
+        if state_fn is None:
+            state_fn = os.path.splitext(self.config_fn)[0] + '.state.json'
+        return Planner(self,state_fn)
+
     def _find_sources(self):
         cfg = self.cfg['sources']
         self.areal_sources = cfg['areal']
@@ -86,43 +224,110 @@ class CloeSetup(object):
     def _query_network(self):
         network = self._v.network()
         network_df = network.as_dataframe()
+        self.network_df = network_df
         catchments = network_df[network_df['feature_type']=='catchment']
         self.catchment_names = list(catchments.name)
         self.fus = list(set(self._v.model.catchment.get_functional_unit_types()))
 
+    def referenced_inputs(self):
+        '''
+        Names of the input files referenced by the configuration
+        '''
+        inputs_cfg = self.cfg['inputs']
+        result = set(inputs_cfg.get('source',{}).values())
+        result = result.union(inputs_cfg.get('column_formats',{}).keys())
+        for lookup in inputs_cfg.get('columns',{}).values():
+            result = result.union(lookup.keys())
+
+        constrained = inputs_cfg.get('existing',None) or inputs_cfg.get('constrained',None) or {}
+        data_sources = [ts['source'] for ts in inputs_cfg.get('global',[])]
+        for configs in constrained.values():
+            if isinstance(configs,dict):
+                configs = [configs]
+            data_sources += [c['datasource'] for c in configs]
+        # Constituent specific data sources are named <constituent>:<input>
+        result = result.union(ds.split(':')[-1] for ds in data_sources)
+
+        result = result.union(sp['input'] for sp in self.cfg.get('parameters',{}).get('spatial',[]))
+        for fn in self.cfg.get('runoff_functions',[]):
+            result = result.union(dp['input'] for dp in fn.get('data_variables',[]))
+        return result
+
+    @traced('setup')
     def load_inputs(self):
         '''
         Find all CSV files in the working directory and load,
         identifying temporal and non-temporal input files.
+
+        Only files referenced by the configuration are loaded, unless inputs.load_all is set.
+        Files are parsed in parallel (inputs.workers threads) and, if inputs.cache
+        is set, parsed files are cached in that directory.
+
+        Text columns are stored as categoricals and, if inputs.float32 is set, time series
+        values as float32 (see compact).
         '''
-        folder = self.cfg['inputs']['dir']
+        inputs_cfg = self.cfg['inputs']
+        folder = inputs_cfg['dir']
         files = glob(os.path.join(folder,'*.csv'))
-        file_lookup = {fn.split('\\')[-1].split('.')[0]:fn for fn in files}
-        if self.cfg['inputs']['ignore']:
-            file_lookup = {k:fn for k,fn in file_lookup.items() if k not in self.cfg['inputs']['ignore']}
-        inputs = {k:read_csv(fn) for k,fn in file_lookup.items()}
-        self.inputs = {k:transform_df(df,k) for k,df in inputs.items()}
+        file_lookup = {os.path.basename(fn.replace('\\','/')).split('.')[0]:fn for fn in files}
+        if inputs_cfg['ignore']:
+            file_lookup = {k:fn for k,fn in file_lookup.items() if k not in inputs_cfg['ignore']}
+        if not inputs_cfg.get('load_all',False):
+            referenced = self.referenced_inputs()
+            file_lookup = {k:fn for k,fn in file_lookup.items() if k in referenced}
+
+        cache = None
+        if inputs_cfg.get('cache',None):
+            cache = InputCache(inputs_cfg['cache'],INPUT_FORMAT)
+        self.input_files = file_lookup
+        self._input_cache = cache
+        keys = list(file_lookup.keys())
+        float32 = [inputs_cfg.get('float32',False)]*len(keys)
+        with ThreadPoolExecutor(inputs_cfg.get('workers',None)) as pool:
+            loaded = pool.map(load_input,keys,[file_lookup[k] for k in keys],[cache]*len(keys),float32)
+            self.inputs = dict(zip(keys,loaded))
+        self.tracer.record(rows=sum(len(df) for df in self.inputs.values()),
+                           columns=sum(len(df.columns) for df in self.inputs.values()))
         self.temporal_inputs = [k for k,df in self.inputs.items() if 'Date' in df.columns]
         self.non_temporal_inputs = [k for k,df in self.inputs.items() if 'Date' not in df.columns]
 
+    def input(self,name):
+        '''
+        Input DataFrame, re-loading it if it has been released (see create_data_sources)
+        '''
+        if name not in self.inputs:
+            self.inputs[name] = load_input(name,self.input_files[name],self._input_cache,
+                                           self.cfg['inputs'].get('float32',False))
+        return self.inputs[name]
+
+    def release_inputs(self,names):
+        '''
+        Drop inputs from memory. Released inputs are re-loaded from file on next use.
+        '''
+        for name in names:
+            self.inputs.pop(name,None)
+
+    @traced('setup')
     def create_constituents(self):
         for c in self.constituents:
             self._v.model.add_constituent(c)
 
+    @traced('setup')
     def create_constituent_sources(self):
         for src in self.constituent_sources:
             self._v.model.add_constituent_source(src)
 
+    @traced('setup')
     def install_models(self):
-        self._v.model.catchment.generation.set_models(model_name('areal'),
-                                                      sources=self.areal_sources,
-                                                      constituents=self.constituents)
-        self._v.model.catchment.generation.set_models(model_name('non_areal'),
-                                                      sources=self.non_areal_sources,
-                                                      constituents=self.constituents)
+        self.metadata.set_generation_models(model_name('areal'),
+                                            sources=self.areal_sources,
+                                            constituents=self.constituents)
+        self.metadata.set_generation_models(model_name('non_areal'),
+                                            sources=self.non_areal_sources,
+                                            constituents=self.constituents)
 
         for cond in self.conditional_sources:
-            self._v.model.catchment.generation.set_models(model_name(cond['model']),**cond['constrain'])
+            self.metadata.set_generation_models(model_name(cond['model']),**cond['constrain'])
 
         self._v.model.link.constituents.set_models('Source.CLOE.InstreamCLOEModel',constituents=self.constituents)
     
@@ -133,37 +338,142 @@ class CloeSetup(object):
                 return True
         return False
 
-    def create_data_sources(self):
+    def upload_manifest(self):
+        '''
+        HashManifest of the data sources uploaded to Source, stored in inputs.upload_manifest
+        (default <config>.data_sources.json, as for the state file). None if
+        inputs.upload_manifest is false.
+
+        The data sources in Source are re-queried each time, and entries for data sources
+        that Source no longer holds (eg after a restart) are dropped.
+        '''
+        fn = self.cfg['inputs'].get('upload_manifest',os.path.splitext(self.config_fn)[0] + '.data_sources.json')
+        if not fn:
+            return None
+        manifest = HashManifest(fn)
+        existing = self.metadata.data_source_columns(refresh=True)
+        manifest.discard([name for name in list(manifest.hashes) if name not in existing])
+        return manifest
+
+    @traced('setup')
+    def create_data_sources(self,target=None):
+        '''
+        Create a data source for each temporal input, pivoting constituent specific inputs.
+
+        Data sources are created in Source by default. Alternatively, pass a target
+        offering create_data_source, such as a CloeEngine.
+
+        When uploading to Source, if inputs.upload_chunk_columns is set, data sources with
+        more than that many columns are split into parts (<name>_0, <name>_1, ...), while
+        those that fit in one part keep their name. Data sources (or parts) that Source
+        already holds, with the same content hash, are not uploaded again. Once uploaded,
+        temporal inputs are released from memory, unless inputs.release is false.
+        '''
+        uploading = target is None
+        if target is None:
+            target = self.metadata
         column_formats = self.cfg['inputs']['column_formats']
         self.data_source_lookup = {}
+        self.data_source_parts = {}
+        manifest = None
+        chunk_columns = None
+        if uploading:
+            chunk_columns = self.cfg['inputs'].get('upload_chunk_columns',DEFAULT_UPLOAD_COLUMNS)
+            if self.deduplicate_uploads:
+                manifest = self.upload_manifest()
 
         # Load data sources
         for input_fn in self.temporal_inputs:
-            print(input_fn,end=' ')
-            df = self.inputs[input_fn]
+            df = self.input(input_fn)
             if not self._constituent_specific_config(input_fn):
                 #(input_fn not in TP_INPUTS) and (input_fn not in TN_INPUTS):
-                print("Don't need to pivot. Load as is")
+                logger.info("%s: Don't need to pivot. Load as is",input_fn)
                 df = df.set_index('Date')
-                self._v.create_data_source(input_fn,df,units='kg')
-                self.data_source_lookup[input_fn] = (input_fn,column_formats.get(input_fn,None),df)
+                self._create_data_source(target,input_fn,df,manifest,chunk_columns)
+                self.data_source_lookup[input_fn] = (input_fn,column_formats.get(input_fn,None),df.columns)
                 continue
 
-            print('Need to pivot')
+            logger.info('%s: Need to pivot',input_fn)
             column_cfg = self.cfg['inputs']['columns']
+            # Pivot all the value columns used by any constituent at once
+            value_columns = list(dict.fromkeys(lookup[input_fn] for lookup in column_cfg.values() if input_fn in lookup))
+            pivots = df.pivot(index='Date',columns='location',values=value_columns)
             for constituent,lookup in column_cfg.items():
                 #[('TP',TP_INPUTS),('TN',TN_INPUTS)]:
                 if input_fn not in lookup:
                     continue
-                pivot = df.pivot('Date','location',lookup[input_fn])
+                pivot = pivots[lookup[input_fn]]
+                pivot.columns = pd.Index(pivot.columns.astype(str),name='location')
                 data_source_name= '%s:%s'%(constituent,input_fn)
-                self._v.create_data_source(data_source_name,pivot,units='kg')
-                self.data_source_lookup[(input_fn,constituent)] = (data_source_name,'SC#${scix}:${fu}',pivot)
+                self._create_data_source(target,data_source_name,pivot,manifest,chunk_columns)
+                self.data_source_lookup[(input_fn,constituent)] = (data_source_name,'SC#${scix}:${fu}',pivot.columns)
+            del pivots
+
         # - do we need to scale by ha->m^2 -- NO. Model is in terms of per hectare...
+        if uploading and self.cfg['inputs'].get('release',True):
+            self.release_inputs(self.temporal_inputs)
+
+    def _create_data_source(self,target,name,df,manifest=None,chunk_columns=None,units='kg'):
+        '''
+        Create a data source, split into parts of at most chunk_columns columns.
+
+        Parts with the content hash recorded in manifest, which exist in Source with the
+        same columns, are skipped. Returns the number of parts uploaded.
+        '''
+        if not chunk_columns or len(df.columns) <= chunk_columns:
+            parts = [(name,df)]
+        else:
+            parts = [('%s_%d'%(name,i),df.iloc[:,start:start+chunk_columns])
+                     for i,start in enumerate(range(0,len(df.columns),chunk_columns))]
+            self.data_source_parts[name] = [(part_name,[str(c) for c in part.columns]) for part_name,part in parts]
+
+        if manifest is None:
+            for part_name,part in parts:
+                target.create_data_source(part_name,part,units=units)
+                self.tracer.record(rows=len(part),columns=len(part.columns))
+            return len(parts)
+
+        pending = self._stale_data_sources(parts,manifest,units)
+        if len(pending) < len(parts):
+            logger.info('%s: %d of %d parts unchanged',name,len(parts)-len(pending),len(parts))
+
+        # Forget the old content first, in case the upload fails part way through
+        manifest.discard([part_name for part_name,_,_ in pending])
+        manifest.save()
+        for part_name,part,content_hash in pending:
+            target.create_data_source(part_name,part,units=units)
+            self.tracer.record(rows=len(part),columns=len(part.columns))
+            manifest.set(part_name,content_hash)
+        manifest.save()
+        return len(pending)
+
+    def _stale_data_sources(self,data_sources,manifest,units='kg'):
+        '''
+        (name,data,content hash) for each of data_sources (name,data) that Source doesn't
+        already hold, according to manifest
+        '''
+        existing = self.metadata.data_source_columns()
+        result = []
+        for name,df in data_sources:
+            content_hash = frame_hash(df,units)
+            if manifest.get(name)==content_hash and existing.get(name,None)==[str(c) for c in df.columns]:
+                continue
+            result.append((name,df,content_hash))
+        return result
+
+    def _data_source_part(self,data_source,column):
+        '''
+        Name of the data source (or part of a split data source) holding column
+        '''
+        for part_name,columns in self.data_source_parts.get(data_source,[]):
+            if column in columns:
+                return part_name
+        return data_source
     
     def map_model_data_sources(self):
-        data_sources = self._v.data_sources()
-        self.existing_data_sources = {ds['Name']:[i['Name'] for i in ds['Items'][0]['Details']] for ds in data_sources}
+        self.existing_data_sources = dict(self.metadata.data_source_columns())
+        for name,parts in self.data_source_parts.items():
+            self.existing_data_sources[name] = [c for _,columns in parts for c in columns]
 
     def _apply_time_series(self,
                            data_source,
@@ -172,51 +482,126 @@ class CloeSetup(object):
                            constituent,
                            columns,
                            fus=None,
-                           param='InputRate'):
+                           param='InputRate',
+                           target=None):
         if fus is not None:
             fus = _stringToList(fus)
-        skipped = 0
-        actioned = 0
         if columns is None:
             columns = self.existing_data_sources.get(data_source,None)
         if columns is None:
-            print("WARNING. We don't know anything about the columns in {data_source}".format(data_source=data_source))
-        skipped_columns = set()
+            logger.warning("We don't know anything about the columns in {data_source}".format(data_source=data_source))
+            columns = []
+
+        assignments, missing = self._resolve_time_series(template,constituent,columns,fus)
+        for column in sorted(missing):
+            logger.info('NO DATA: %s/%s',data_source,column)
+        skipped = len(self.catchment_names)*len(fus or self.fus) - len(assignments)
+
+        actioned = 0
+        for part_name,part_columns in self.data_source_parts.get(data_source,[(data_source,None)]):
+            part_assignments = assignments
+            if part_columns is not None:
+                part_columns = set(part_columns)
+                part_assignments = {e:c for e,c in assignments.items() if c in part_columns}
+            if self.batch_time_series:
+                actioned += self._assign_time_series_batch(param,part_name,part_assignments,constituent_source,constituent,fus,target)
+                continue
+            for (catchment,fu),column in part_assignments.items():
+                self._assign_time_series(param,column,part_name,target,
+                                         catchments=catchment,
+                                         fus=fu,
+                                         constituents=constituent,
+                                         sources=constituent_source)
+                actioned += 1
+        msg ='Applying timeseries from {datasource} to {constituent}/{source}. Applied {applied} and skipped {skipped}.'
+        logger.info(msg.format(datasource=data_source,constituent=constituent,source=constituent_source,applied=actioned,skipped=skipped))
+        self.tracer.record(columns=actioned)
+        return actioned, skipped
+
+    def _resolve_time_series(self,template,constituent,columns,fus=None):
+        '''
+        Resolve the data source column for every catchment/FU locally.
+
+        Returns a dictionary of (catchment,fu) -> column for those elements with
+        data, along with the set of columns that weren't found in the data source.
+        '''
+        template = string.Template(template)
+        columns = set(columns)
+        assignments = {}
+        missing = set()
         for catchment in self.catchment_names:
+            scix = catchment.split('#')[1]
             for fu in (fus or self.fus):
-                scix = catchment.split('#')[1]
-                column = string.Template(template).substitute(fu=fu,sc=catchment,scix=scix,con=constituent)
-                # msg = '%s:%s:%s:%s ==> %s/%s'%(catchment,fu,constituent_source,constituent,data_source,column)
-                if column not in columns:
-                    if column not in skipped_columns:
-                        print('NO DATA: %s/%s'%(data_source,column))
-                    skipped_columns = skipped_columns.union({column})
-                    skipped += 1
+                column = template.substitute(fu=fu,sc=catchment,scix=scix,con=constituent)
+                if column in columns:
+                    assignments[(catchment,fu)] = column
+                else:
+                    missing.add(column)
+        return assignments, missing
+
+    def _assign_time_series(self,param,values,data_source,target=None,**kwargs):
+        if target is None:
+            target = self._v.model.catchment.generation
+        try:
+            target.assign_time_series(param,values,data_source,**kwargs)
+        except:
+            details = ', '.join('%s=%s'%(k,v) for k,v in kwargs.items())
+            logger.error('Error assigning time series: column=%s, datasource=%s, %s',values,data_source,details)
+            raise
+
+    def _assign_time_series_batch(self,param,data_source,assignments,constituent_source,constituent,fus=None,target=None):
+        '''
+        Assign resolved columns using as few Veneer calls as possible.
+
+        Columns are passed as a list, aligned with the order in which Source
+        enumerates the matching elements. If every element has data, a single call
+        is made. Otherwise one call is made per FU, restricted to the catchments
+        with data.
+        '''
+        if not len(assignments):
+            return 0
+        constraint = dict(constituents=constituent,sources=constituent_source)
+        if fus is not None:
+            constraint['fus'] = fus
+        if target is None:
+            target = self._v.model.catchment.generation
+            names = self.metadata.generation_names(**constraint)
+        else:
+            names = target.enumerate_names(**constraint)
+        elements = [(n[0],n[1]) for n in names]
+
+        if all(e in assignments for e in elements):
+            groups = [(constraint,elements)]
+        else:
+            groups = []
+            for fu in sorted({fu for _,fu in assignments}):
+                fu_elements = [e for e in elements if e[1]==fu]
+                with_data = [e for e in fu_elements if e in assignments]
+                if not len(with_data):
                     continue
-                try:
-                    self._v.model.catchment.generation.assign_time_series(param,
-                                                                    column,
-                                                                    data_source,
-                                                                    catchments=catchment,
-                                                                    fus=fu,
-                                                                    constituents=constituent,
-                                                                    sources=constituent_source)
-                    actioned += 1
-                except:
-                    print('Error assigning time series')
-                    print('column=',column)
-                    print('datasource=',data_source)
-                    print('catchment=',catchment)
-                    print('fus=',fu)
-                    print('constituent=',constituent)
-                    print('source=',constituent_source)
-                    raise
-        msg ='Applying timeseries from {datasource} to {constituent}/{source}. Applied {applied} and skipped {skipped}.'
-        print(msg.format(datasource=data_source,constituent=constituent,source=constituent_source,applied=actioned,skipped=skipped))
-    #         break
+                group_constraint = dict(constraint,fus=fu)
+                if len(with_data) < len(fu_elements):
+                    group_constraint['catchments'] = list(dict.fromkeys(c for c,_ in with_data))
+                groups.append((group_constraint,with_data))
 
-    def connect_time_series(self):
-        self.map_model_data_sources()
+        actioned = 0
+        for group_constraint,group in groups:
+            columns = [assignments[e] for e in group]
+            self._assign_time_series(param,columns,data_source,target,from_list=True,**group_constraint)
+            actioned += len(set(group))
+        return actioned
+
+    @traced('setup')
+    def connect_time_series(self,target=None):
+        '''
+        Connect input time series to the generation models in Source or, if provided,
+        to an alternative target such as a CloeEngine.
+        '''
+        if target is None:
+            target = self._v.model.catchment.generation
+            self.map_model_data_sources()
+        else:
+            self.existing_data_sources = target.data_source_columns()
         # constituent_cfg = self.cfg['inputs'].get('columns',{})
         exclusions = self.cfg['sources']['constituents']
         global_sources = self.cfg['inputs']['source']
@@ -224,32 +609,32 @@ class CloeSetup(object):
         if constrained_sources is None:
             constrained_sources = self.cfg['inputs'].get('constrained',None)
 
-        self._v.model.catchment.generation.clear_time_series('InputRate')
+        target.clear_time_series('InputRate')
+        self.time_series_summary = {'applied':0,'skipped':0}
         for con_src in self.constituent_sources:
         #     print(src)
             for con in self.constituents:
             # for con, custom_sources in exclusions.items():
                 if con_src in exclusions.get(con,{}).get('exclude',[]):
-                    print('SKIPPING %s:%s - exclude list'%(con_src,con))
+                    logger.info('SKIPPING %s:%s - exclude list',con_src,con)
                     continue
 
                 if con_src in global_sources:
                     # Default treatment. Apply data source to all FUs/Constituents for which we have data
                     # CURRENTLY NOT USED FOR Tully
                     data_fn = self.cfg['inputs']['source'][con_src]
-                    print('\n%s:%s'%(con_src,con),end='')
-                    data_source, column_template, df = self.data_source_lookup.get(data_fn,self.data_source_lookup.get((data_fn,con),(None,None,None)))
+                    data_source, column_template, columns = self.data_source_lookup.get(data_fn,self.data_source_lookup.get((data_fn,con),(None,None,None)))
                     if data_source is None:
                         data_source = data_fn
                     if column_template is None:
                         column_template = self.cfg['inputs']['column_formats'][data_fn]
-                    print(' - %s --> %s'%(data_source,column_template))
-                    self._apply_time_series(data_source,column_template,con_src,con,None if df is None else df.columns)
+                    logger.info('%s:%s - %s --> %s',con_src,con,data_source,column_template)
+                    self._record_time_series(self._apply_time_series(data_source,column_template,con_src,con,columns,target=target))
                 else:
                     # Apply in specific circumstances
                     constrained_config = constrained_sources.get(con_src,[])
                     if not len(constrained_config):
-                        print('SKIPPING %s:%s - no inputs'%(con_src,con))
+                        logger.info('SKIPPING %s:%s - no inputs',con_src,con)
                         continue
 
                     if isinstance(constrained_config,dict):
@@ -257,41 +642,114 @@ class CloeSetup(object):
 
                     for config in constrained_config:
                         constrain = config.get('constrain',{})
-                        self._apply_time_series(config['datasource'],
-                                                config['column_format'],
-                                                con_src,
-                                                constrain.get('constituents',self.constituents),
-                                                None,
-                                                constrain.get('fus',None),
-                                                param=config.get('param','InputRate'))
+                        self._record_time_series(self._apply_time_series(config['datasource'],
+                                                                         config['column_format'],
+                                                                         con_src,
+                                                                         constrain.get('constituents',self.constituents),
+                                                                         None,
+                                                                         constrain.get('fus',None),
+                                                                         param=config.get('param','InputRate'),
+                                                                         target=target))
                         
         # for each source, constituent, (skip some combinations)
         #   if we have a temporal input rate, assign it...
-        self._connect_global_time_series()
-
-    def _connect_global_time_series(self):
+        self._connect_global_time_series(target)
+        msg = 'Time series connections: applied {applied} and skipped {skipped} in total.'
+        logger.info(msg.format(**self.time_series_summary))
+        return self.time_series_summary
+
+    def _record_time_series(self,counts):
+        applied, skipped = counts
+        self.time_series_summary['applied'] += applied
+        self.time_series_summary['skipped'] += skipped
+
+    def _connect_global_time_series(self,target=None):
+        if target is None:
+            target = self._v.model.catchment.generation
         for ts in self.cfg['inputs'].get('global',[]):
-            self._v.model.catchment.generation.assign_time_series(ts['parameter'],ts['column'],ts['source'],**ts['constrain'])
+            data_source = self._data_source_part(ts['source'],ts['column'])
+            target.assign_time_series(ts['parameter'],ts['column'],data_source,**ts['constrain'])
+
+    def spatial_parameter_table(self,sp):
+        '''
+        Table of the match values (one column per match key, excluding those overridden by
+        constrain) and parameter value for a spatial parameter
+        '''
+        data = self.input(sp['input'])
+        constrain = sp.get('constrain',{})
+        table = pd.DataFrame({k:data[col].values for k,col in sp['match'].items() if k not in constrain})
+        table['value'] = data[sp['value']].values
+        return table
 
     def extract_spatial_parameters(self,sp):
-        result = []
-        data = self.inputs[sp['input']]
-        for _,row in data.iterrows():
-            matches = {k:row[v] for k,v in sp['match'].items()}
-            matches.update(sp.get('constrain',{}))
-            val = row[sp['value']]
-            result.append((val,matches))
-        return result
+        constrain = sp.get('constrain',{})
+        table = self.spatial_parameter_table(sp)
+        keys = [c for c in table.columns if c != 'value']
+        return [(row[-1],dict(zip(keys,row[:-1]),**constrain)) for row in table.itertuples(index=False,name=None)]
+
+    def _apply_spatial_parameter(self,target,sp,enumerate_names):
+        '''
+        Set a spatial parameter using one call per parameter (fromList), aligned with the
+        elements enumerated by Source.
+
+        Where only some elements have values, the call is restricted to those elements:
+        by a list of the matched names (single match key) or, for two match keys, with one
+        call per distinct value of one of the keys. Other match configurations are set
+        one row at a time.
+
+        Returns the number of calls made.
+        '''
+        constrain = sp.get('constrain',{})
+        table = self.spatial_parameter_table(sp)
+        keys = [c for c in table.columns if c != 'value']
+        if not len(keys) or len(keys) > 2 or not set(keys).issubset(ELEMENT_POSITIONS):
+            actions = self.extract_spatial_parameters(sp)
+            for val,matches in actions:
+                target.set_param_values(sp['param'],val,**matches)
+            return len(actions)
+
+        # Later rows take precedence, as when set row by row
+        table = table.drop_duplicates(keys,keep='last')
+        self.tracer.record(rows=len(table))
+        lookup = dict(zip(zip(*[table[k].astype(str) for k in keys]),table['value'].tolist()))
+
+        names = enumerate_names(**constrain)
+        element_keys = [tuple(str(n[ELEMENT_POSITIONS[k]]) for k in keys) for n in names]
+        covered = [k for k in element_keys if k in lookup]
+        if len(covered) == len(element_keys):
+            groups = [(constrain,covered)]
+        elif len(keys) == 1:
+            groups = [(dict(constrain,**{keys[0]:list(dict.fromkeys(k[0] for k in covered))}),covered)]
+        else:
+            # Group on the key with fewest distinct values
+            group_ix = min([0,1],key=lambda ix: len({k[ix] for k in covered}))
+            other_ix = 1 - group_ix
+            by_group = {}
+            for k in covered:
+                by_group.setdefault(k[group_ix],[]).append(k)
+            groups = [(dict(constrain,**{keys[group_ix]:g,keys[other_ix]:list(dict.fromkeys(k[other_ix] for k in ks))}),ks)
+                      for g,ks in by_group.items()]
+
+        for constraint,group_keys in groups:
+            if not len(group_keys):
+                continue
+            target.set_param_values(sp['param'],[lookup[k] for k in group_keys],fromList=True,**constraint)
+        return len(groups)
 
-    def apply_parameters(self):
+    @traced('setup')
+    def apply_parameters(self,target=None):
         cfg = self.cfg['parameters']
 
-        target = self._v.model.catchment.generation
-        print('Setting fixed scalar parameters')
+        if target is None:
+            target = self._v.model.catchment.generation
+            enumerate_names = self.metadata.generation_names
+        else:
+            enumerate_names = target.enumerate_names
+        logger.info('Setting fixed scalar parameters')
         for p,val in cfg.get('fixed',{}).items():
             target.set_param_values(p,val)
 
-        print('Configure loss parameters')
+        logger.info('Configure loss parameters')
         losses = cfg.get('losses',{})
         for p,frac in losses.get('fixed',{}).items():
             target.set_param_values('O%s'%p,0.0)
@@ -301,24 +759,24 @@ class CloeSetup(object):
             target.set_param_values('O%s'%p,1.0)
             target.set_param_values('D%s'%p,0.0)
 
-        print('Setting constrained scalar parameters')
+        logger.info('Setting constrained scalar parameters')
         for scalar in cfg.get('scalar',[]):
             matches = scalar.get('match',{})
             for param,val in scalar.get('parameters',{}).items():
                 target.set_param_values(param,val,**matches)
 
-        print('Setting spatial parameters')
+        logger.info('Setting spatial parameters')
         spatial = cfg.get('spatial',[])
         for sp in spatial:
-            actions = self.extract_spatial_parameters(sp)
-            for val,matches in actions:
-                target.set_param_values(sp['param'],val,**matches)
+            self._apply_spatial_parameter(target,sp,enumerate_names)
 
+    @traced('setup')
     def setup_functions(self):
         cfg = self.cfg.get('runoff_functions',[])
         for fn in cfg:
             self._setup_function(fn)
     
+    @traced('setup')
     def _setup_function(self,fn):
         general_function = fn['template']
         constraint = fn.get('constrain',{})
@@ -329,7 +787,7 @@ class CloeSetup(object):
         else:
             runoff_constraint = {}
 
-        print(f'Configuring runoff function {fn["function_name"]} for {fn["param"]}')
+        logger.info(f'Configuring runoff function {fn["function_name"]} for {fn["param"]}')
         use_format = '{' in general_function
 
         function_parameters = fn.get('model_variables',[fn.get('runoff_variable',None)])
@@ -341,18 +799,23 @@ class CloeSetup(object):
         else:
             variables = []
 
-        for fp in function_parameters:
-            var_pattern = '$'+fp.replace(' ','_').replace('-','_')
-            all_variables = self._v.variables()
-            vars_to_delete = [v for v in all_variables._select(['FullName']) if v.startswith(var_pattern)]
+        patterns = ['$'+fp.replace(' ','_').replace('-','_') for fp in function_parameters]
+        for var_pattern in patterns:
+            vars_to_delete = self.metadata.variables_with_prefix(var_pattern)
             if len(vars_to_delete):
-                print(f'Deleting existing variables with prefix: {var_pattern}')
-                self._v.model.functions.delete_variables(vars_to_delete)
-
-            self._v.model.catchment.runoff.create_modelled_variable(fp,**runoff_constraint)
+                logger.info(f'Deleting existing variables with prefix: {var_pattern}')
+                self.metadata.delete_variables(vars_to_delete)
 
-            all_variables = self._v.variables()
-            vars_for_fp = [v for v in all_variables._select(['FullName']) if v.startswith(var_pattern)]
+        for fp in function_parameters:
+            self.metadata.create_modelled_variable(fp,**runoff_constraint)
+
+        # Variables created above are re-queried (once) on first lookup
+        for var_pattern in patterns:
+            # Where the prefix of another parameter extends this one (eg $Quick_Flow_Rate and
+            # $Quick_Flow), leave out its variables, as if queried before they were created
+            longer = [p for p in patterns if p != var_pattern and p.startswith(var_pattern)]
+            vars_for_fp = [v for v in self.metadata.variables_with_prefix(var_pattern)
+                           if not any(v.startswith(p) for p in longer)]
             # print(fp,vars_for_fp[:5])
 
             if use_format:
@@ -365,7 +828,7 @@ class CloeSetup(object):
         function_names = [v.replace(var_pattern[1:],fn['function_name']) for v in vars_for_fp]
 
         for scalar in fn.get('model_parameters',[]):
-            values = self._v.model.catchment.runoff.get_param_values(scalar,**runoff_constraint)
+            values = self.metadata.runoff_param_values(scalar,**runoff_constraint)
             # print(scalar,values)
 
             if use_format:
@@ -376,22 +839,11 @@ class CloeSetup(object):
         for data_parameter in fn.get('data_variables',[]):
             assert use_format
             actions = self.extract_spatial_parameters(data_parameter)
-            values = []
-            for sc, fu in self._v.model.catchment.runoff.enumerate_names(**runoff_constraint):
-                scix = int(sc.split('#')[-1])
-                val_found = data_parameter.get('default_value',-1)
-                for val,matches in actions:
-                    if 'catchments' in matches:
-                        if matches['catchments'] != sc:
-                            continue
-                    if 'fus' in matches:
-                        if matches['fus'] != fu:
-                            continue
-                    val_found = val
-                    break
-                values.append(val_found)
+            values = first_match_values(actions,
+                                        self.metadata.runoff_names(**runoff_constraint),
+                                        data_parameter.get('default_value',-1))
             if len(values)!=len(function_names):
-                print(f'Expected length of values ({len(values)}) to match number of functions ({len(function_names)})')
+                logger.error(f'Expected length of values ({len(values)}) to match number of functions ({len(function_names)})')
                 assert len(values)==len(function_names)
             # Now, align with parameters... catchment, fu
             variables[data_parameter['label']] = values            
@@ -415,7 +867,7 @@ class CloeSetup(object):
         if 'units' in fn:
             self._v.model.functions.set_options('ResultUnit','UnitLibrary.%s'%fn['units'],functions=function_names)
         
-        models = self._v.model.catchment.generation.model_table(**constraint)
+        models = self.metadata.generation_model_table(**constraint)
         element_names = [(row['Catchment'],row['Functional Unit']) for _,row in models.iterrows() if row['model'] and row['model'].endswith('CLOEModel')]
         #element_names = self._v.model.catchment.generation.enumerate_names(**constraint)
         fn_applications = [('$%s_%s_%s'%(fn['function_name'],n[0],n[1])).replace('#','').replace('- ','').replace(' ','_') for n in element_names]
@@ -424,14 +876,49 @@ class CloeSetup(object):
         self._v.model.catchment.generation.apply_function(fn['param'],fn_applications,**constraint)
         self._v.model.functions.set_time_of_evaluation('DuringFlowPhase',functions=fn_applications)
 
+def model_var_criteria(variable,constituent):
+    return {'RecordingVariable':'Constituents@%s.*@Generation Model@%s'%(constituent,variable)}
+
+def fu_flux_criteria(variable,constituent):
+    return {'RecordingVariable':'Constituents@%s.*@%s'%(constituent,variable)}
+
+def _matches(rec,criteria):
+    return all(re.search(pattern,rec.get(k,'')) for k,pattern in criteria.items())
+
+def run_key(run,run_data):
+    '''
+    Identifier of a run, for caching retrieved results: the run number and time reported
+    by Veneer, so that 'latest' is resolved and runs renumbered after Source restarts
+    are kept apart.
+
+    None if run_data doesn't include the time of the run: results of such runs aren't cached.
+    '''
+    if not run_data.get('DateRun',None):
+        return None
+    return '%s|%s'%(run_data.get('Number',run),run_data['DateRun'])
+
 class CloeScenario(object):
-    def __init__(self,v):
-        self._v = v
+    def __init__(self,v,tracer=None,cache=None,fetch_all=False):
+        '''
+        v: Veneer client
+        tracer: Tracer recording each retrieval (see cloe_trace). A new Tracer is created if None
+        cache: ResultCache (see cloe_cache), or directory for one, holding retrieved results
+               between calls and sessions
+        fetch_all: when a result isn't cached, retrieve every CLOE recorder of the run at
+                   once (see fetch_all), rather than just the variable requested
+        '''
+        self.tracer = tracer or Tracer()
+        self._v = TracingClient(v,self.tracer)
+        if isinstance(cache,str):
+            cache = ResultCache(cache)
+        self.cache = cache
+        self.prefetch = fetch_all
 
     def record_stores(self):
         variables = [
             'SoilStore',
-            'GroundwaterStore'
+            'GroundwaterStore',
+            'LinkStore'
         ]
         recorders = [{'RecordingVariable':v} for v in variables]
         self._v.configure_recording(enable=recorders)
@@ -458,13 +945,19 @@ class CloeScenario(object):
     def retrieve_loss_to_outside(self,constituent='TP',run='latest',run_data=None):
         return self.retrieve_model_var_by_fu('LossOut$',constituent,run,run_data)
 
-    def retrieve_model_var_by_fu(self,variable,constituent='TP',run='latest',run_data=None):
-        criteria = {
-            'RecordingVariable':'Constituents@%s.*@Generation Model@%s'%(constituent,variable)
-        }
-        table = self._v.retrieve_multiple_time_series(run,run_data,criteria,name_fn=custom_name)
+    @traced('retrieval')
+    def retrieve_model_var_by_fu(self,variable,constituent='TP',run='latest',run_data=None,by=None,regions=None):
+        '''
+        Retrieve a CLOE model variable, summed across constituent sources for each catchment/FU.
 
-        return sum_dataframe(table,'@@',sum_element=1)
+        Optionally aggregate further (by='catchment', 'fu', 'region' or a custom grouping),
+        as per aggregate.
+        '''
+        table = self._retrieve(model_var_criteria(variable,constituent),run,run_data)
+        result = sum_dataframe(table,'@@',sum_element=1)
+        if by is None:
+            return result
+        return aggregate(result,by,regions=regions)
         # column_names = {c.split('@@')[0] for c in table.columns}
         # reduced = {cn:sum([table[c] for c in table.columns if c.startswith(cn)]) for cn in column_names}
         # return pd.DataFrame(reduced)
@@ -475,13 +968,142 @@ class CloeScenario(object):
     def retrieve_slowflow_flux(self,constituent='TP',run='latest',run_data=None):
         return self.retrieve_fu_flux('Slow Flow Load Out',constituent,run,run_data)
 
-    def retrieve_fu_flux(self,variable,constituent='TP',run='latest',run_data=None):
-        criteria = {
-            'RecordingVariable':'Constituents@%s.*@%s'%(constituent,variable)
-        }
-        table = self._v.retrieve_multiple_time_series(run,run_data,criteria,name_fn=custom_name)
+    @traced('retrieval')
+    def retrieve_fu_flux(self,variable,constituent='TP',run='latest',run_data=None,by=None,regions=None):
+        table = self._retrieve(fu_flux_criteria(variable,constituent),run,run_data)
+        result = sum_dataframe(table,'@@',sum_element=1)
+        if by is None:
+            return result
+        return aggregate(result,by,regions=regions)
 
-        return sum_dataframe(table,'@@',sum_element=1)
+    @traced('retrieval')
+    def stream_model_var_by_fu(self,variable,output,constituent='TP',run='latest',run_data=None,chunk_size=50,chunk_by='catchment'):
+        '''
+        Retrieve a CLOE model variable in chunks, reducing each chunk (as per
+        retrieve_model_var_by_fu) and appending it to a ChunkStore in directory output.
+
+        chunk_size: number of catchments (chunk_by='catchment') or recording variables
+                    (chunk_by='variable') retrieved at once.
+        '''
+        return self._stream(model_var_criteria(variable,constituent),output,run,run_data,chunk_size,chunk_by)
+
+    @traced('retrieval')
+    def stream_fu_flux(self,variable,output,constituent='TP',run='latest',run_data=None,chunk_size=50,chunk_by='catchment'):
+        '''
+        Streaming equivalent of retrieve_fu_flux. See stream_model_var_by_fu
+        '''
+        return self._stream(fu_flux_criteria(variable,constituent),output,run,run_data,chunk_size,chunk_by)
+
+    def _retrieve(self,criteria,run,run_data):
+        '''
+        Retrieve the time series matching criteria, named as per custom_name, through the cache.
+
+        Cached results are keyed by run number and time (see run_key), so without
+        run_data, the run is always retrieved from Veneer: run numbers alone are reused
+        when Source restarts.
+        '''
+        key = None
+        if self.cache is not None:
+            if run_data is None:
+                run_data = self._v.retrieve_run(run)
+            key = run_key(run,run_data)
+        if key is None:
+            table = self._v.retrieve_multiple_time_series(run,run_data,criteria,name_fn=custom_name)
+        else:
+            if self.prefetch and not self.cache.contains(key,criteria):
+                self.fetch_all(run,run_data)
+            table = self.cache.get(key,criteria)
+            if table is None:
+                table = self._v.retrieve_multiple_time_series(run,run_data,criteria,name_fn=custom_name)
+                self.cache.put(key,criteria,table)
+        self.tracer.record(rows=len(table),columns=len(table.columns))
+        return table
+
+    @traced('retrieval')
+    def fetch_all(self,run='latest',run_data=None,constituents=None):
+        '''
+        Retrieve every CLOE recorder of a run (each of MODEL_VARIABLES and FLUX_VARIABLES,
+        for each constituent) in one request, and store each variable and constituent in
+        the cache, as retrieved by retrieve_model_var_by_fu and retrieve_fu_flux.
+
+        constituents: constituents to retrieve (default: all recorded constituents)
+        '''
+        if self.cache is None:
+            raise ValueError('fetch_all requires a cache')
+        if run_data is None:
+            run_data = self._v.retrieve_run(run)
+        key = run_key(run,run_data)
+        if key is None:
+            raise ValueError('Run %s has no DateRun, so its results cannot be cached'%run)
+        if constituents is None:
+            constituents = sorted({r['RecordingVariable'].split('@')[1] for r in run_data['Results']
+                                   if r.get('RecordingVariable','').startswith('Constituents@')})
+        wanted = [model_var_criteria(v,c) for c in constituents for v in MODEL_VARIABLES] + \
+                 [fu_flux_criteria(v,c) for c in constituents for v in FLUX_VARIABLES]
+        wanted = [criteria for criteria in wanted if not self.cache.contains(key,criteria)]
+
+        # Name each series uniquely while retrieving, then split by variable and constituent
+        def full_name(rec):
+            return '%s|%s'%(custom_name(rec),rec['RecordingVariable'])
+        matched = [[r for r in run_data['Results'] if _matches(r,criteria)] for criteria in wanted]
+        groups = [[full_name(r) for r in records] for records in matched]
+        if not any(len(g) for g in groups):
+            return
+        # Each series once, in the order Veneer lists them
+        selected = {id(r) for records in matched for r in records}
+        results = [r for r in run_data['Results'] if id(r) in selected]
+        table = self._v.retrieve_multiple_time_series(run,dict(run_data,Results=results),
+                                                      {'RecordingVariable':'Constituents@'},name_fn=full_name)
+        self.tracer.record(rows=len(table),columns=len(table.columns))
+        for criteria,columns in zip(wanted,groups):
+            part = table[columns]
+            part.columns = [c.rsplit('|',1)[0] for c in columns]
+            self.cache.put(key,criteria,part)
+
+    def _chunk_results(self,run_data,criteria,chunk_size,chunk_by):
+        chunk_keys = {
+            'catchment':'NetworkElement',
+            'variable':'RecordingVariable'
+        }
+        key = chunk_keys[chunk_by]
+        candidates = [r for r in run_data['Results'] if _matches(r,criteria)]
+        groups = {}
+        for r in candidates:
+            groups.setdefault(r[key],[]).append(r)
+        group_keys = list(groups.keys())
+        for ix in range(0,len(group_keys),chunk_size):
+            yield sum([groups[k] for k in group_keys[ix:ix+chunk_size]],[])
+
+    def _stream(self,criteria,output,run,run_data,chunk_size,chunk_by):
+        if run_data is None:
+            run_data = self._v.retrieve_run(run)
+        store = ChunkStore(output)
+        store.clear()
+        for chunk in self._chunk_results(run_data,criteria,chunk_size,chunk_by):
+            chunk_run = dict(run_data,Results=chunk)
+            table = self._v.retrieve_multiple_time_series(run,chunk_run,criteria,name_fn=custom_name)
+            self.tracer.record(rows=len(table),columns=len(table.columns))
+            store.append(sum_dataframe(table,'@@',sum_element=1))
+        return store
+
+def sum_by_group(df,groups):
+    '''
+    Sum the columns of df that share a group label, keeping the dtype of df.
+
+    groups: list of group labels, one per column of df
+
+    Columns are ordered by group and each run of columns summed with np.add.reduceat,
+    so the cost is linear in the number of columns, however they are grouped.
+    '''
+    codes, labels = pd.factorize(pd.Index(groups))
+    values = df.values
+    if not len(labels):
+        return pd.DataFrame(np.zeros((len(df),0),dtype=values.dtype),index=df.index)
+
+    order = np.argsort(codes,kind='stable')
+    starts = np.searchsorted(codes[order],np.arange(len(labels)))
+    reduced = np.add.reduceat(values[:,order],starts,axis=1)
+    return pd.DataFrame(reduced,index=df.index,columns=labels)
 
 def sum_dataframe(df,column_delim='@',sum_element=2):
     def make_new_name(col):
@@ -489,10 +1111,40 @@ def sum_dataframe(df,column_delim='@',sum_element=2):
         keep = [s for i,s in enumerate(split) if i != sum_element]
         return column_delim.join(keep)
 
-    column_names = {make_new_name(c) for c in df.columns}
-    reduced = {cn:sum([df[c] for c in df.columns if make_new_name(c)==cn]) for cn in column_names}
-    return pd.DataFrame(reduced)
+    return sum_by_group(df,[make_new_name(c) for c in df.columns])
 
 def sum_for_catchment(df):
     return sum_dataframe(df,column_delim='@',sum_element=1)
 
+AGGREGATION_ELEMENTS={
+    'catchment':0,
+    'fu':1
+}
+
+def aggregate(df,by,column_delim='@',regions=None):
+    '''
+    Sum columns named <catchment>@<fu>[...] (as returned by CloeScenario) to a coarser level.
+
+    by: 'catchment', 'fu', 'region' (requires regions: mapping of catchment -> region),
+        a mapping of column -> group, or a function of column name returning the group.
+        Columns without a group are dropped.
+    '''
+    if callable(by):
+        groups = [by(c) for c in df.columns]
+    elif not isinstance(by,str):
+        groups = [by.get(c,None) for c in df.columns]
+    elif by in AGGREGATION_ELEMENTS:
+        groups = [c.split(column_delim)[AGGREGATION_ELEMENTS[by]] for c in df.columns]
+    elif by == 'region':
+        if regions is None:
+            raise ValueError('regions (catchment -> region) required to aggregate by region')
+        groups = [regions.get(c.split(column_delim)[0],None) for c in df.columns]
+    else:
+        raise ValueError('Unknown aggregation: %s'%by)
+
+    keep = [g is not None for g in groups]
+    if not all(keep):
+        df = df.loc[:,keep]
+        groups = [g for g in groups if g is not None]
+    return sum_by_group(df,groups)
+
@@ -0,0 +1,261 @@
+'''
+Tracing of CloeSetup stages and CloeScenario retrievals.
+
+A Tracer records a span for each traced call (eg each CloeSetup.apply stage),
+with its elapsed time and the Veneer requests, bytes, rows and columns
+accumulated while it was open. Veneer requests are counted by wrapping the
+client in a TracingClient. Bytes are estimated from the size of the arguments
+and results of each request (eg the values in a DataFrame), rather than
+measured on the wire.
+
+    setup = CloeSetup('config.json',v)
+    setup.apply()
+    setup.tracer.save_chrome_trace('apply.trace.json') # Open in chrome://tracing or Perfetto
+    setup.tracer.save_summary('apply.summary.json')
+
+Sinks are called with each span as it finishes, eg to forward to other metrics:
+
+    setup.tracer.add_sink(lambda span: statsd.timing(span.name,span.duration))
+
+Open spans are tracked for each thread. Work handed to another thread (eg a
+pool) is made part of the current spans with bind:
+
+    pool.submit(tracer.bind(fn),*args)
+'''
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+COUNTERS=['requests','bytes','rows','columns']
+
+def payload_size(value,depth=0):
+    '''
+    Approximate size, in bytes, of a value sent to or received from Veneer
+    '''
+    if value is None:
+        return 0
+    if isinstance(value,(pd.DataFrame,pd.Series)):
+        return int(value.memory_usage(index=True,deep=False).sum()) if isinstance(value,pd.DataFrame) else int(value.memory_usage(index=True))
+    if isinstance(value,np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value,(str,bytes)):
+        return len(value)
+    if isinstance(value,(bool,int,float,np.number)):
+        return 8
+    if depth > 3:
+        return 8
+    if isinstance(value,dict):
+        return sum(payload_size(k,depth+1) + payload_size(v,depth+1) for k,v in value.items())
+    if isinstance(value,(list,tuple,set)):
+        return sum(payload_size(v,depth+1) for v in value)
+    return 8
+
+class Span(object):
+    def __init__(self,name,category,parent=None,**attributes):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attributes = attributes
+        self.counters = {c:0 for c in COUNTERS}
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def as_dict(self):
+        return dict(name=self.name,category=self.category,parent=self.parent,start=self.start,
+                    duration=self.duration,**self.counters,**self.attributes)
+
+class Tracer(object):
+    '''
+    Records spans, and the counters of each, for traced calls.
+
+    sinks: functions called with each Span as it finishes
+    '''
+    def __init__(self,sinks=None):
+        self.sinks = list(sinks or [])
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_sink(self,sink):
+        self.sinks.append(sink)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    def span(self,name,category='cloe',**attributes):
+        return _SpanContext(self,name,category,attributes)
+
+    def _open(self):
+        '''
+        Spans open in the current thread, outermost first
+        '''
+        if not hasattr(self._local,'open'):
+            self._local.open = []
+        return self._local.open
+
+    def current(self):
+        '''
+        Spans open in the current thread, to pass to work run in other threads (see attach)
+        '''
+        return list(self._open())
+
+    def attach(self,spans):
+        '''
+        Context in which spans (from current, in another thread) are open in this thread,
+        as parents of new spans and receiving the counters recorded
+        '''
+        return _AttachContext(self,spans)
+
+    def bind(self,fn):
+        '''
+        Wrap fn to run within the spans currently open in this thread, from any thread
+        '''
+        spans = self.current()
+        @functools.wraps(fn)
+        def wrapper(*args,**kwargs):
+            with self.attach(spans):
+                return fn(*args,**kwargs)
+        return wrapper
+
+    def _start(self,name,category,attributes):
+        spans = self._open()
+        parent = spans[-1].name if len(spans) else None
+        span = Span(name,category,parent,**attributes)
+        spans.append(span)
+        return span
+
+    def _finish(self,span):
+        span.finish()
+        self._open().remove(span)
+        with self._lock:
+            self.spans.append(span)
+        for sink in self.sinks:
+            sink(span)
+
+    def record(self,**counters):
+        '''
+        Add to the counters (requests, bytes, rows, columns) of every span open in the
+        current thread
+        '''
+        spans = self._open()
+        with self._lock:
+            for span in spans:
+                for k,v in counters.items():
+                    span.counters[k] = span.counters.get(k,0) + v
+
+    def request(self,args,kwargs,result):
+        self.record(requests=1,bytes=payload_size(args)+payload_size(kwargs)+payload_size(result))
+
+    def summary(self):
+        '''
+        Totals by span name: number of calls, total duration and counters
+        '''
+        result = {}
+        for span in self.spans:
+            entry = result.setdefault(span.name,dict(category=span.category,calls=0,duration=0.0,**{c:0 for c in COUNTERS}))
+            entry['calls'] += 1
+            entry['duration'] += span.duration
+            for c in COUNTERS:
+                entry[c] += span.counters.get(c,0)
+        return result
+
+    def as_dataframe(self):
+        return pd.DataFrame([s.as_dict() for s in self.spans])
+
+    def chrome_trace(self):
+        '''
+        Spans in the Chrome trace event format
+        '''
+        pid = os.getpid()
+        events = [{
+            'name':s.name,
+            'cat':s.category,
+            'ph':'X',
+            'ts':s.start*1e6,
+            'dur':s.duration*1e6,
+            'pid':pid,
+            'tid':s.thread,
+            'args':dict(s.counters,**s.attributes)
+        } for s in self.spans]
+        return {'traceEvents':events,'displayTimeUnit':'ms'}
+
+    def save_chrome_trace(self,fn):
+        with open(fn,'w') as fp:
+            json.dump(self.chrome_trace(),fp,default=str)
+
+    def save_summary(self,fn):
+        with open(fn,'w') as fp:
+            json.dump({'summary':self.summary(),'spans':[s.as_dict() for s in self.spans]},fp,indent=2,default=str)
+
+class _SpanContext(object):
+    def __init__(self,tracer,name,category,attributes):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.tracer._start(self.name,self.category,self.attributes)
+        return self.span
+
+    def __exit__(self,*exc):
+        self.tracer._finish(self.span)
+        return False
+
+class _AttachContext(object):
+    def __init__(self,tracer,spans):
+        self.tracer = tracer
+        self.spans = list(spans)
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = self.tracer._open()
+        self.tracer._local.open = self.spans + [s for s in self.previous if s not in self.spans]
+        return self.tracer
+
+    def __exit__(self,*exc):
+        self.tracer._local.open = self.previous
+        return False
+
+def traced(category):
+    '''
+    Decorator for methods of objects with a tracer, recording a span for each call
+    '''
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self,*args,**kwargs):
+            with self.tracer.span(method.__name__,category):
+                return method(self,*args,**kwargs)
+        return wrapper
+    return decorate
+
+class TracingClient(object):
+    '''
+    Wraps a Veneer client (or part of one, eg model.catchment.generation), counting
+    each call as a request in the tracer
+    '''
+    def __init__(self,client,tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self,attr):
+        value = getattr(self._client,attr)
+        if callable(value) or hasattr(value,'__dict__'):
+            return TracingClient(value,self._tracer)
+        return value
+
+    def __call__(self,*args,**kwargs):
+        result = self._client(*args,**kwargs)
+        self._tracer.request(args,kwargs,result)
+        return result
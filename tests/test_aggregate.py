@@ -0,0 +1,71 @@
+'''
+sum_dataframe and aggregate compared with the original sum_dataframe, which summed
+the matching columns for each output name.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from cloe_setup import sum_dataframe, aggregate
+
+def reference_sum_dataframe(df,column_delim='@',sum_element=2):
+    def make_new_name(col):
+        split = col.split(column_delim)
+        keep = [s for i,s in enumerate(split) if i != sum_element]
+        return column_delim.join(keep)
+
+    column_names = {make_new_name(c) for c in df.columns}
+    reduced = {cn:sum([df[c] for c in df.columns if make_new_name(c)==cn]) for cn in column_names}
+    return pd.DataFrame(reduced)
+
+def compare(actual,expected):
+    pd.testing.assert_frame_equal(actual.sort_index(axis=1),expected.sort_index(axis=1),
+                                  check_exact=False,rtol=1e-12)
+
+CATCHMENTS=['SC#%d'%i for i in range(30)]
+FUS=['Grazing','Forestry','Urban','Sugarcane']
+SOURCES=['Hillslope','Septic','Fertiliser']
+REGIONS={sc:'region%d'%(i%4) for i,sc in enumerate(CATCHMENTS)}
+
+@pytest.fixture(params=['float64','int64'])
+def retrieved(request):
+    '''
+    Time series named as per custom_name (<catchment>@<fu>@@<source>)
+    '''
+    rng = np.random.default_rng(1)
+    columns = ['%s@%s@@%s'%(sc,fu,src) for sc in CATCHMENTS for fu in FUS for src in SOURCES]
+    # Not in catchment order, as returned by Veneer
+    columns = list(rng.permutation(columns))
+    values = rng.uniform(0,100,(20,len(columns))).astype(request.param)
+    return pd.DataFrame(values,index=pd.date_range('2000-01-01',periods=20),columns=columns)
+
+def test_sum_dataframe(retrieved):
+    result = sum_dataframe(retrieved,'@@',sum_element=1)
+    compare(result,reference_sum_dataframe(retrieved,'@@',sum_element=1))
+    assert (result.dtypes == retrieved.dtypes.iloc[0]).all()
+
+@pytest.mark.parametrize('by,sum_element',[('catchment',1),('fu',0)])
+def test_aggregate_elements(retrieved,by,sum_element):
+    by_fu = sum_dataframe(retrieved,'@@',sum_element=1)
+    result = aggregate(by_fu,by)
+    compare(result,reference_sum_dataframe(by_fu,'@',sum_element=sum_element))
+    assert (result.dtypes == retrieved.dtypes.iloc[0]).all()
+
+def test_aggregate_region(retrieved):
+    by_fu = sum_dataframe(retrieved,'@@',sum_element=1)
+    result = aggregate(by_fu,'region',regions=REGIONS)
+    by_region = by_fu.copy()
+    by_region.columns = ['%s@%s'%(REGIONS[c.split('@')[0]],c) for c in by_fu.columns]
+    by_region = reference_sum_dataframe(by_region,'@',sum_element=1)
+    compare(result,reference_sum_dataframe(by_region,'@',sum_element=1))
+
+def test_aggregate_mapping_drops_ungrouped(retrieved):
+    by_fu = sum_dataframe(retrieved,'@@',sum_element=1)
+    groups = {c:'urban' for c in by_fu.columns if c.endswith('@Urban')}
+    result = aggregate(by_fu,groups)
+    assert list(result.columns) == ['urban']
+    np.testing.assert_allclose(result['urban'],by_fu[list(groups)].sum(axis=1))
+
+def test_single_group(retrieved):
+    result = aggregate(retrieved,lambda c: 'total')
+    np.testing.assert_allclose(result['total'],retrieved.sum(axis=1))
@@ -0,0 +1,172 @@
+'''
+InputCache, ResultCache (shared between sessions) and cached retrieval through
+CloeScenario.
+'''
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from cloe_cache import InputCache, ResultCache
+from cloe_setup import CloeScenario, INPUT_FORMAT, load_input
+from fake_veneer import FakeVeneer
+from synthetic import FUS, network
+
+def table(seed,n=4):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.random((10,n)),index=pd.date_range('2000-01-01',periods=10),
+                        columns=['col%d'%i for i in range(n)])
+
+def write_input(fn,values=(1.0,2.0,3.0)):
+    pd.DataFrame({'name':['a','b','c'],'value':list(values)}).to_csv(fn,index=False)
+
+def test_input_cache(tmp_path):
+    fn = str(tmp_path/'attributes.csv')
+    write_input(fn)
+    cache = InputCache(str(tmp_path/'cache'),INPUT_FORMAT)
+    assert cache.get('attributes',fn) is None
+
+    df = load_input('attributes',fn,cache)
+    cached = cache.get('attributes',fn)
+    pd.testing.assert_frame_equal(cached,df)
+    # Keyed by input name and file
+    assert cache.get('other',fn) is None
+
+    # Touched, but unchanged
+    stat = os.stat(fn)
+    os.utime(fn,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+    pd.testing.assert_frame_equal(cache.get('attributes',fn),df)
+
+    # Changed, with the same size
+    write_input(fn,(4.0,5.0,6.0))
+    assert os.stat(fn).st_size == stat.st_size
+    os.utime(fn,ns=(stat.st_atime_ns,stat.st_mtime_ns+2*10**9))
+    assert cache.get('attributes',fn) is None
+    assert load_input('attributes',fn,cache)['value'].tolist() == [4.0,5.0,6.0]
+
+    # Changed size
+    write_input(fn,(7.5,8.5,9.5))
+    assert cache.get('attributes',fn) is None
+
+def test_input_cache_format(tmp_path):
+    fn = str(tmp_path/'septic.csv')
+    pd.DataFrame({'Date':['01/01/2000']*4,'cmt':['SC #0','SC #0','SC #1','SC #1'],
+                  'FU':['Grazing','Urban']*2,'P':[1.0,2.0,3.0,4.0]}).to_csv(fn,index=False)
+    directory = str(tmp_path/'cache')
+
+    # Entry written before the format was versioned: not transformed or compacted
+    InputCache(directory).put('septic',fn,pd.read_csv(fn))
+    assert InputCache(directory).get('septic',fn) is not None
+    cache = InputCache(directory,INPUT_FORMAT)
+    assert cache.get('septic',fn) is None
+
+    df = load_input('septic',fn,cache)
+    assert 'location' in df.columns
+    pd.testing.assert_frame_equal(cache.get('septic',fn),df)
+    assert InputCache(directory,INPUT_FORMAT+1).get('septic',fn) is None
+
+def feather_files(directory):
+    return {fn for fn in os.listdir(directory) if fn.endswith('.feather')}
+
+def test_sessions_merge_index(tmp_path):
+    first = ResultCache(str(tmp_path))
+    second = ResultCache(str(tmp_path))
+    first.put('1|a',{'RecordingVariable':'x'},table(0))
+    second.put('1|a',{'RecordingVariable':'y'},table(1))
+
+    # Neither session overwrote the other's entry
+    third = ResultCache(str(tmp_path))
+    assert len(third.entries) == 2
+    pd.testing.assert_frame_equal(first.get('1|a',{'RecordingVariable':'y'}),table(1),check_freq=False)
+    assert feather_files(str(tmp_path)) == {e['file'] for e in third.entries.values()}
+
+def test_concurrent_sessions(tmp_path):
+    def session(ix):
+        cache = ResultCache(str(tmp_path))
+        for i in range(5):
+            cache.put('%d|a'%ix,{'RecordingVariable':str(i)},table(i))
+    threads = [threading.Thread(target=session,args=(ix,)) for ix in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    index = ResultCache(str(tmp_path)).entries
+    assert len(index) == 20
+    assert feather_files(str(tmp_path)) == {e['file'] for e in index.values()}
+
+def test_sessions_evict(tmp_path):
+    size = len(table(0).to_numpy().tobytes())
+    first = ResultCache(str(tmp_path),max_bytes=size*3)
+    second = ResultCache(str(tmp_path),max_bytes=size*3)
+    for i in range(4):
+        (first if i%2 else second).put('1|a',{'RecordingVariable':str(i)},table(i))
+    index = ResultCache(str(tmp_path)).entries
+    assert len(index) < 4
+    assert feather_files(str(tmp_path)) == {e['file'] for e in index.values()}
+
+    first.clear()
+    assert not len(ResultCache(str(tmp_path)).entries)
+    assert not len(feather_files(str(tmp_path)))
+
+def fake():
+    v = FakeVeneer(network(3),FUS[:2])
+    v.constituents = ['TP']
+    v.constituent_sources = ['Hillslope']
+    return v
+
+def test_numbered_run_cached(tmp_path):
+    v = fake()
+    expected = CloeScenario(v,cache=str(tmp_path)).retrieve_quickflow_flux('TP',run=1)
+
+    # Another session: the run's details are retrieved, but not its results
+    v.reset_counts()
+    cached = CloeScenario(v,cache=str(tmp_path)).retrieve_quickflow_flux('TP',run=1)
+    pd.testing.assert_frame_equal(cached,expected,check_freq=False)
+    assert v.requests_by_path == {'retrieve_run':1}
+
+    # The latest run is the same run
+    v.reset_counts()
+    CloeScenario(v,cache=str(tmp_path)).retrieve_quickflow_flux('TP',run='latest')
+    assert v.requests_by_path == {'retrieve_run':1}
+
+def test_run_number_reused(tmp_path):
+    v = fake()
+    before = CloeScenario(v,cache=str(tmp_path)).retrieve_quickflow_flux('TP',run=1)
+
+    # Source restarted: run 1 is a different run
+    v.run_date = '02/01/2000 09:30:00'
+    v.reset_counts()
+    after = CloeScenario(v,cache=str(tmp_path)).retrieve_quickflow_flux('TP',run=1)
+    assert v.requests_by_path['retrieve_multiple_time_series'] > 0
+    assert not np.allclose(after.values,before.values)
+
+def test_runs_without_date_not_cached(tmp_path):
+    v = fake()
+    run_data = dict(v.retrieve_run(),DateRun=None)
+    scenario = CloeScenario(v,cache=str(tmp_path))
+    scenario.retrieve_quickflow_flux('TP',run_data=run_data)
+    v.reset_counts()
+    scenario.retrieve_quickflow_flux('TP',run_data=run_data)
+    assert v.requests_by_path['retrieve_multiple_time_series'] > 0
+    assert not len(feather_files(str(tmp_path)))
+
+def test_index_saved_on_change_only(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put('1|a',{'RecordingVariable':'x'},table(0))
+    index_fn = os.path.join(str(tmp_path),ResultCache.INDEX)
+    saved = os.stat(index_fn).st_mtime_ns
+    with open(index_fn) as fp:
+        content = fp.read()
+    for _ in range(3):
+        assert cache.get('1|a',{'RecordingVariable':'x'}) is not None
+    assert os.stat(index_fn).st_mtime_ns == saved
+    with open(index_fn) as fp:
+        assert fp.read() == content
+
+    # Last use is saved with the next change
+    used = cache.entries[cache._key('1|a',{'RecordingVariable':'x'})]['last_used']
+    cache.put('1|a',{'RecordingVariable':'y'},table(1))
+    assert ResultCache(str(tmp_path)).entries[cache._key('1|a',{'RecordingVariable':'x'})]['last_used'] == used
@@ -0,0 +1,136 @@
+'''
+CalibrationCampaign sampling, running (in this process and on a process pool, with
+forcing in shared memory) and resuming.
+'''
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from cloe_calibration import CalibrationCampaign, SAMPLE_ID
+from cloe_engine import CloeEngine, AREAL, NON_AREAL
+
+RANGES=[{'param':'B1','min':0.0,'max':2.0},{'param':'Dsurf','min':0.0,'max':0.5}]
+N_SAMPLES=12
+
+# File (set in the environment, so that it reaches pool workers) logging each run
+RUN_LOG='CLOE_TEST_RUN_LOG'
+
+def total_load(results):
+    '''
+    Objective, logging each run
+    '''
+    with open(os.environ[RUN_LOG],'a') as fp:
+        fp.write('%d\n'%os.getpid())
+    return {'quickflow':float(results['quickflowConstituent'].sum()),
+            'slowflow':float(results['slowflowConstituent'].sum())}
+
+class Interrupted(Exception):
+    pass
+
+def interrupted_after(n):
+    runs = []
+    def objective(results):
+        if len(runs) == n:
+            raise Interrupted()
+        runs.append(1)
+        return total_load(results)
+    return objective
+
+def small_engine():
+    rng = np.random.default_rng(3)
+    elements = pd.DataFrame([(c,f,'TP',s,model) for c in ['c0','c1'] for f in ['f0','f1']
+                             for s,model in [('areal',AREAL),('non_areal',NON_AREAL)]],
+                            columns=['catchment','fu','constituent','source','model'])
+    elements['area'] = rng.uniform(1e4,1e6,len(elements))
+    engine = CloeEngine(elements)
+    for p in ['M','E','Alpha','TimingFactor','O','T','Osurf','Ogw']:
+        engine.set_param_values(p,1.0)
+    engine.set_param_values('Dgw',0.1)
+    dates = pd.date_range('2000-01-01',periods=30)
+    for p in ['InputRate','quickflow','slowflow']:
+        columns = ['%s%d'%(p,i) for i in range(len(elements))]
+        engine.create_data_source(p,pd.DataFrame(rng.uniform(0.0,10.0,(len(dates),len(elements))),index=dates,columns=columns))
+        engine.assign_time_series(p,columns,p,from_list=True)
+    return engine
+
+@pytest.fixture
+def run_log(tmp_path,monkeypatch):
+    fn = str(tmp_path/'runs.log')
+    monkeypatch.setenv(RUN_LOG,fn)
+    def runs():
+        '''
+        Process id of each run so far
+        '''
+        if not os.path.exists(fn):
+            return []
+        with open(fn,'r') as fp:
+            return [int(pid) for pid in fp.read().split()]
+    return runs
+
+def run_campaign(tmp_path,objective=total_load,workers=None,name='campaign.csv'):
+    campaign = CalibrationCampaign(small_engine(),RANGES,objective,str(tmp_path/name))
+    return campaign.run(N_SAMPLES,workers=workers,seed=1)
+
+def campaign(tmp_path,ranges=RANGES):
+    return CalibrationCampaign(None,ranges,None,str(tmp_path/'campaign.csv'))
+
+def test_samples_reloaded(tmp_path):
+    samples = campaign(tmp_path).samples(20,seed=1)
+    assert len(samples) == 20
+    assert samples['B1'].between(0.0,2.0).all()
+    reloaded = campaign(tmp_path).samples(20,seed=1)
+    assert reloaded.values == pytest.approx(samples.values)
+
+@pytest.mark.parametrize('changes',[
+    {'n':30},
+    {'method':'uniform'},
+    {'seed':2},
+    {'ranges':[dict(RANGES[0],max=1.0),RANGES[1]]}
+])
+def test_samples_settings_changed(tmp_path,changes):
+    campaign(tmp_path).samples(20,seed=1)
+    settings = dict({'n':20,'method':'lhs','seed':1},**changes)
+    ranges = settings.pop('ranges',RANGES)
+    with pytest.raises(ValueError):
+        campaign(tmp_path,ranges).samples(**settings)
+
+def test_run_serial_matches_pool(tmp_path,run_log):
+    serial = run_campaign(tmp_path,name='serial.csv')
+    assert len(run_log()) == N_SAMPLES
+    parallel = run_campaign(tmp_path,workers=2,name='parallel.csv')
+    assert len(run_log()) == 2*N_SAMPLES
+    assert os.getpid() not in run_log()[N_SAMPLES:]
+    assert sorted(parallel.index) == list(range(N_SAMPLES))
+    pd.testing.assert_frame_equal(parallel.sort_index(),serial.sort_index())
+    # Samples vary the objective
+    assert serial['quickflow'].nunique() == N_SAMPLES
+
+def test_results_streamed_and_resumed(tmp_path,run_log):
+    with pytest.raises(Interrupted):
+        run_campaign(tmp_path,interrupted_after(5))
+    # Completed samples were written before the interruption
+    partial = pd.read_csv(str(tmp_path/'campaign.csv'),index_col=SAMPLE_ID)
+    assert len(partial) == 5
+
+    results = run_campaign(tmp_path)
+    assert len(run_log()) == N_SAMPLES
+    assert sorted(results.index) == list(range(N_SAMPLES))
+    pd.testing.assert_frame_equal(results.loc[partial.index],partial)
+
+@pytest.mark.parametrize('workers',[None,2])
+def test_resume_runs_remaining_samples(tmp_path,run_log,workers):
+    complete = run_campaign(tmp_path,name='complete.csv')
+    # As if interrupted after some samples (in completion order)
+    done = [3,0,7,8]
+    complete.loc[done].to_csv(str(tmp_path/'campaign.csv'))
+    runs = len(run_log())
+
+    results = run_campaign(tmp_path,workers=workers)
+    assert len(run_log()) - runs == N_SAMPLES - len(done)
+    assert results.index.is_unique
+    pd.testing.assert_frame_equal(results.sort_index(),complete.sort_index())
+
+    # Nothing left to run
+    run_campaign(tmp_path,workers=workers)
+    assert len(run_log()) - runs == N_SAMPLES - len(done)
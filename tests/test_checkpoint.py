@@ -0,0 +1,62 @@
+'''
+Checkpoints captured from a run, saved, loaded and applied, using FakeVeneer.
+'''
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from cloe_checkpoint import Checkpoint
+from cloe_setup import CloeScenario
+from fake_veneer import FakeVeneer
+from synthetic import FUS, network
+
+CONSTITUENTS=['TP','TN']
+
+def fake():
+    v = FakeVeneer(network(4),FUS[:2])
+    v.constituents = list(CONSTITUENTS)
+    v.constituent_sources = ['Hillslope','Septic']
+    return v
+
+def test_save_load_apply(tmp_path):
+    v = fake()
+    scenario = CloeScenario(v)
+    scenario.record_stores()
+    checkpoint = Checkpoint.from_run(scenario)
+    states = checkpoint.states
+    assert len(states) == len(v._generation_names()) + len(v._link_names())
+
+    fn = str(tmp_path/'checkpoint.parquet')
+    checkpoint.save(fn)
+    loaded = Checkpoint.load(fn)
+
+    target = fake()
+    loaded.apply(target)
+    for name in target._generation_names():
+        key = (name[0],name[1],name[2],name[3])
+        assert target.parameters[(name,'InitialSoilStore')] == pytest.approx(states.loc[key,'SoilStore'])
+        assert target.parameters[(name,'InitialGroundwaterStore')] == pytest.approx(states.loc[key,'GroundwaterStore'])
+    for link,con in target._link_names():
+        assert target.link_parameters[((link,con),'InitialLinkStore')] == pytest.approx(states.loc[(link,'',con,''),'LinkStore'])
+
+def test_apply_links_keeps_missing(tmp_path):
+    v = fake()
+    scenario = CloeScenario(v)
+    scenario.record_stores()
+    checkpoint = Checkpoint.from_run(scenario)
+    missing = ('Link 0','',CONSTITUENTS[0],'')
+    checkpoint.states = checkpoint.states.drop(missing)
+
+    target = fake()
+    target.link_parameters[(('Link 0',CONSTITUENTS[0]),'InitialLinkStore')] = 42.0
+    checkpoint.apply(target)
+    assert target.link_parameters[(('Link 0',CONSTITUENTS[0]),'InitialLinkStore')] == 42.0
+    assert target.link_parameters[(('Link 0',CONSTITUENTS[1]),'InitialLinkStore')] == \
+        pytest.approx(checkpoint.states.loc[('Link 0','',CONSTITUENTS[1],''),'LinkStore'])
+
+def test_apply_links_checks_names():
+    class Links(object):
+        def enumerate_names(self):
+            return [('Link 0',)]
+    with pytest.raises(ValueError):
+        Checkpoint(None).apply_links(Links())
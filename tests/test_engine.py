@@ -0,0 +1,201 @@
+'''
+CloeEngine compared with a scalar port of AbstractCLOEFUModel.runTimeStep, and its
+forward sensitivities compared with central finite differences.
+'''
+import math
+import numpy as np
+import pandas as pd
+import pytest
+
+from cloe_engine import CloeEngine, DEFAULTS, DEFAULT_RECORD, LOADS, LOSS_RATES, AREAL, NON_AREAL, TINY
+from cloe_setup import CloeSetup
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+TIMESTEP=86400.0
+DAYS=60
+SERIES=['InputRate','quickflow','slowflow','Temp']
+
+def safe_inv(x):
+    x = float(x)
+    if abs(x) < TINY:
+        sign = (x > 0) - (x < 0)
+        x = (1 if sign==0 else sign)*TINY
+    return 1/x
+
+def weight(d,o,e):
+    return (1 - o)*d + o*e
+
+class ReferenceModel(object):
+    '''
+    Line by line port of AbstractCLOEFUModel (with ArealCLOEModel's area scaling)
+    '''
+    def __init__(self,p,area_ha=None):
+        self.p = dict(p)
+        self.area_ha = area_ha
+        self.SoilStore = self.p['InitialSoilStore']
+        self.GroundwaterStore = self.p['InitialGroundwaterStore']
+
+    def generate_rate(self):
+        p = self.p
+        result = p['O']*p['Alpha']*p['InputRate']*p['M']*p['E']*p['TimingFactor']
+        if self.area_ha is not None:
+            result *= self.area_ha
+        return result
+
+    def outside_loss_rate(self):
+        p = self.p
+        exponent = (-p['B11']*safe_inv(p['Temp'])) + (-p['B12']*safe_inv(p['SoilMoisture'])) + \
+                   (-p['B13']*p['M13']*safe_inv(p['PlantUptake']))
+        return weight(p['Dout'],p['Oout'],math.exp(exponent))
+
+    def surface_loss_rate(self):
+        p = self.p
+        exponent = (-p['B1']*safe_inv(p['quickflow'])) + (-p['B2']*p['Distance']) + \
+                   (-p['B3']*p['M3']*p['Groundcover']) + (-p['B4']*p['M4']*p['Riparian']) + \
+                   (-p['B5']*p['M5']*p['Wetlands']) + (-p['B6']*p['M6']*p['Soil'])
+        return weight(p['Dsurf'],p['Osurf'],math.exp(exponent))
+
+    def groundwater_loss_rate(self):
+        p = self.p
+        exponent = -p['B21']*safe_inv(p['Drainage']) - p['B22']*p['M22']*p['SoilLeach']
+        return weight(p['Dgw'],p['Ogw'],math.exp(exponent))
+
+    def groundwater_loss_out_rate(self):
+        p = self.p
+        exponent = (-p['B41']*p['M41']*safe_inv(p['DOC'])) + (-p['B42']*p['Geology'])
+        return weight(p['DgwOut'],p['OgwOut'],math.exp(exponent))
+
+    def groundwater_loss_slowflow_rate(self):
+        p = self.p
+        exponent = -p['B31']*safe_inv(p['slowflow'])
+        return weight(p['DgwSurf'],p['OgwSurf'],math.exp(exponent))
+
+    def run_time_step(self,ts):
+        self.SoilStore += self.generate_rate()
+
+        loss_threshold = self.p['T']*self.SoilStore
+        self.LossOut = self.SoilStore*self.outside_loss_rate()
+        self.quickflowConstituent = self.SoilStore*self.surface_loss_rate()
+        self.LossToGroundwater = self.SoilStore*self.groundwater_loss_rate()
+        loss_demand = self.LossOut + self.quickflowConstituent + self.LossToGroundwater
+        loss_scale = 1.0
+        if loss_demand > loss_threshold:
+            loss_scale = loss_threshold/loss_demand
+        self.quickflowConstituent *= loss_scale
+        self.SoilStore -= self.quickflowConstituent
+        self.LossToGroundwater *= loss_scale
+        self.SoilStore -= self.LossToGroundwater
+        self.GroundwaterStore += self.LossToGroundwater
+        self.LossOut *= loss_scale
+        self.LossOut = min(self.LossOut,self.SoilStore)
+        self.SoilStore -= self.LossOut
+        self.LossOut /= ts
+        self.quickflowConstituent /= ts
+        self.LossToGroundwater /= ts
+
+        self.LossOutGroundwater = self.GroundwaterStore*self.groundwater_loss_out_rate()
+        self.slowflowConstituent = self.GroundwaterStore*self.groundwater_loss_slowflow_rate()
+        self.LossOutGroundwater = min(self.GroundwaterStore,self.LossOutGroundwater)
+        self.GroundwaterStore -= self.LossOutGroundwater
+        self.slowflowConstituent = min(self.GroundwaterStore,self.slowflowConstituent)
+        self.GroundwaterStore -= self.slowflowConstituent
+        self.LossOutGroundwater /= ts
+        self.slowflowConstituent /= ts
+
+# Delivery ratios and scaling of each loss rate
+LOSS_CONTROLS=[x for d,o,_ in LOSS_RATES.values() for x in (d,o)]
+
+def parameter_range(p):
+    if p.startswith('Initial'):
+        return (0.0,20.0)
+    if p == 'T':
+        return (0.2,1.0)
+    if p in LOSS_CONTROLS or (p.startswith('M') and p != 'M'):
+        return (0.0,0.6)
+    if p.startswith('B'):
+        return (0.0,2.0)
+    return (0.5,1.5)
+
+@pytest.fixture
+def engine():
+    rng = np.random.default_rng(42)
+    elements = pd.DataFrame([(c,f,'TP',s,model) for c in ['c0','c1','c2'] for f in ['f0','f1']
+                             for s,model in [('areal',AREAL),('non_areal',NON_AREAL)]],
+                            columns=['catchment','fu','constituent','source','model'])
+    elements['area'] = rng.uniform(1e4,1e6,len(elements))
+    engine = CloeEngine(elements)
+    for p in DEFAULTS:
+        if p in SERIES:
+            continue
+        lo, hi = parameter_range(p)
+        engine.set_param_values(p,rng.uniform(lo,hi,len(elements)).tolist(),fromList=True)
+
+    dates = pd.date_range('2000-01-01',periods=DAYS)
+    for p in SERIES:
+        data = rng.uniform(0.0,10.0,(DAYS,len(elements)))
+        if p == 'quickflow':
+            data[rng.random(data.shape) < 0.2] = 0.0
+        columns = ['%s%d'%(p,i) for i in range(len(elements))]
+        engine.create_data_source(p,pd.DataFrame(data,index=dates,columns=columns))
+        engine.assign_time_series(p,columns,p,from_list=True)
+    return engine
+
+def reference_run(engine):
+    dates = engine.default_dates()
+    static = {p:engine._parameter(p) for p in DEFAULTS}
+    result = {v:np.empty((len(dates),engine.n_elements)) for v in DEFAULT_RECORD}
+    for el in range(engine.n_elements):
+        areal = engine.elements.model[el] == AREAL
+        model = ReferenceModel({p:v[el] for p,v in static.items()},
+                               engine.elements.area[el]*1e-4 if areal else None)
+        for t,date in enumerate(dates):
+            for p in SERIES:
+                ds, column = engine.time_series[p][el]
+                model.p[p] = engine.data_sources[ds][column][date]
+            model.run_time_step(TIMESTEP)
+            for v in DEFAULT_RECORD:
+                result[v][t,el] = getattr(model,v)
+    return result
+
+def test_matches_reference(engine):
+    results = engine.run(timestep=TIMESTEP)
+    expected = reference_run(engine)
+    for v in DEFAULT_RECORD:
+        np.testing.assert_allclose(results[v],expected[v],rtol=1e-10,atol=1e-14,err_msg=v)
+
+SENSITIVITIES=['B1','B2','B11','B21','B31','B42','M3','M41','Dsurf','Osurf','Dgw','Dout','DgwOut','OgwSurf','Alpha','M','E']
+
+def test_sensitivities_match_finite_differences(engine):
+    results = engine.run(timestep=TIMESTEP,sensitivities=SENSITIVITIES,sensitivity_record=LOADS+['SoilStore'])
+    for p in SENSITIVITIES:
+        base = engine.parameters[p].copy()
+        h = 1e-6*np.maximum(1.0,np.abs(base))
+        engine.parameters[p] = base + h
+        up = engine.run(timestep=TIMESTEP,record=LOADS+['SoilStore'])
+        engine.parameters[p] = base - h
+        down = engine.run(timestep=TIMESTEP,record=LOADS+['SoilStore'])
+        engine.parameters[p] = base
+        for v in LOADS+['SoilStore']:
+            finite_difference = (up[v] - down[v]) / (2*h)
+            scale = np.abs(finite_difference).max()
+            np.testing.assert_allclose(results.sensitivities[v][p],finite_difference,
+                                       rtol=1e-4,atol=1e-6*scale,err_msg='%s/%s'%(v,p))
+
+def test_time_series_parameter_not_in_defaults(engine):
+    engine.assign_time_series('Unknown','InputRate0','InputRate')
+    with pytest.raises(ValueError,match='Unknown'):
+        engine.run(timestep=TIMESTEP)
+
+@pytest.mark.parametrize('model',['non_areal','Source.CLOE.NonArealCLOEModel'])
+def test_from_setup_conditional_model_names(tmp_path,model):
+    config_fn, network_df, fus = generate(str(tmp_path),4,days=10)
+    setup = CloeSetup(config_fn,FakeVeneer(network_df,fus))
+    setup.load_inputs()
+    setup.conditional_sources = [{'model':model,'constrain':{'sources':'Hillslope','fus':fus[0]}}]
+    areas = {(c,fu):1e5 for c in setup.catchment_names for fu in fus}
+    elements = CloeEngine.from_setup(setup,areas).elements
+    conditional = (elements.source=='Hillslope') & (elements.fu==fus[0])
+    assert conditional.any()
+    assert (elements.model[conditional] == NON_AREAL).all()
+    assert (elements.model[(elements.source=='Hillslope') & ~conditional] == AREAL).all()
@@ -0,0 +1,89 @@
+'''
+PrefixIndex and MetadataCache, and runoff functions configured through the cache,
+using FakeVeneer.
+'''
+import pandas as pd
+import pytest
+
+from cloe_metadata import MetadataCache, PrefixIndex
+from cloe_setup import CloeSetup
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+def test_prefix_index():
+    index = PrefixIndex(['$b_2','$a_1','$ab_1','$a_2','$b_1','$a_1'])
+    assert len(index) == 5
+    assert '$ab_1' in index and '$c' not in index
+    # In the order listed, not sorted
+    assert index.with_prefix('$a_') == ['$a_1','$a_2']
+    assert index.with_prefix('$a') == ['$a_1','$ab_1','$a_2']
+    assert index.with_prefix('$b') == ['$b_2','$b_1']
+    assert index.with_prefix('$c') == []
+
+    index.add('$a_0')
+    index.add('$a_1')
+    assert index.with_prefix('$a_') == ['$a_1','$a_2','$a_0']
+    index.remove('$a_1')
+    index.remove('$missing')
+    assert index.with_prefix('$a') == ['$ab_1','$a_2','$a_0']
+    assert '$a_1' not in index and len(index) == 5
+
+@pytest.fixture
+def model(tmp_path):
+    return generate(str(tmp_path),12,days=10)
+
+def test_variables_cached_and_invalidated(model):
+    _, network_df, fus = model
+    v = FakeVeneer(network_df,fus)
+    metadata = MetadataCache(v)
+    assert metadata.variables_with_prefix('$Quick_Flow') == []
+    assert v.requests_by_path['variables'] == 1
+
+    # Creating variables re-queries overlapping prefixes only
+    metadata.create_modelled_variable('Quick Flow Rate',fus=fus[0])
+    assert metadata.variables_with_prefix('$Slow_Flow') == []
+    assert v.requests_by_path['variables'] == 1
+    rate = metadata.variables_with_prefix('$Quick_Flow')
+    assert v.requests_by_path['variables'] == 2
+    assert rate == list(v.variable_names)
+    assert len(rate) == 12
+    metadata.create_modelled_variable('Quick Flow')
+    quick = metadata.variables_with_prefix('$Quick_Flow')
+    assert v.requests_by_path['variables'] == 3
+    assert quick == list(v.variable_names)
+    assert metadata.variables_with_prefix('$Quick_Flow_Rate') == rate
+
+    # Deleted variables are dropped without re-querying
+    metadata.delete_variables(rate[:5])
+    assert metadata.variables_with_prefix('$Quick_Flow_Rate') == rate[5:]
+    assert metadata.variables_with_prefix('$Quick_Flow') == list(v.variable_names)
+    assert v.requests_by_path['variables'] == 3
+
+def variable_name(prefix,sc,fu):
+    return ('$%s_%s_%s'%(prefix,sc,fu)).replace('#','').replace(' ','_')
+
+@pytest.mark.parametrize('model_variables',[['Quick Flow','Quick Flow Rate'],['Quick Flow Rate','Quick Flow']])
+def test_overlapping_function_variables(model,model_variables):
+    config_fn, network_df, fus = model
+    v = FakeVeneer(network_df,fus)
+    setup = CloeSetup(config_fn,v)
+    setup.load_inputs()
+    setup.create_constituents()
+    setup.create_constituent_sources()
+    setup.install_models()
+    fn = dict(setup.cfg['runoff_functions'][0],
+              template='{Quick_Flow}*{Quick_Flow_Rate}*{dist}',
+              model_variables=model_variables)
+    # Variables left from an earlier setup, to be replaced
+    v.model.catchment.runoff.create_modelled_variable('Quick Flow Rate',fus=fus[1])
+    setup._setup_function(fn)
+
+    distance = pd.read_csv(setup.input_files['attributes']).set_index('name')['distance']
+    elements = [(sc,fu) for sc in setup.catchment_names for fu in fus]
+    assert len(v.functions) == len(elements)
+    for sc,fu in elements:
+        arguments = v.functions[variable_name('drainage',sc,fu)]
+        assert arguments['Quick_Flow'] == variable_name('Quick_Flow',sc,fu)
+        assert arguments['Quick_Flow_Rate'] == variable_name('Quick_Flow_Rate',sc,fu)
+        assert arguments['dist'] == pytest.approx(distance[sc])
+    assert len(v.variable_names) == 2*len(elements)
@@ -0,0 +1,128 @@
+'''
+Spatial parameters applied in bulk (_apply_spatial_parameter, first_match_values)
+compared with applying the rows of the input one at a time, as originally done.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from cloe_setup import CloeSetup, first_match_values
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+N_CATCHMENTS=10
+
+@pytest.fixture
+def model(tmp_path):
+    return generate(str(tmp_path),N_CATCHMENTS,days=10)
+
+def installed(model):
+    config_fn, network_df, fus = model
+    v = FakeVeneer(network_df,fus)
+    setup = CloeSetup(config_fn,v)
+    setup.load_inputs()
+    setup.create_constituents()
+    setup.create_constituent_sources()
+    setup.install_models()
+    return setup, v
+
+def parameter_table(setup,rows):
+    '''
+    Input of (catchment,fu,source,value) rows, with rows for catchments (and FUs) not in the model
+    '''
+    return pd.DataFrame(rows + [('SC #999',setup.fus[0],'Hillslope',-1.0),(setup.catchment_names[0],'Unknown','Hillslope',-2.0)],
+                        columns=['name','fu','source','value'])
+
+def overlapping_rows(setup,rng):
+    '''
+    Rows for some catchments and FUs, with repeated catchment/FU pairs (later rows override)
+    '''
+    catchments = setup.catchment_names
+    fus = sorted(setup.fus)
+    rows = []
+    for _ in range(40):
+        sc = catchments[rng.integers(0,len(catchments)-2)]
+        fu = fus[rng.integers(0,len(fus)-1)]
+        rows.append((sc,fu,'Hillslope',float(rng.random())))
+    return rows
+
+def full_rows(setup,rng):
+    rows = [(sc,fu,'Hillslope',float(rng.random())) for sc in setup.catchment_names for fu in setup.fus]
+    # Overridden by repeated rows
+    return rows + [(sc,fu,src,v+10.0) for sc,fu,src,v in rows[::3]]
+
+SPATIAL=[
+    # Single match key, some catchments, overlapping rows
+    ({'match':{'catchments':'name'}},overlapping_rows),
+    # Single match key, every catchment
+    ({'match':{'catchments':'name'}},full_rows),
+    # Two match keys, some elements
+    ({'match':{'catchments':'name','fus':'fu'}},overlapping_rows),
+    # Two match keys, every element
+    ({'match':{'catchments':'name','fus':'fu'}},full_rows),
+    # Constrained
+    ({'match':{'catchments':'name','fus':'fu'},'constrain':{'sources':'Septic','constituents':'TN'}},overlapping_rows),
+    # Match key overridden by the constraint
+    ({'match':{'catchments':'name','fus':'fu'},'constrain':{'fus':'Grazing'}},overlapping_rows),
+    # Match on three keys (applied row by row)
+    ({'match':{'catchments':'name','fus':'fu','sources':'source'}},overlapping_rows)
+]
+
+@pytest.mark.parametrize('spatial,rows',SPATIAL)
+def test_spatial_parameter_matches_row_by_row(model,spatial,rows):
+    results = {}
+    for bulk in [True,False]:
+        setup, v = installed(model)
+        setup.inputs['params'] = parameter_table(setup,rows(setup,np.random.default_rng(5)))
+        sp = dict(spatial,input='params',param='Distance',value='value')
+        v.reset_counts()
+        target = setup._v.model.catchment.generation
+        if bulk:
+            setup._apply_spatial_parameter(target,sp,setup.metadata.generation_names)
+        else:
+            for val,matches in setup.extract_spatial_parameters(sp):
+                target.set_param_values(sp['param'],val,**matches)
+        results[bulk] = (dict(v.parameters),v.requests)
+
+    assert len(results[True][0])
+    assert results[True][0] == results[False][0]
+    if len(spatial['match']) - len(spatial.get('constrain',{})) <= 2:
+        # At most one request per FU (two match keys), plus enumerate_names
+        assert results[True][1] <= len(model[2]) + 1
+
+def reference_first_match_values(actions,elements,default):
+    values = []
+    for sc,fu in elements:
+        val_found = default
+        for val,matches in actions:
+            if 'catchments' in matches:
+                if matches['catchments'] != sc:
+                    continue
+            if 'fus' in matches:
+                if matches['fus'] != fu:
+                    continue
+            val_found = val
+            break
+        values.append(val_found)
+    return values
+
+def test_first_match_values():
+    rng = np.random.default_rng(9)
+    catchments = ['SC #%d'%i for i in range(8)]
+    fus = ['Grazing','Urban','Forestry']
+    elements = [(sc,fu) for sc in catchments for fu in fus]
+    for case in range(20):
+        actions = []
+        for ix in range(15):
+            matches = {}
+            if rng.random() < 0.7:
+                matches['catchments'] = catchments[rng.integers(0,len(catchments))]
+            if rng.random() < 0.5:
+                matches['fus'] = fus[rng.integers(0,len(fus))]
+            if rng.random() < 0.2:
+                matches['sources'] = 'Hillslope'
+            actions.append((float(ix),matches))
+        if case % 2:
+            # Catch all, part way through
+            actions.insert(8,(-5.0,{}))
+        assert first_match_values(actions,elements,-1) == reference_first_match_values(actions,elements,-1)
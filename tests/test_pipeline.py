@@ -0,0 +1,139 @@
+'''
+Concurrent (cloe_pipeline) and incremental (cloe_plan) application of a configuration,
+compared with CloeSetup.apply, using FakeVeneer and synthetic models.
+'''
+import pytest
+
+from cloe_pipeline import lanes
+from cloe_plan import Operation
+from cloe_setup import CloeSetup
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+N_CATCHMENTS=12
+
+@pytest.fixture
+def model(tmp_path):
+    return generate(str(tmp_path),N_CATCHMENTS,days=30)
+
+def fresh(model):
+    config_fn, network_df, fus = model
+    v = FakeVeneer(network_df,fus)
+    return CloeSetup(config_fn,v,batch_time_series=True), v
+
+def model_state(v):
+    return {
+        'constituents':sorted(v.constituents),
+        'constituent_sources':sorted(v.constituent_sources),
+        'models':dict(v.generation_models),
+        'parameters':dict(v.parameters),
+        'time_series':dict(v.time_series),
+        'functions':set(v.functions),
+        'data_sources':dict(v.data_source_columns)
+    }
+
+@pytest.fixture
+def sequential(model):
+    setup, v = fresh(model)
+    setup.apply()
+    return model_state(v)
+
+def test_pipeline_on_fresh_model(model,sequential):
+    setup, v = fresh(model)
+    setup.apply(workers=4)
+    state = model_state(v)
+    assert len(state['parameters'])
+    assert len(state['time_series'])
+    for k,expected in sequential.items():
+        assert state[k] == expected, k
+
+@pytest.mark.parametrize('workers',[None,4])
+def test_incremental_on_fresh_model(model,sequential,tmp_path,workers):
+    setup, v = fresh(model)
+    plan = setup.apply(incremental=True,state_fn=str(tmp_path/'state.json'),workers=workers)
+    assert model_state(v) == sequential
+    assert len(plan.changes) == len(plan.operations)
+
+    v.reset_counts()
+    plan = setup.apply(incremental=True,state_fn=str(tmp_path/'state.json'),workers=workers)
+    assert not len(plan.changes)
+    assert model_state(v) == sequential
+
+def test_incremental_models_change(model,sequential,tmp_path):
+    setup, v = fresh(model)
+    state_fn = str(tmp_path/'state.json')
+    setup.apply(incremental=True,state_fn=state_fn)
+
+    # Installing a different model resets the parameters and inputs of the affected elements
+    setup.conditional_sources = [{'model':'areal','constrain':{'fus':model[2][0],'sources':'Septic'}}]
+    plan = setup.apply(incremental=True,state_fn=state_fn)
+    changed = set(op.stage for op in plan.changes)
+    assert {'models','parameters','time_series','functions'}.issubset(changed)
+    state = model_state(v)
+    assert state['parameters'] == sequential['parameters']
+    assert state['time_series'] == sequential['time_series']
+
+def test_incremental_models_keyed_by_arguments(model,tmp_path):
+    setup, v = fresh(model)
+    state_fn = str(tmp_path/'state.json')
+    fus = model[2]
+    setup.conditional_sources = [
+        {'model':'areal','constrain':{'fus':fus[0],'sources':'Septic'}},
+        {'model':'areal','constrain':{'fus':fus[1],'sources':'Septic'}}
+    ]
+    plan = setup.apply(incremental=True,state_fn=state_fn)
+    groups = list(plan.state['models'])
+    assert len(groups) == 5
+    assert all('CLOE' in g for g in groups)
+
+    setup.conditional_sources[0] = {'model':'areal','constrain':{'fus':fus[2],'sources':'Septic'}}
+    plan = setup.apply(incremental=True,state_fn=state_fn)
+    models = [op for op in plan.changes if op.stage == 'models']
+    assert [op.kwargs.get('fus') for op in models] == [fus[2],fus[1],None]
+
+def test_pipeline_traced(model):
+    setup, v = fresh(model)
+    v.reset_counts()
+    setup.apply(workers=4)
+    spans = setup.tracer.spans
+    assert [s for s in spans if s.name == 'apply'][0].counters['requests'] == v.requests
+    pipeline = [s for s in spans if s.name == 'pipeline'][0]
+    assert pipeline.parent == 'apply'
+    compiled = [s for s in spans if s.name == 'connect_time_series']
+    assert [s.parent for s in compiled] == ['pipeline']
+
+def assign(parameter,column,**kwargs):
+    return Operation('time_series','generation:%s'%parameter,'model.catchment.generation.assign_time_series',
+                     [parameter,column,'ds'],kwargs)
+
+def clear(parameter):
+    return Operation('time_series','generation:%s'%parameter,'model.catchment.generation.clear_time_series',[parameter],{})
+
+def test_time_series_lanes():
+    by_source = [assign('InputRate','a',sources='Hillslope'),assign('InputRate','b',sources='Septic'),
+                 assign('InputRate','c',sources='Hillslope'),assign('Temp','d',sources='Hillslope')]
+    unconstrained = [assign('InputRate','e',fus='Grazing'),assign('Temp','f'),assign('InputRate','g',sources=['Hillslope','Septic'])]
+    phases = lanes([clear('InputRate')] + by_source + unconstrained + [assign('InputRate','h',sources='Septic')])
+    columns = [[[op.args[1] if len(op.args) > 1 else 'clear' for op in lane] for lane in phase] for phase in phases]
+    assert columns == [
+        [['clear']],
+        [['a','c'],['b'],['d']],
+        [['e','g'],['f']],
+        [['h']]
+    ]
+
+def test_pipeline_global_time_series(model):
+    config_fn, network_df, fus = model
+    states = []
+    for workers in [None,4]:
+        v = FakeVeneer(network_df,fus,latency=0.001)
+        setup = CloeSetup(config_fn,v,batch_time_series=True)
+        # Overrides the time series assigned to each source of the first FU
+        setup.cfg['inputs']['global'] = [{'source':'hillslope','column':'SC#0:%s'%fus[0],'parameter':'InputRate',
+                                          'constrain':{'fus':fus[0]}}]
+        setup.apply(workers=workers)
+        states.append(model_state(v))
+    sequential, concurrent = states
+    overridden = [ts for (name,p),ts in sequential['time_series'].items() if name[1]==fus[0] and p=='InputRate']
+    assert len(overridden) and all(ts == ('hillslope','SC#0:%s'%fus[0]) for ts in overridden)
+    assert concurrent == sequential
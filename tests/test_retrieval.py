@@ -0,0 +1,65 @@
+'''
+CloeScenario retrieval in chunks (streaming) and of every recorder at once (fetch_all),
+compared with retrieving the same series in a single request, using FakeVeneer.
+'''
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from cloe_setup import CloeScenario, custom_name, model_var_criteria, fu_flux_criteria, sum_dataframe
+from fake_veneer import FakeVeneer
+from synthetic import FUS, network
+
+def fake():
+    v = FakeVeneer(network(12),FUS,dates=pd.date_range('2000-01-01',periods=20))
+    v.constituents = ['TP','TN']
+    v.constituent_sources = ['Hillslope','Septic','Fertiliser']
+    CloeScenario(v).record_stores()
+    CloeScenario(v).record_fluxes()
+    return v
+
+def single_request(v,criteria):
+    run_data = v.retrieve_run()
+    table = v.retrieve_multiple_time_series(run_data=run_data,criteria=criteria,name_fn=custom_name)
+    return sum_dataframe(table,'@@',sum_element=1)
+
+def compare(actual,expected):
+    assert len(expected.columns)
+    assert set(actual.columns) == set(expected.columns)
+    pd.testing.assert_frame_equal(actual[list(expected.columns)],expected,check_freq=False)
+
+@pytest.mark.parametrize('chunk_by,chunk_size',[('catchment',1),('catchment',5),('catchment',50),
+                                                ('variable',1),('variable',7)])
+def test_stream_matches_single_request(tmp_path,chunk_by,chunk_size):
+    v = fake()
+    scenario = CloeScenario(v)
+    store = scenario.stream_model_var_by_fu('SoilStore',str(tmp_path/'soil'),'TN',chunk_size=chunk_size,chunk_by=chunk_by)
+    compare(store.read(),single_request(v,model_var_criteria('SoilStore','TN')))
+
+    store = scenario.stream_fu_flux('Quick Flow Load Out',str(tmp_path/'quick'),'TP',chunk_size=chunk_size,chunk_by=chunk_by)
+    compare(store.read(),single_request(v,fu_flux_criteria('Quick Flow Load Out','TP')))
+
+def test_fetch_all_matches_single_request(tmp_path):
+    v = fake()
+    scenario = CloeScenario(v,cache=str(tmp_path/'cache'),fetch_all=True)
+    run_data = v.retrieve_run()
+    v.reset_counts()
+    soil = scenario.retrieve_model_var_by_fu('SoilStore','TP',run_data=run_data)
+    # Every CLOE recorder (not LinkStore) retrieved, each series once
+    generation = [r for r in run_data['Results'] if 'FunctionalUnit' in r]
+    assert len(generation) < len(run_data['Results'])
+    assert v.requests_by_path == {'retrieve_multiple_time_series':len(generation)}
+    compare(soil,single_request(v,model_var_criteria('SoilStore','TP')))
+
+    for constituent in ['TP','TN']:
+        compare(scenario.retrieve_model_var_by_fu('LossOut$',constituent,run_data=run_data),
+                single_request(v,model_var_criteria('LossOut$',constituent)))
+        compare(scenario.retrieve_fu_flux('Slow Flow Load Out',constituent,run_data=run_data),
+                single_request(v,fu_flux_criteria('Slow Flow Load Out',constituent)))
+
+    # Served from the cache
+    v.reset_counts()
+    scenario.retrieve_model_var_by_fu('GroundwaterStore','TN',run_data=run_data)
+    scenario.retrieve_fu_flux('Quick Flow Load Out','TN',run_data=run_data)
+    assert v.requests == 0
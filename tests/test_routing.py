@@ -0,0 +1,70 @@
+'''
+InstreamRouting: parallel routing matches serial routing, mass is conserved and
+sensitivities match central finite differences.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from cloe_routing import InstreamRouting
+from synthetic import catchment_name, network
+
+TIMESTEP=86400.0
+DAYS=40
+N_LINKS=40
+
+@pytest.fixture
+def routing():
+    network_df = network(N_LINKS,seed=3)
+    routing = InstreamRouting(network_df)
+    rng = np.random.default_rng(7)
+    routing.set_param_values('Dlink',rng.uniform(0.2,0.9,N_LINKS).tolist(),fromList=True)
+    routing.set_param_values('Olink',rng.uniform(0.0,0.8,N_LINKS).tolist(),fromList=True)
+    routing.set_param_values('B51',rng.uniform(0.0,2.0,N_LINKS).tolist(),fromList=True)
+    routing.set_param_values('InitialLinkStore',rng.uniform(0.0,5.0,N_LINKS).tolist(),fromList=True)
+    return routing
+
+@pytest.fixture
+def inputs(routing):
+    rng = np.random.default_rng(11)
+    dates = pd.date_range('2000-01-01',periods=DAYS)
+    loads = pd.DataFrame(rng.uniform(0.0,1e-4,(DAYS,N_LINKS)),index=dates,
+                         columns=[catchment_name(ix) for ix in range(N_LINKS)])
+    names = [routing.link_names[l] for l in routing.link_ids]
+    flow = pd.DataFrame(rng.uniform(0.1,10.0,(DAYS,N_LINKS)),index=dates,columns=names)
+    return loads, flow
+
+def test_parallel_matches_serial(routing,inputs):
+    loads, flow = inputs
+    serial = routing.route(loads,flow,timestep=TIMESTEP)
+    jobs, trunk = routing.partition(8)
+    assert len(jobs) > 1
+    parallel = routing.route(loads,flow,timestep=TIMESTEP,workers=2)
+    for k in ['ProcessedLoad','LinkStore']:
+        pd.testing.assert_frame_equal(parallel[k],serial[k],check_exact=False,rtol=1e-12,atol=0.0)
+
+def test_mass_balance(routing,inputs):
+    loads, flow = inputs
+    initial = routing._parameter('InitialLinkStore').sum()
+    result = routing.route(loads,flow,timestep=TIMESTEP,additional_inflow=0.01)
+    outlets = [routing.link_names[l] for l in routing.link_ids if not len(routing.downstream[l])]
+    inflow = loads.values.sum()*TIMESTEP + 0.01*DAYS*N_LINKS
+    exported = result['ProcessedLoad'][outlets].values.sum()
+    stored = result['LinkStore'].iloc[-1].sum()
+    assert initial + inflow == pytest.approx(exported + stored,rel=1e-10)
+
+def test_sensitivities_match_finite_differences(routing,inputs):
+    loads, flow = inputs
+    parameters = ['Dlink','Olink','B51']
+    result = routing.route(loads,flow,timestep=TIMESTEP,sensitivities=parameters)
+    for p in parameters:
+        base = routing.parameters[p].copy()
+        h = 1e-6
+        routing.parameters[p] = base + h
+        up = routing.route(loads,flow,timestep=TIMESTEP)['ProcessedLoad']
+        routing.parameters[p] = base - h
+        down = routing.route(loads,flow,timestep=TIMESTEP)['ProcessedLoad']
+        routing.parameters[p] = base
+        finite_difference = (up - down) / (2*h)
+        np.testing.assert_allclose(result['ProcessedLoad sensitivities'][p].values,finite_difference.values,
+                                   rtol=1e-5,atol=1e-8*np.abs(finite_difference.values).max(),err_msg=p)
@@ -0,0 +1,183 @@
+'''
+ScenarioScheduler running scenarios on FakeVeneer endpoints: restoring the base model
+after each run, retrying failed scenarios, retiring endpoints and resuming from the store.
+'''
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from cloe_cache import ScenarioStore
+from cloe_scheduler import ScenarioScheduler, RestoreError, apply_changes, parameter_changes
+from cloe_setup import CloeSetup
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+SCENARIOS=[
+    {'name':'baseline'},
+    {'name':'riparian','parameters':{'fixed':{'Dsurf':0.3}}},
+    {'name':'reduced_fertiliser','parameters':{
+        'fixed':{'Dgw':0.2},
+        'scalar':[{'match':{'fus':'Grazing'},'parameters':{'M':0.5,'Dsurf':0.1}}]
+    }},
+    {'name':'forestry','parameters':{'scalar':[{'match':{'fus':'Forestry'},'parameters':{'M':2.0}}]}}
+]
+
+# Parameters of the base model changed by the scenarios
+BASE_PARAMETERS={'M':1.0,'Dsurf':0.2,'Dgw':0.05}
+
+class FailingVeneer(FakeVeneer):
+    '''
+    FakeVeneer where run_model fails the first fail_runs times, and set_param_values
+    fails set_failures times (or every time, if None) once fail_sets_after calls have
+    succeeded (as if the connection dropped)
+    '''
+    fail_runs=0
+    fail_sets_after=None
+    set_failures=None
+
+    def _model_catchment_generation_set_param_values(self,*args,**kwargs):
+        if self.fail_sets_after is not None and self.set_failures != 0:
+            if self.fail_sets_after == 0:
+                if self.set_failures is not None:
+                    self.set_failures -= 1
+                raise OSError('Connection dropped')
+            self.fail_sets_after -= 1
+        return super()._model_catchment_generation_set_param_values(*args,**kwargs)
+
+    def run_model(self,*args,**kwargs):
+        if self.fail_runs:
+            self.fail_runs -= 1
+            raise OSError('Run failed')
+        return super().run_model(*args,**kwargs)
+
+@pytest.fixture
+def model(tmp_path):
+    return generate(str(tmp_path/'model'),6,days=10)
+
+def installed(model,**kwargs):
+    config_fn, network_df, fus = model
+    v = FailingVeneer(network_df,fus)
+    setup = CloeSetup(config_fn,v)
+    setup.load_inputs()
+    setup.create_constituents()
+    setup.create_constituent_sources()
+    setup.install_models()
+    for p,value in BASE_PARAMETERS.items():
+        v.model.catchment.generation.set_param_values(p,value)
+    for failure,value in kwargs.items():
+        setattr(v,failure,value)
+    return v
+
+class Connections(object):
+    '''
+    Endpoint function returning the same client, counting connections
+    '''
+    def __init__(self,v):
+        self.v = v
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return self.v
+
+def scheduler(tmp_path,endpoints,**kwargs):
+    return ScenarioScheduler(endpoints,str(tmp_path/'scenarios'),constituents=['TP'],**kwargs)
+
+def scenario_values(v,scenario):
+    '''
+    Generation parameters of v with the changes of scenario applied
+    '''
+    target = v.model.catchment.generation
+    base = dict(v.parameters)
+    apply_changes(target,parameter_changes(scenario.get('parameters',{})))
+    values = dict(v.parameters)
+    v.parameters.clear()
+    v.parameters.update(base)
+    return values
+
+def test_scenarios_run_on_base_model(tmp_path,model):
+    v = installed(model)
+    base = dict(v.parameters)
+    expected = [scenario_values(v,s) for s in SCENARIOS]
+    assert v.parameters == base
+    assert expected[2] != base
+
+    store = scheduler(tmp_path,[v]).run(SCENARIOS)
+    assert store.completed() == {s['name'] for s in SCENARIOS}
+    # Each run used its scenario's parameters, applied to the base model
+    assert v.runs == expected
+    assert v.parameters == base
+    quickflow = store.read('quickflow@TP')
+    assert len(quickflow)
+    assert sorted(store.names()) == ['quickflow@TP','slowflow@TP']
+
+def test_failed_scenario_retried(tmp_path,model):
+    v = installed(model,fail_runs=1)
+    base = dict(v.parameters)
+    connections = Connections(v)
+    store = scheduler(tmp_path,[connections]).run(SCENARIOS[1:2])
+    assert store.completed() == {'riparian'}
+    assert store.scenarios['riparian']['attempts'] == 2
+    # Reconnected after the failure, with the parameters restored
+    assert connections.count == 2
+    assert len(v.runs) == 1
+    assert v.parameters == base
+
+def test_endpoint_retired_after_repeated_failures(tmp_path,model):
+    v = installed(model,fail_runs=10)
+    base = dict(v.parameters)
+    connections = Connections(v)
+    store = scheduler(tmp_path,[connections],retries=1,max_failures=3).run(SCENARIOS[1:3])
+    assert store.completed() == set()
+    assert store.scenarios['riparian']['status'] == 'failed'
+    assert store.scenarios['riparian']['attempts'] == 2
+    assert 'reduced_fertiliser' not in store.scenarios
+    assert connections.count == 3
+    assert v.parameters == base
+
+def test_rollback_failure_raises_restore_error(model):
+    v = installed(model,fail_sets_after=1)
+    changes = parameter_changes(SCENARIOS[2]['parameters'])
+    with pytest.raises(RestoreError):
+        apply_changes(v.model.catchment.generation,changes)
+
+def test_rollback_after_failed_change(model):
+    v = installed(model,fail_sets_after=2,set_failures=1)
+    base = dict(v.parameters)
+    changes = parameter_changes(SCENARIOS[2]['parameters'])
+    with pytest.raises(OSError):
+        apply_changes(v.model.catchment.generation,changes[:2] + changes)
+    # Restored once the failing change has been rolled back
+    assert v.parameters == base
+
+def test_endpoint_retired_when_not_restored(tmp_path,model):
+    v = installed(model,fail_sets_after=0)
+    connections = Connections(v)
+    store = scheduler(tmp_path,[connections]).run(SCENARIOS[1:3])
+    # Not reconnected and reused with a partly modified model
+    assert connections.count == 1
+    assert v.runs == []
+    assert store.completed() == set()
+
+    # Other endpoints pick up the scenarios
+    good = installed(model)
+    store = scheduler(tmp_path,[Connections(v),good]).run(SCENARIOS[1:3])
+    assert store.completed() == {'riparian','reduced_fertiliser'}
+    assert {store.scenarios[s]['endpoint'] for s in store.completed()} == {1}
+
+def test_resume_from_store(tmp_path,model):
+    v = installed(model)
+    first = scheduler(tmp_path,[v]).run(SCENARIOS[:2])
+    quickflow = first.get('riparian','quickflow@TP')
+    assert len(v.runs) == 2
+
+    # Completed scenarios are skipped
+    store = scheduler(tmp_path,[v]).run(SCENARIOS)
+    assert len(v.runs) == len(SCENARIOS)
+    assert store.completed() == {s['name'] for s in SCENARIOS}
+    reloaded = ScenarioStore(str(tmp_path/'scenarios'))
+    assert reloaded.completed() == store.completed()
+    assert reloaded.get('riparian','quickflow@TP').equals(quickflow)
+
+    scheduler(tmp_path,[v]).run(SCENARIOS)
+    assert len(v.runs) == len(SCENARIOS)
@@ -0,0 +1,114 @@
+'''
+CloeSetup against FakeVeneer, using synthetic models.
+'''
+import os
+import pandas as pd
+import pytest
+
+from cloe_setup import CloeSetup
+from fake_veneer import FakeVeneer
+from synthetic import generate
+
+@pytest.fixture
+def model(tmp_path):
+    return generate(str(tmp_path),8,days=30)
+
+def with_manifest(model,v):
+    config_fn = model[0]
+    setup = CloeSetup(config_fn,v)
+    setup.cfg['inputs'].pop('upload_manifest')
+    return setup
+
+def test_upload_manifest_checked_against_source(model):
+    config_fn, network_df, fus = model
+    v = FakeVeneer(network_df,fus)
+    setup = with_manifest(model,v)
+    setup.apply()
+    assert os.path.exists(os.path.splitext(config_fn)[0] + '.data_sources.json')
+    uploaded = dict(v.data_source_columns)
+
+    # Unchanged: nothing uploaded
+    v.reset_counts()
+    setup.apply()
+    assert v.requests_by_path.get('create_data_source',0) == 0
+
+    # Data sources lost (eg Source restarted): the manifest isn't trusted
+    v.data_source_columns.clear()
+    setup.apply()
+    assert v.data_source_columns == uploaded
+
+ASSIGN='model_catchment_generation_assign_time_series'
+
+@pytest.mark.parametrize('n_catchments',[8,40])
+def test_batch_time_series(tmp_path,n_catchments):
+    config_fn, network_df, fus = generate(str(tmp_path),n_catchments,days=30)
+    assigned = {}
+    requests = {}
+    applied = {}
+    for batch in [False,True]:
+        v = FakeVeneer(network_df,fus)
+        setup = CloeSetup(config_fn,v,batch_time_series=batch)
+        setup.load_inputs()
+        setup.create_constituents()
+        setup.create_constituent_sources()
+        setup.install_models()
+        setup.create_data_sources()
+        v.reset_counts()
+        applied[batch] = setup.connect_time_series()['applied']
+        assigned[batch] = dict(v.time_series)
+        requests[batch] = v.requests_by_path[ASSIGN]
+
+    assert len(assigned[True])
+    assert assigned[True] == assigned[False]
+    assert applied[True] == applied[False]
+    # One request per catchment and FU...
+    assert requests[False] == applied[False]
+    # ...or one per constituent and source with full coverage (Hillslope, Fertiliser, Gully)
+    # and one per FU for those with data in some catchments (Septic)
+    assert requests[True] == 2 + 2 + 1 + 2*len(fus)
+
+def connected(config_fn,network_df,fus,chunk_columns=None):
+    v = FakeVeneer(network_df,fus)
+    setup = CloeSetup(config_fn,v,batch_time_series=True)
+    if chunk_columns is not None:
+        setup.cfg['inputs']['upload_chunk_columns'] = chunk_columns
+    setup.load_inputs()
+    setup.create_constituents()
+    setup.create_constituent_sources()
+    setup.install_models()
+    setup.create_data_sources()
+    setup.connect_time_series()
+    return setup, v
+
+def test_upload_chunks(tmp_path):
+    config_fn, network_df, fus = generate(str(tmp_path),12,days=10)
+    setup, v = connected(config_fn,network_df,fus)
+    names = set(v.data_source_columns)
+    assert 'hillslope' in names and not len(setup.data_source_parts)
+
+    # Data sources that fit in one part keep their name
+    _, single = connected(config_fn,network_df,fus,1000)
+    assert set(single.data_source_columns) == names
+    assert single.time_series == v.time_series
+
+    # Split into parts: the same columns are assigned from the parts holding them
+    chunked_setup, chunked = connected(config_fn,network_df,fus,25)
+    assert 'hillslope' not in chunked.data_source_columns
+    assert len(chunked_setup.data_source_parts['hillslope']) == 3
+    assert all(len(columns) <= 25 for columns in chunked.data_source_columns.values())
+    part_of = {part:name for name,parts in chunked_setup.data_source_parts.items() for part,_ in parts}
+    assert {k:(part_of.get(ds,ds),column) for k,(ds,column) in chunked.time_series.items()} == v.time_series
+
+def test_float32_time_series_only(model):
+    config_fn, network_df, fus = model
+    setup = CloeSetup(config_fn,FakeVeneer(network_df,fus))
+    setup.cfg['inputs']['float32'] = True
+    setup.load_inputs()
+    assert set(setup.temporal_inputs) == {'hillslope','fertiliser','septic'}
+    for name in setup.temporal_inputs:
+        assert 'float32' in set(str(t) for t in setup.inputs[name].dtypes)
+        assert 'float64' not in set(str(t) for t in setup.inputs[name].dtypes)
+    # Spatial parameter values keep full precision
+    attributes = setup.inputs['attributes']
+    assert attributes['distance'].dtype == 'float64'
+    assert attributes['distance'].tolist() == pd.read_csv(setup.input_files['attributes'])['distance'].tolist()
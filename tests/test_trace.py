@@ -0,0 +1,43 @@
+'''
+Tracer spans across threads.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cloe_trace import Tracer
+
+def test_threads_have_their_own_spans():
+    tracer = Tracer()
+    started = threading.Barrier(2)
+    def work(name):
+        with tracer.span(name):
+            started.wait()
+            with tracer.span(name+'_inner'):
+                tracer.record(requests=1)
+    threads = [threading.Thread(target=work,args=(n,)) for n in ['a','b']]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    spans = {s.name:s for s in tracer.spans}
+    assert spans['a_inner'].parent == 'a'
+    assert spans['b_inner'].parent == 'b'
+    assert spans['a'].counters['requests'] == 1
+    assert spans['b'].counters['requests'] == 1
+
+def test_bind_passes_parent_to_pool():
+    tracer = Tracer()
+    def work(ix):
+        with tracer.span('work'):
+            tracer.record(requests=1)
+    with tracer.span('apply'):
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(tracer.bind(work),range(8)))
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(work,range(2)))
+
+    work_spans = [s for s in tracer.spans if s.name == 'work']
+    assert [s.parent for s in work_spans].count('apply') == 8
+    assert [s.parent for s in work_spans].count(None) == 2
+    apply_span = [s for s in tracer.spans if s.name == 'apply'][0]
+    assert apply_span.counters['requests'] == 8